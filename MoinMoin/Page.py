@@ -35,12 +35,30 @@
 """
 
 import os, re, codecs
+from datetime import datetime
 
 from MoinMoin import log
 logging = log.getLogger(__name__)
 
 from MoinMoin import config, caching, user, util, wikiutil
 from MoinMoin.logfile import eventlog
+from MoinMoin.support.python_compatibility import hash_new
+from werkzeug import http_date, quote_etag
+
+# Names used by the cached code of pages that write the same html on each
+# view: the cache check of the text_python formatter, the formatter state
+# it sets, and the formatter calls that only depend on the render state
+# kept with the html (see Page._getRenderState)
+STATIC_CODE_NAMES = frozenset([
+    'Exception', 'None', 'True', 'False', '__file__', 'int', 'getattr',
+    'os', 'path', 'getmtime', 'dirname', 'moincode_timestamp', 'cfg',
+    'cfg_mtime', 'request', 'write', 'current_lang', 'formatter', 'in_p',
+    'in_pre', 'anchordef', 'line_anchordef', 'anchorlink',
+    'line_anchorlink', 'heading',
+])
+
+# Formatter attributes the static formatter calls use and change
+RENDER_STATE_ATTRS = ('_base_depth', '_show_section_numbers', 'in_p', 'in_pre')
 
 def is_cache_exception(e):
     args = e.args
@@ -917,30 +935,7 @@ class Page(object):
         # add current page name for list matching
         pageList.append(self.page_name)
 
-        scope, arena, key = 'userdir', 'users', 'pagesubscriptions'
-
-        # get or create cache file
-        cache = caching.CacheEntry(request, arena, key, scope=scope, use_pickle=True)
-        if cache.exists():
-            page_sub = cache.content()
-        else:
-            # build a cache if it doesn't exist
-            cache = caching.CacheEntry(request, arena, key, scope=scope, use_pickle=True, do_locking=False)
-            # lock to stop anybody else interfering with the data while we're working
-            cache.lock('w')
-            userlist = user.getUserList(request)
-            page_sub = {}
-            for uid in userlist:
-                subscriber = user.User(request, uid)
-                # we don't care about storing entries for users without any page subscriptions
-                if subscriber.subscribed_pages:
-                    page_sub[subscriber.id] = {
-                        'name': subscriber.name,
-                        'email': subscriber.email,
-                        'subscribed_pages': subscriber.subscribed_pages,
-                    }
-            cache.update(page_sub)
-            cache.unlock()
+        index = user.loadSubscriptionIndex(request)
 
         if self.cfg.SecurityPolicy:
             UserPerms = self.cfg.SecurityPolicy
@@ -950,56 +945,38 @@ class Page(object):
         # get email addresses of all wiki users which have a profile stored;
         # add the address only if the user has subscribed to the page and
         # the user is not the current editor
-        userlist = page_sub
         subscriber_list = {}
 
         pages = pageList[:]
         if request.cfg.interwikiname:
             pages += ["%s:%s" % (request.cfg.interwikiname, pagename) for pagename in pageList]
-        # Create text for regular expression search
-        text = '\n'.join(pages)
 
-        for uid in userlist:
+        for uid in sorted(index.subscribers(pages)):
             if uid == request.user.id and not include_self:
                 continue # no self notification
 
             # This is a bit wrong if return_users=1 (which implies that the caller will process
             # user attributes and may, for example choose to send an SMS)
             # So it _should_ be "not (subscriber.email and return_users)" but that breaks at the moment.
-            if not userlist[uid]['email']:
+            if not index.get_user(uid)['email']:
                 continue # skip empty email addresses
 
-            # now check patterns for actual match
-            isSubscribed = False
-            for pattern in userlist[uid]['subscribed_pages']:
-                if pattern in pages:
-                    isSubscribed = True
-                    break
-                try:
-                    pattern = re.compile(r'^%s$' % pattern, re.M)
-                except re.error:
-                    continue
-                if pattern.search(text):
-                    isSubscribed = True
-                    break
-
             # only if subscribed, create a User object from the profile
-            if isSubscribed:
-                subscriber = user.User(request, uid)
+            subscriber = user.User(request, uid)
 
-                if not subscriber.valid:
-                    continue
+            if not subscriber.valid:
+                continue
 
-                if not UserPerms(subscriber).read(self.page_name):
-                    continue
+            if not UserPerms(subscriber).read(self.page_name):
+                continue
 
-                lang = subscriber.language or request.cfg.language_default
-                if not lang in subscriber_list:
-                    subscriber_list[lang] = []
-                if return_users:
-                    subscriber_list[lang].append(subscriber)
-                else:
-                    subscriber_list[lang].append(subscriber.email)
+            lang = subscriber.language or request.cfg.language_default
+            if not lang in subscriber_list:
+                subscriber_list[lang] = []
+            if return_users:
+                subscriber_list[lang].append(subscriber)
+            else:
+                subscriber_list[lang].append(subscriber.email)
 
         request.clock.stop('getSubscribers')
         return subscriber_list
@@ -1242,13 +1219,18 @@ class Page(object):
                     elif request.user.valid:
                         # use nocache headers if a user is logged in (which triggers personalisation features)
                         request.disableHttpCaching(level=1)
-                    else:
-                        # TODO: we need to know if a page generates dynamic content -
-                        # if it does, we must not use the page file mtime as last modified value
-                        # The following code is commented because it is incorrect for dynamic pages:
-                        #lastmod = os.path.getmtime(self._text_filename())
-                        #request.headers['Last-Modified'] = util.timefuncs.formathttpdate(lastmod)
-                        pass
+                    elif (do_cache and request.status_code == 200 and
+                          self.isStaticContent(request)):
+                        # the content only changes with the page, its
+                        # attachments and the code, we can use the page
+                        # file mtime as last modified value. Not for 403,
+                        # the client must not keep showing its old copy.
+                        lastmod, etag = self.getHttpValidators(request)
+                        request.headers['Last-Modified'] = http_date(lastmod)
+                        request.headers['ETag'] = quote_etag(etag)
+                        if self._isNotModified(request, lastmod, etag):
+                            request.status_code = 304
+                            return
                 else:
                     request.status_code = 404
 
@@ -1437,16 +1419,16 @@ class Page(object):
 
         if not (do_cache and self.canUseCache(Parser)):
             self.format(parser)
-        else:
+        elif not self.sendHtmlCache(request):
             try:
                 code = self.loadCache(request)
-                self.execute(request, parser, code)
+                self.executeCache(request, parser, code)
             except Exception, e:
                 if not is_cache_exception(e):
                     raise
                 try:
                     code = self.makeCache(request, parser)
-                    self.execute(request, parser, code)
+                    self.executeCache(request, parser, code)
                 except Exception, e:
                     if not is_cache_exception(e):
                         raise
@@ -1477,6 +1459,152 @@ class Page(object):
         finally:
             request.clock.stop("Page.execute")
 
+    def executeCache(self, request, parser, code):
+        """ Write page content by executing cache code, and keep the html
+        written by code without dynamic parts in the html cache """
+        if not self.isStaticCode(code):
+            self.execute(request, parser, code)
+            return
+
+        state = self._getRenderState(request)
+        html = request.redirectedOutput(self.execute, request, parser, code)
+        if isinstance(html, unicode):
+            html = html.encode(config.charset)
+
+        cache = self._htmlCacheEntry(request, state)
+        cache.update({
+            'rev': self.get_real_rev(),
+            'state': state,
+            'html': html,
+            'result': self._getRenderState(request),
+        })
+        self._writeHtml(request, html)
+
+    def sendHtmlCache(self, request):
+        """ Write the page content from the html cache, if it has the html
+        for the current render state. Return if the page content was
+        written.
+        """
+        state = self._getRenderState(request)
+        cache = self._htmlCacheEntry(request, state)
+        if not self._isCacheCurrent(cache):
+            return False
+        try:
+            data = cache.content()
+        except caching.CacheError:
+            return False
+        if data['rev'] != self.get_real_rev() or data['state'] != state:
+            return False
+
+        self._writeHtml(request, data['html'])
+        self._setRenderState(request, data['result'])
+        return True
+
+    def _writeHtml(self, request, html):
+        # The html is sent as it is, but output collected with
+        # redirectedOutput must not mix encoded and unicode text
+        if request.writestack:
+            html = html.decode(config.charset)
+        request.write(html)
+
+    def _getRenderState(self, request):
+        """ Return the request and formatter state the formatter calls in
+        the cached code of static pages depend on and change """
+        uid_generator = request.uid_generator
+        page_ids = dict([(namespace, ids.copy())
+                         for namespace, ids in uid_generator.page_ids.items()])
+        counters = getattr(request, '_fmt_hd_counters', None)
+        if counters is not None:
+            counters = list(counters)
+        formatter = dict([(name, getattr(self.formatter, name))
+                          for name in RENDER_STATE_ATTRS
+                          if hasattr(self.formatter, name)])
+        return {
+            'include_id': uid_generator.include_id,
+            'page_ids': page_ids,
+            'counters': counters,
+            'formatter': formatter,
+            'current_lang': request.current_lang,
+        }
+
+    def _setRenderState(self, request, state):
+        uid_generator = request.uid_generator
+        uid_generator.include_id = state['include_id']
+        uid_generator.page_ids = dict([(namespace, ids.copy())
+                                       for namespace, ids in state['page_ids'].items()])
+        if state['counters'] is not None:
+            request._fmt_hd_counters = list(state['counters'])
+        for name, value in state['formatter'].items():
+            setattr(self.formatter, name, value)
+        request.current_lang = state['current_lang']
+
+    def _htmlCacheEntry(self, request, state):
+        """ Return the html cache entry of the page for the render state,
+        the language, theme and user settings the page html depends on """
+        page_ids = sorted([(namespace, sorted(ids.items()))
+                           for namespace, ids in state['page_ids'].items()])
+        key = repr((request.content_lang, state['current_lang'],
+                    request.theme.name, request.user.show_topbottom,
+                    request.getPragma('section-numbers'),
+                    state['include_id'], page_ids, state['counters'],
+                    sorted(state['formatter'].items())))
+        key = '%s.html.%s' % (self.getFormatterName(),
+                              hash_new('md5', key).hexdigest())
+        return caching.CacheEntry(request, self, key, scope='item',
+                                  use_pickle=True, use_memory=True)
+
+    def _isCacheCurrent(self, cache):
+        """ Is the cache entry newer than the page, its attachments, the
+        wiki code and the configuration, as checked by the cached code? """
+        attachmentsPath = self.getPagePath('attachments', check_create=0)
+        if cache.needsUpdate(self._text_filename(), attachmentsPath):
+            return False
+        mtime = cache.mtime()
+        moincode_timestamp = os.path.getmtime(os.path.dirname(__file__))
+        cfg_mtime = getattr(self.request.cfg, "cfg_mtime", None)
+        return not (moincode_timestamp > mtime or
+                    cfg_mtime is None or cfg_mtime > mtime)
+
+    def isStaticCode(self, code):
+        """ Does the cached code write the same html on each view?
+
+        The code of pages without macros, links or other dynamic parts
+        only writes html and calls formatter methods that depend on the
+        render state.
+        """
+        return set(code.co_names) <= STATIC_CODE_NAMES
+
+    def isStaticContent(self, request):
+        """ Is the content of the page the same on each view?
+
+        True only if this is known from the cached code of the page.
+        """
+        if not self.canUseCache():
+            return False
+        cache = caching.CacheEntry(request, self,
+                                   self.getFormatterName() + '.static',
+                                   scope='item')
+        return self._isCacheCurrent(cache)
+
+    def getHttpValidators(self, request):
+        """ Return the last modified time and the entity tag of views of
+        a page with static content """
+        cache = caching.CacheEntry(request, self,
+                                   self.getFormatterName() + '.static',
+                                   scope='item')
+        lastmod = cache.mtime()
+        etag = repr((self.page_name, self.get_real_rev(), lastmod,
+                     request.content_lang, request.current_lang,
+                     request.theme.name, request.user.show_topbottom))
+        return lastmod, hash_new('md5', etag.encode('utf-8')).hexdigest()
+
+    def _isNotModified(self, request, lastmod, etag):
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        if_modified = request.if_modified_since
+        return (if_modified is not None and
+                if_modified >= datetime.utcfromtimestamp(int(lastmod)))
+
     def loadCache(self, request):
         """ Return page content cache or raises 'CacheNeedsUpdate' """
         cache = caching.CacheEntry(request, self, self.getFormatterName(), scope='item')
@@ -1502,18 +1630,28 @@ class Page(object):
         from MoinMoin.formatter.text_python import Formatter
         formatter = Formatter(request, ["page"], self.formatter)
 
-        # Save request state while formatting page
-        saved_current_lang = request.current_lang
+        # Save request state while formatting page, the code is executed
+        # in the state the page started in
+        saved_state = self._getRenderState(request)
         try:
             text = request.redirectedOutput(parser.format, formatter)
         finally:
-            request.current_lang = saved_current_lang
+            self._setRenderState(request, saved_state)
 
         src = formatter.assemble_code(text)
         code = compile(src.encode(config.charset),
                        self.page_name.encode(config.charset), 'exec')
         cache = caching.CacheEntry(request, self, self.getFormatterName(), scope='item')
         cache.update(marshal.dumps(code))
+
+        # Mark pages with static content, see isStaticContent
+        cache = caching.CacheEntry(request, self,
+                                   self.getFormatterName() + '.static',
+                                   scope='item')
+        if self.isStaticCode(code):
+            cache.update('')
+        elif cache.exists():
+            cache.remove()
         return code
 
     def _specialPageText(self, request, special_type):
@@ -6,9 +6,13 @@
     @license: GNU GPL, see COPYING for details.
 """
 
+import os
+
 import py
 
+from MoinMoin import user
 from MoinMoin.Page import Page
+from MoinMoin._tests import become_trusted, create_page, nuke_page, wikiconfig
 
 class TestPage:
     def testMeta(self):
@@ -64,6 +68,115 @@ class TestPage:
         assert result.strip().endswith('</html>')
         assert result.strip().startswith('<!DOCTYPE HTML PUBLIC')
 
+class TestHtmlCache:
+    """ Page: html cache of pages with static content """
+    pagename = u'HtmlCacheTestPage'
+    static_text = u"= Heading =\nSome ''text''.\n== Heading ==\n * list\n"
+
+    class Config(wikiconfig.Config):
+        acl_rights_before = 'Trusted:read,write,delete,revert,admin'
+
+    def setup_class(self):
+        become_trusted(self.request)
+        # The page cache is only used with a configuration loaded from a file
+        self.cfg_mtime = self.request.cfg.cfg_mtime
+        self.request.cfg.cfg_mtime = 0
+
+    def teardown_class(self):
+        self.request.cfg.cfg_mtime = self.cfg_mtime
+        nuke_page(self.request, self.pagename)
+
+    def render(self):
+        self.request.reset()
+        page = Page(self.request, self.pagename)
+        html = self.request.redirectedOutput(page.send_page, content_only=1)
+        return page, html
+
+    def html_entries(self, page):
+        return [name for name in os.listdir(page.getPagePath('cache'))
+                if '.html.' in name]
+
+    def test_static(self):
+        create_page(self.request, self.pagename, self.static_text)
+        page, html = self.render()
+        assert page.isStaticContent(self.request)
+        assert len(self.html_entries(page)) == 1
+        page_ids = self.request.uid_generator.page_ids
+
+        # Served from the html cache, with the same ids taken
+        execute = Page.execute
+        Page.execute = None
+        try:
+            assert self.render()[1] == html
+        finally:
+            Page.execute = execute
+        assert self.request.uid_generator.page_ids == page_ids
+        assert u'Heading-1"' in html
+
+        # Not for a new revision
+        create_page(self.request, self.pagename, self.static_text + u"More")
+        page, html = self.render()
+        assert u'More' in html
+
+    def test_dynamic(self):
+        create_page(self.request, self.pagename, u"FrontPage <<Date>>")
+        page, html = self.render()
+        assert not page.isStaticContent(self.request)
+        assert self.html_entries(page) == []
+
+    def test_not_modified(self):
+        create_page(self.request, self.pagename, self.static_text)
+        page, html = self.render()
+        lastmod, etag = page.getHttpValidators(self.request)
+
+
+        request = self.request
+        saved = request.user, request.cacheable, request.status_code
+        request.environ['HTTP_IF_NONE_MATCH'] = '"%s"' % etag
+        try:
+            assert page._isNotModified(request, lastmod, etag)
+            assert not page._isNotModified(request, lastmod, etag + 'x')
+
+            # Anonymous views of the page
+            request.user = user.User(request)
+            request.cacheable = 1
+            request.reset()
+            page = Page(request, self.pagename)
+            assert request.redirectedOutput(page.send_page) == ''
+            assert request.status_code == 304
+            assert request.headers['ETag'] == '"%s"' % etag
+        finally:
+            del request.environ['HTTP_IF_NONE_MATCH']
+            request.user, request.cacheable, request.status_code = saved
+
+    def test_not_modified_forbidden(self):
+        create_page(self.request, self.pagename,
+                    u"#acl All:\n" +
+                    self.static_text)
+        page, html = self.render()
+        assert page.isStaticContent(self.request)
+        lastmod, etag = page.getHttpValidators(self.request)
+
+        request = self.request
+        saved = request.user, request.cacheable, request.status_code
+        request.request.__dict__.pop('if_none_match', None)
+        request.environ['HTTP_IF_NONE_MATCH'] = '"%s"' % etag
+        try:
+            # The user may not read the page anymore, no 304 for the
+            # copy the client has
+            request.user = user.User(request)
+            request.cacheable = 1
+            request.reset()
+            request.headers.clear()
+            page = Page(request, self.pagename)
+            request.redirectedOutput(page.send_page)
+            assert request.status_code == 403
+            assert 'ETag' not in request.headers
+        finally:
+            del request.environ['HTTP_IF_NONE_MATCH']
+            request.request.__dict__.pop('if_none_match', None)
+            request.user, request.cacheable, request.status_code = saved
+
 class TestRootPage:
     def testPageList(self):
         rootpage = self.request.rootpage
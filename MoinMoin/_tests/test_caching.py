@@ -8,10 +8,12 @@
 
 import py
 
+import os
 import time
 
 from MoinMoin import caching
 from MoinMoin.PageEditor import PageEditor
+from MoinMoin.util import pickle, PICKLE_PROTOCOL
 
 
 class TestCaching(object):
@@ -95,5 +97,49 @@ class TestCaching(object):
 
         assert data == rdata
 
+    def test_memory(self):
+        """ test if content is kept in memory until the file changes """
+        test_data = {1: [2, 3]}
+        cache = caching.CacheEntry(self.request, 'test_arena', 'test_memory', 'wiki',
+                                   use_pickle=True, use_memory=True)
+        cache.update(test_data)
+        arena_dir = cache.arena_dir
+        caching.clear_memory()
+
+        data = cache.content()
+        assert data == test_data
+        cache = caching.CacheEntry(self.request, 'test_arena', 'test_memory', 'wiki',
+                                   use_pickle=True, use_memory=True)
+        assert cache.content() is data
+        assert caching.get_memory_stats()[arena_dir] == (1, 1)
+
+        # updated by this process
+        cache.update({4: 5})
+        assert cache.content() == {4: 5}
+        assert caching.get_memory_stats()[arena_dir] == (1, 2)
+
+        # updated by another process, without us knowing
+        fname = os.path.join(arena_dir, 'test_memory')
+        f = open(fname + '.new', 'wb')
+        f.write(pickle.dumps({6: 7}, PICKLE_PROTOCOL))
+        f.close()
+        os.rename(fname + '.new', fname)
+        assert cache.content() == {6: 7}
+
+        # no memory for removed entries
+        cache.remove()
+        py.test.raises(caching.CacheError, cache.content)
+
+    def test_memory_flavour(self):
+        """ test if entries of other flavours do not get the kept object """
+        cache = caching.CacheEntry(self.request, 'test_arena', 'test_flavour', 'wiki',
+                                   use_pickle=True, use_memory=True)
+        cache.update([1, 2])
+        assert cache.content() == [1, 2]
+        raw = caching.CacheEntry(self.request, 'test_arena', 'test_flavour', 'wiki',
+                                 use_memory=True)
+        assert isinstance(raw.content(), str)
+        cache.remove()
+
 coverage_modules = ['MoinMoin.caching']
 
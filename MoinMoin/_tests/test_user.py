@@ -307,6 +307,79 @@ class TestLoginWithPassword(object):
             py.test.skip("Can't create test user")
 
 
+class TestSubscriptionIndex(object):
+    """user: page subscription index tests"""
+
+    def testNames(self):
+        """ user: subscriptions to page names """
+        index = user.SubscriptionIndex()
+        index.add('1', u'A', 'a@example.org', [u'FrontPage', u'C++'])
+        index.add('2', u'B', 'b@example.org', [u'FrontPage'])
+        assert index.subscribers([u'FrontPage']) == set(['1', '2'])
+        assert index.subscribers([u'C++']) == set(['1'])
+        assert index.subscribers([u'FrontPage/SubPage']) == set()
+
+        index.remove('1')
+        assert index.subscribers([u'FrontPage']) == set(['2'])
+        assert index.subscribers([u'C++']) == set()
+        assert index.content['patterns'] == {}
+
+    def testPatterns(self):
+        """ user: subscriptions to page name patterns """
+        index = user.SubscriptionIndex()
+        index.add('1', u'A', '', [u'Help.*'])
+        index.add('2', u'B', '', [u'(Front|Back)Page'])
+        index.add('3', u'C', '', [u'(?i)frontpage', u'[BadPattern'])
+        index.add('4', u'D', '', [u'Wiki:Front.*'])
+
+        assert index.subscribers([u'HelpContents']) == set(['1'])
+        assert index.subscribers([u'FrontPage']) == set(['2', '3'])
+        assert index.subscribers([u'NoHelp']) == set()
+        assert index.subscribers([u'[BadPattern']) == set(['3'])
+        assert index.subscribers([u'SomePage', u'CategoryHelp',
+                                  u'Wiki:FrontPage']) == set(['4'])
+
+        # Changing subscriptions replaces the earlier ones
+        index.add('1', u'A', '', [u'.*'])
+        assert index.subscribers([u'HelpContents']) == set(['1'])
+        assert index.subscribers([u'NoHelp']) == set(['1'])
+
+    def testGetSubscribers(self):
+        """ user: getSubscribers uses the stored subscription index """
+        from MoinMoin.Page import Page
+        name = u'__Subscription Index User__'
+        self.user = user.User(self.request)
+        self.user.name = name
+        self.user.email = '__subscription_index__@moinhost'
+        if self.user.exists():
+            self.user = None
+            py.test.skip("Test user exists, will not override existing user data file!")
+
+        try:
+            self.user.subscribed_pages = [u'FrontPage']
+            self.user.save()
+
+            index = user.loadSubscriptionIndex(self.request)
+            assert self.user.id in index.subscribers([u'FrontPage'])
+            # loaded from memory as long as the index is not changed
+            assert user.loadSubscriptionIndex(self.request) is index
+
+            subscribers = Page(self.request, u'FrontPage').getSubscribers(
+                self.request, include_self=1)
+            assert self.user.email in sum(subscribers.values(), [])
+
+            # profile changes update the index
+            self.user.subscribed_pages = [u'Help.*']
+            self.user.save()
+            index = user.loadSubscriptionIndex(self.request)
+            assert self.user.id not in index.subscribers([u'FrontPage'])
+            assert self.user.id in index.subscribers([u'HelpContents'])
+        finally:
+            os.remove(self.user._User__filename())
+            user.clearLookupCaches(self.request)
+            user.rebuildSubscriptionIndex(self.request)
+
+
 class TestGroupName(object):
 
     def testGroupNames(self):
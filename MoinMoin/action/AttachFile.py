@@ -31,7 +31,8 @@
 import os, time, zipfile, errno, datetime
 from StringIO import StringIO
 
-from werkzeug import http_date
+from werkzeug import http_date, quote_etag
+from werkzeug.http import parse_range_header, parse_if_range_header
 
 from MoinMoin import log
 logging = log.getLogger(__name__)
@@ -1054,6 +1055,178 @@ def _do_box(pagename, request):
         request.send_file(ci.get(filename))
 
 
+# Requests for more byte ranges than this get the whole file
+MAX_RANGES = 16
+
+
+class RangeFile(object):
+    """ File-like object reading byte ranges of a file, each after a
+    header, for request.send_file.
+
+    It has no fileno, so the ranges are read even where the
+    wsgi.file_wrapper of the server would send whole files with sendfile.
+    """
+
+    def __init__(self, fileobj, parts, trailer=''):
+        """
+        @param fileobj: the file to read from
+        @param parts: list of (header, start, stop) of the ranges, the
+                      stop positions are not included
+        @param trailer: read after the last range
+        """
+        self.fileobj = fileobj
+        # (text, None, None) or (None, start, stop)
+        self.segments = []
+        for header, start, stop in parts:
+            if header:
+                self.segments.append((header, None, None))
+            self.segments.append((None, start, stop))
+        if trailer:
+            self.segments.append((trailer, None, None))
+
+    def read(self, size=-1):
+        chunks = []
+        while self.segments and size:
+            text, start, stop = self.segments[0]
+            if text is not None:
+                chunk = text
+                if 0 < size < len(text):
+                    chunk = text[:size]
+                    self.segments[0] = (text[size:], None, None)
+                else:
+                    del self.segments[0]
+            else:
+                count = max(stop - start, 0)
+                if size > 0:
+                    count = min(count, size)
+                self.fileobj.seek(start)
+                chunk = self.fileobj.read(count)
+                start += len(chunk)
+                if chunk and start < stop:
+                    self.segments[0] = (None, start, stop)
+                else:
+                    # done, or the file was shorter than expected
+                    del self.segments[0]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def file_etag(st):
+    """ Return a strong entity tag for the file with the os.stat result st,
+    from the identity of the file, its size and modification time. """
+    return '%x-%x-%x' % (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+
+def get_byte_ranges(request, length, etag, timestamp):
+    """ Return the byte ranges of a file of length bytes requested, as a
+    list of (start, stop) tuples, an empty list if none of them are
+    satisfiable, or None for the whole file.
+
+    @param etag: entity tag of the file
+    @param timestamp: modification time of the file, as UTC datetime
+    """
+    try:
+        ranges = parse_range_header(request.environ.get('HTTP_RANGE'))
+    except ValueError:
+        ranges = None
+    if ranges is None or ranges.units != 'bytes' or len(ranges.ranges) > MAX_RANGES:
+        return None
+
+    # Only ranges of the file the client has, else the whole file
+    if_range = parse_if_range_header(request.environ.get('HTTP_IF_RANGE'))
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != timestamp:
+        return None
+
+    result = []
+    for start, stop in ranges.ranges:
+        if stop is None:
+            if start < 0:
+                start = max(length + start, 0)
+            stop = length
+        stop = min(stop, length)
+        if start < stop:
+            result.append((start, stop))
+    return result
+
+
+def send_attachment(request, fpath, content_type, content_dispo=None):
+    """ Send the file fpath, or the byte ranges of it requested.
+
+    Answers conditional requests with 304 (If-None-Match, If-Modified-Since)
+    and range requests (Range, If-Range) with 206, or 416 if none of the
+    ranges requested are in the file.
+    """
+    st = os.stat(fpath)
+    etag = file_etag(st)
+    timestamp = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+
+    request.headers['Last-Modified'] = http_date(st.st_mtime)
+    request.headers['ETag'] = quote_etag(etag)
+    request.headers['Accept-Ranges'] = 'bytes'
+    # Caches may keep the file, but have to check if it is still current
+    if request.user.valid:
+        request.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    else:
+        request.headers['Cache-Control'] = 'max-age=0, must-revalidate'
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        if_modified = request.if_modified_since
+        not_modified = if_modified is not None and if_modified >= timestamp
+    if not_modified:
+        request.status_code = 304
+        return
+
+    if content_dispo:
+        request.headers['Content-Disposition'] = content_dispo
+
+    length = st.st_size
+    ranges = get_byte_ranges(request, length, etag, timestamp)
+    if ranges == []:
+        request.status_code = 416
+        request.headers['Content-Range'] = 'bytes */%d' % length
+        return
+
+    fileobj = open(fpath, 'rb')
+    if ranges is None:
+        request.headers['Content-Type'] = content_type
+        request.headers['Content-Length'] = str(length)
+        request.send_file(fileobj)
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        request.status_code = 206
+        request.headers['Content-Type'] = content_type
+        request.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+        request.headers['Content-Length'] = str(stop - start)
+        if stop == length:
+            # up to the end, the server may send the file as it is
+            fileobj.seek(start)
+            request.send_file(fileobj)
+        else:
+            request.send_file(RangeFile(fileobj, [('', start, stop)]))
+    else:
+        boundary = os.urandom(16).encode('hex')
+        parts = []
+        for start, stop in ranges:
+            header = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                     boundary, content_type, start, stop - 1, length)
+            parts.append((header, start, stop))
+        trailer = '\r\n--%s--\r\n' % boundary
+
+        request.status_code = 206
+        request.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        request.headers['Content-Length'] = str(sum([len(header) + stop - start
+                                                     for header, start, stop in parts]) + len(trailer))
+        request.send_file(RangeFile(fileobj, parts, trailer))
+
+
 def _do_get(pagename, request):
     _ = request.getText
 
@@ -1064,36 +1237,25 @@ def _do_get(pagename, request):
         request.status_code = 404
         return # error msg already sent in _access_file
 
-    timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(fpath))
-    if_modified = request.if_modified_since
-    if if_modified and if_modified >= timestamp:
-        request.status_code = 304
-    else:
-        mt = wikiutil.MimeType(filename=filename)
-        content_type = mt.content_type()
-        mime_type = mt.mime_type()
+    mt = wikiutil.MimeType(filename=filename)
+    content_type = mt.content_type()
+    mime_type = mt.mime_type()
 
-        # TODO: fix the encoding here, plain 8 bit is not allowed according to the RFCs
-        # There is no solution that is compatible to IE except stripping non-ascii chars
-        filename_enc = filename.encode(config.charset)
+    # TODO: fix the encoding here, plain 8 bit is not allowed according to the RFCs
+    # There is no solution that is compatible to IE except stripping non-ascii chars
+    filename_enc = filename.encode(config.charset)
 
-        # for dangerous files (like .html), when we are in danger of cross-site-scripting attacks,
-        # we just let the user store them to disk ('attachment').
-        # For safe files, we directly show them inline (this also works better for IE).
-        dangerous = mime_type in request.cfg.mimetypes_xss_protect
-        content_dispo = dangerous and 'attachment' or 'inline'
+    # for dangerous files (like .html), when we are in danger of cross-site-scripting attacks,
+    # we just let the user store them to disk ('attachment').
+    # For safe files, we directly show them inline (this also works better for IE).
+    dangerous = mime_type in request.cfg.mimetypes_xss_protect
+    content_dispo = dangerous and 'attachment' or 'inline'
 
-        now = time.time()
-        request.headers['Date'] = http_date(now)
-        request.headers['Content-Type'] = content_type
-        request.headers['Last-Modified'] = http_date(timestamp)
-        request.headers['Expires'] = http_date(now - 365 * 24 * 3600)
-        request.headers['Content-Length'] = os.path.getsize(fpath)
-        content_dispo_string = '%s; filename="%s"' % (content_dispo, filename_enc)
-        request.headers['Content-Disposition'] = content_dispo_string
+    request.headers['Date'] = http_date(time.time())
+    content_dispo_string = '%s; filename="%s"' % (content_dispo, filename_enc)
 
-        # send data
-        request.send_file(open(fpath, 'rb'))
+    # send data
+    send_attachment(request, fpath, content_type, content_dispo_string)
 
 
 def _do_install(pagename, request):
@@ -8,6 +8,7 @@
 """
 import os, StringIO
 from MoinMoin.action import AttachFile
+from MoinMoin.web.request import MoinMoinFinish
 from MoinMoin.PageEditor import PageEditor
 from MoinMoin._tests import become_trusted, create_page, nuke_page
 
@@ -66,4 +67,91 @@ class TestAttachFile:
 
         assert file_exists
 
+class TestSendAttachment:
+    """ AttachFile: conditional and range requests of attachments """
+    pagename = u"AutoCreatedSillyPageToTestAttachments"
+    filename = "AutoCreatedSillyAttachment.bin"
+    data = ''.join([chr(i) for i in range(256)]) * 4
+
+    def setup_class(self):
+        become_trusted(self.request)
+        create_page(self.request, self.pagename, u"Foo!")
+        AttachFile.add_attachment(self.request, self.pagename, self.filename, self.data, True)
+        self.fpath = AttachFile.getFilename(self.request, self.pagename, self.filename)
+
+    def teardown_class(self):
+        nuke_page(self.request, self.pagename)
+
+    def send(self, **headers):
+        request = self.request
+        # headers of the request are parsed once
+        for name in ['if_none_match', 'if_modified_since']:
+            request.request.__dict__.pop(name, None)
+        names = ['HTTP_' + name.upper() for name in headers]
+        for name, value in zip(names, headers.values()):
+            request.environ[name] = value
+        request.status_code = 200
+        request.headers.clear()
+        request.request.response = []
+        try:
+            try:
+                AttachFile.send_attachment(request, self.fpath, 'application/octet-stream')
+            except MoinMoinFinish:
+                pass
+            body = ''.join(request.request.response)
+        finally:
+            for name in names:
+                del request.environ[name]
+        return request.status_code, request.headers, body
+
+    def test_whole(self):
+        status, headers, body = self.send()
+        assert status == 200
+        assert body == self.data
+        assert headers['Accept-Ranges'] == 'bytes'
+
+        etag = headers['ETag']
+        assert self.send(if_none_match=etag)[0] == 304
+        assert self.send(if_none_match='"other"')[0] == 200
+        assert self.send(if_modified_since=headers['Last-Modified'])[0] == 304
+
+    def test_range(self):
+        status, headers, body = self.send(range='bytes=10-19')
+        assert status == 206
+        assert body == self.data[10:20]
+        assert headers['Content-Range'] == 'bytes 10-19/1024'
+        assert headers['Content-Length'] == '10'
+
+        # up to the end
+        status, headers, body = self.send(range='bytes=-100')
+        assert (status, body) == (206, self.data[-100:])
+        status, headers, body = self.send(range='bytes=1000-2000')
+        assert (status, body) == (206, self.data[1000:])
+
+        assert self.send(range='bytes=2000-')[0] == 416
+        assert self.send(range='bytes=a-b')[0] == 200
+        assert self.send(range='bytes=0-9', if_range='"other"')[0] == 200
+
+        etag = self.send()[1]['ETag']
+        assert self.send(range='bytes=0-9', if_range=etag)[0] == 206
+
+    def test_multiple_ranges(self):
+        status, headers, body = self.send(range='bytes=0-9,100-109')
+        assert status == 206
+        assert headers['Content-Type'].startswith('multipart/byteranges; boundary=')
+        assert len(body) == int(headers['Content-Length'])
+        boundary = headers['Content-Type'].split('=', 1)[1]
+        parts = body.split('\r\n--%s' % boundary)
+        assert parts[0] == '' and parts[-1] == '--\r\n'
+        assert parts[1].endswith('Content-Range: bytes 0-9/1024\r\n\r\n' + self.data[0:10])
+        assert parts[2].endswith('Content-Range: bytes 100-109/1024\r\n\r\n' + self.data[100:110])
+
+    def test_range_file(self):
+        f = StringIO.StringIO(self.data)
+        rf = AttachFile.RangeFile(f, [('ab', 0, 3), ('', 1020, 2000)], 'end')
+        assert rf.read(1) == 'a'
+        assert rf.read(3) == 'b' + self.data[:2]
+        assert rf.read() == self.data[2:3] + self.data[1020:] + 'end'
+        assert rf.read() == ''
+
 coverage_modules = ['MoinMoin.action.AttachFile']
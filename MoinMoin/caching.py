@@ -17,6 +17,15 @@ logging = log.getLogger(__name__)
 
 from MoinMoin import config
 from MoinMoin.util import filesys, lock, pickle, PICKLE_PROTOCOL
+from MoinMoin.util.lru import LRUCache
+
+# Number of entries kept in the memory of the process by entries created
+# with use_memory=True, see CacheEntry.content
+MEMORY_CACHE_SIZE = 256
+
+_memory = LRUCache(MEMORY_CACHE_SIZE)
+# arena dir -> [hits, misses]
+_memory_stats = {}
 
 
 class CacheError(Exception):
@@ -40,6 +49,18 @@ def get_arena_dir(request, arena, scope):
     return None
 
 
+def get_memory_stats():
+    """ Return a dict of arena dir -> (hits, misses) of the memory tier """
+    return dict([(arena_dir, tuple(counts))
+                 for arena_dir, counts in _memory_stats.items()])
+
+
+def clear_memory():
+    """ Drop all the entries and counters of the memory tier """
+    _memory.clear()
+    _memory_stats.clear()
+
+
 def get_cache_list(request, arena, scope):
     arena_dir = get_arena_dir(request, arena, scope)
     try:
@@ -50,7 +71,7 @@ def get_cache_list(request, arena, scope):
 
 class CacheEntry:
     def __init__(self, request, arena, key, scope='wiki', do_locking=True,
-                 use_pickle=False, use_encode=False):
+                 use_pickle=False, use_encode=False, use_memory=False):
         """ init a cache entry
             @param request: the request object
             @param arena: either a string or a page object, when we want to use
@@ -64,12 +85,16 @@ class CacheEntry:
             @param do_locking: if there should be a lock, normally True
             @param use_pickle: if data should be pickled/unpickled (nice for arbitrary cache content)
             @param use_encode: if data should be encoded/decoded (nice for readable cache files)
+            @param use_memory: if content() should keep the data in the memory of
+                               the process, too. The same object is then returned
+                               to all callers, so it must not be modified.
         """
         self.request = request
         self.key = key
         self.locking = do_locking
         self.use_pickle = use_pickle
         self.use_encode = use_encode
+        self.use_memory = use_memory
         self.arena_dir = get_arena_dir(request, arena, scope)
         if not os.path.exists(self.arena_dir):
             os.makedirs(self.arena_dir)
@@ -239,6 +264,7 @@ class CacheEntry:
                     filesys.chmod(self._tmp_fname, 0666 & config.umask) # fix mode that mkstemp chose
                     # this is either atomic or happening with real locks set:
                     filesys.rename(self._tmp_fname, self._fname)
+                    _memory.pop((self.arena_dir, self.key))
         finally:
             if self.locking:
                 self.unlock()
@@ -272,6 +298,32 @@ class CacheEntry:
 
     def content(self):
         # no file-like api yet, we implement it when we need it
+        if self.use_memory:
+            return self._memory_content()
+        return self._content()
+
+    def _memory_content(self):
+        """ Return the data kept in memory if the file was not changed since,
+        by this or by any other process. Else read it and keep it.
+        """
+        memkey = (self.arena_dir, self.key)
+        flavour = (self.use_pickle, self.use_encode)
+        counts = _memory_stats.setdefault(self.arena_dir, [0, 0])
+        # taken before reading, so a concurrent update is noticed next time
+        uid = self.uid()
+        if uid is not None:
+            entry = _memory.get(memkey)
+            if entry is not None and entry[:2] == (uid, flavour):
+                counts[0] += 1
+                return entry[2]
+        counts[1] += 1
+
+        data = self._content()
+        if uid is not None:
+            _memory[memkey] = (uid, flavour, data)
+        return data
+
+    def _content(self):
         try:
             try:
                 self.open(mode='r')
@@ -294,6 +346,7 @@ class CacheEntry:
                 os.remove(self._fname)
             except OSError:
                 pass
+            _memory.pop((self.arena_dir, self.key))
         finally:
             if self.locking:
                 self.unlock()
@@ -26,7 +26,8 @@ from MoinMoin.events import PageDeletedEvent, PageCopiedEvent
 from MoinMoin.events import PageRevertedEvent, FileAttachedEvent
 import MoinMoin.web.session
 from MoinMoin.packages import packLine
-from MoinMoin.security import AccessControlList
+from MoinMoin.security import AccessControlList, ACL_STRINGS_CACHE_SIZE
+from MoinMoin.util.lru import LRUCache
 from MoinMoin.support.python_compatibility import set
 
 _url_re_cache = None
@@ -386,6 +387,7 @@ class ConfigFunctionality(object):
         self.cache.acl_rights_before = AccessControlList(self, [self.acl_rights_before])
         self.cache.acl_rights_default = AccessControlList(self, [self.acl_rights_default])
         self.cache.acl_rights_after = AccessControlList(self, [self.acl_rights_after])
+        self.cache.acl_strings = LRUCache(ACL_STRINGS_CACHE_SIZE)
 
         action_prefix = self.url_prefix_action
         if action_prefix is not None and action_prefix.endswith('/'): # make sure there is no trailing '/'
@@ -1211,6 +1213,16 @@ options = {
        "Valid tokens for right sides of ACL entries."),
     )),
 
+    'event_queue': ('Event queue',
+    'Events can be handled after the request that sent them, see MoinMoin.events.eventqueue.',
+    (
+      ('handlers', [],
+       "Names of the event handler plugins that get their events through the event queue, e.g. ['emailnotify', 'jabbernotify', 'xapian_index'] (default: none, events are handled by the request that sends them)."),
+      ('workers', 1, "Number of threads of each wiki process that deliver queued events (0 = delivered by 'moin maint eventqueue' only)."),
+      ('retries', 5, "Number of times a handler gets an event it failed to handle, before the event is dropped for it."),
+      ('retry_delay', 60, "Time [s] until a handler gets an event it failed to handle again, doubled for each retry."),
+    )),
+
     'xapian': ('Xapian search', "Configuration of the Xapian based indexed search, see HelpOnXapian.", (
       ('search', False,
        "True to enable the fast, indexed search (based on the Xapian search library)"),
@@ -39,7 +39,8 @@ class WikiDict(BaseDict):
         if page.exists():
             arena = 'pagedicts'
             key = wikiutil.quoteWikinameFS(dict_name)
-            cache = caching.CacheEntry(request, arena, key, scope='wiki', use_pickle=True)
+            cache = caching.CacheEntry(request, arena, key, scope='wiki',
+                                         use_pickle=True, use_memory=True)
             try:
                 cache_mtime = cache.mtime()
                 page_mtime = wikiutil.version2timestamp(page.mtime_usecs())
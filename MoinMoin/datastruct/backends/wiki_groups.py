@@ -35,7 +35,8 @@ class WikiGroup(GreedyGroup):
         if page.exists():
             arena = 'pagegroups'
             key = wikiutil.quoteWikinameFS(group_name)
-            cache = caching.CacheEntry(request, arena, key, scope='wiki', use_pickle=True)
+            cache = caching.CacheEntry(request, arena, key, scope='wiki',
+                                         use_pickle=True, use_memory=True)
             try:
                 cache_mtime = cache.mtime()
                 page_mtime = wikiutil.version2timestamp(page.mtime_usecs())
@@ -30,6 +30,9 @@ class Event(object):
 
     # NOTE: each Event subclass must have a unique name attribute
     name = u"Event"
+    # if the event can be handled after the request that sent it,
+    # see MoinMoin.events.eventqueue
+    queueable = True
 
     def __init__(self, request):
         self.request = request
@@ -199,6 +202,8 @@ class PagePreSaveEvent(Event):
     """
 
     name = u"PagePreSaveEvent"
+    # handlers can abort the save
+    queueable = False
 
     def __init__(self, request, page_editor, new_text):
         Event.__init__(self, request)
@@ -246,16 +251,23 @@ def get_handlers(cfg):
 def send_event(event):
     """Function called from outside to process an event
 
+    Handlers configured in cfg.event_queue_handlers get the event later,
+    through the event queue.
+
     @return: a list of messages returned by handlers
     @rtype: list
     """
+    from MoinMoin.events import eventqueue
 
     # A list of messages generated by event handlers, passed back to caller
     msg = []
     cfg = event.request.cfg
+    queued = eventqueue.enqueue(event)
 
     # Try to handle the event with each available handler (for now)
     for handle in cfg.event_handlers:
+        if handle in queued:
+            continue
         retval = handle(event)
 
         assert retval is None or isinstance(retval, EventResult)
@@ -0,0 +1,146 @@
+# -*- coding: iso-8859-1 -*-
+"""
+    MoinMoin - tests for MoinMoin.events.eventqueue
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import os
+import shutil
+import tempfile
+
+import py
+
+import MoinMoin.events as events
+import MoinMoin.events.notification as notification
+from MoinMoin.events import emailnotify, eventqueue
+from MoinMoin._tests import append_page, become_trusted, create_page, nuke_page
+from MoinMoin.PageEditor import PageEditor
+
+
+class TestEventQueue(object):
+    """ eventqueue: queueing and delivering events """
+
+    from MoinMoin._tests import wikiconfig
+    class Config(wikiconfig.Config):
+        event_queue_handlers = ['xapian_index']
+        event_queue_workers = 0
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.queue = eventqueue.EventQueue(os.path.join(self.tempdir, 'queue'),
+                                           retries=3, retry_delay=60)
+        self.handled = []
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tempdir)
+
+    def make_request(self, data):
+        return self.request
+
+    def handle(self, event):
+        self.handled.append(event)
+
+    def fail(self, event):
+        self.handled.append(event)
+        return notification.Failure(u"No mail server")
+
+    def test_dump_event(self):
+        page = PageEditor(self.request, u'EventQueuePage', uid_override=u'Someone')
+        event = events.PageRenamedEvent(self.request, page, PageEditor(self.request, u'OldName'), u'Moved')
+        data = eventqueue.dump_event(event)
+
+        event = eventqueue.load_event(self.request, data)
+        assert isinstance(event, events.PageRenamedEvent)
+        assert isinstance(event.page, PageEditor)
+        assert event.page.page_name == u'EventQueuePage'
+        assert event.page.uid_override == u'Someone'
+        assert event.old_page.page_name == u'OldName'
+        assert event.comment == u'Moved'
+
+        event = events.PagePreSaveEvent(self.request, page, u'Text')
+        py.test.raises(eventqueue.EventQueueError, eventqueue.dump_event, event)
+
+    def test_queued_revisions(self):
+        """ eventqueue: queued page events keep the revisions of the change """
+        pagename = u'EventQueueRevisionsPage'
+        become_trusted(self.request)
+        create_page(self.request, pagename, u'First text\n')
+        page = append_page(self.request, pagename, u'Second text')
+        try:
+            data = eventqueue.dump_event(events.PageChangedEvent(self.request, page, u''))
+            append_page(self.request, pagename, u'Third text')
+
+            event = eventqueue.load_event(self.request, data)
+            assert event.revisions == [2, 1]
+            mail = emailnotify.prep_page_changed_mail(self.request, event.page, u'', 'en',
+                                                      event.revisions)
+            assert u'+ Second text' in mail['text']
+            assert u'Third text' not in mail['text']
+        finally:
+            nuke_page(self.request, pagename)
+
+    def test_send_event(self):
+        """ eventqueue: the queued handlers are skipped by send_event """
+        queue = eventqueue.get_queue(self.request)
+        names = queue.names()
+        page = PageEditor(self.request, u'EventQueuePage')
+        event = events.PageChangedEvent(self.request, page, u'')
+        handlers = eventqueue.get_queued_handlers(self.request.cfg).values()
+        assert handlers
+
+        old_handlers = self.request.cfg.event_handlers
+        self.request.cfg.event_handlers = handlers + [self.handle]
+        try:
+            events.send_event(event)
+        finally:
+            self.request.cfg.event_handlers = old_handlers
+        assert self.handled == [event]
+
+        new = [name for name in queue.names() if name not in names]
+        assert len(new) == 1
+        workname = queue.claim(new[0])
+        queue.deliver(workname, make_request=self.make_request)
+        assert new[0] not in queue.names()
+
+    def test_retry(self):
+        page = PageEditor(self.request, u'EventQueuePage')
+        data = eventqueue.dump_event(events.PageChangedEvent(self.request, page, u''))
+        self.queue.put(data, ['ok', 'fail'])
+
+        old_get_queued_handlers = eventqueue.get_queued_handlers
+        eventqueue.get_queued_handlers = lambda cfg: {'ok': self.handle, 'fail': self.fail}
+        try:
+            now = 1000000
+            assert self.queue.process(now, self.make_request) == 1
+            assert len(self.handled) == 2
+            # only the failed handler is retried, after a delay
+            data = self.queue.load(self.queue.names()[0])
+            assert data['pending'] == {'fail': (1, now + 60)}
+            assert self.queue.process(now + 59, self.make_request) == 0
+            assert self.queue.process(now + 60, self.make_request) == 1
+            assert len(self.handled) == 3
+            data = self.queue.load(self.queue.names()[0])
+            assert data['pending'] == {'fail': (2, now + 180)}
+
+            # dropped after the last retry
+            assert self.queue.process(now + 180, self.make_request) == 1
+            assert len(self.handled) == 4
+            assert self.queue.names() == []
+        finally:
+            eventqueue.get_queued_handlers = old_get_queued_handlers
+
+    def test_recover(self):
+        page = PageEditor(self.request, u'EventQueuePage')
+        data = eventqueue.dump_event(events.PageChangedEvent(self.request, page, u''))
+        name = self.queue.put(data, ['ok'])
+        assert self.queue.claim(name)
+        assert self.queue.claim(name) is None
+        assert self.queue.names() == []
+
+        self.queue.recover()
+        assert self.queue.names() == []
+        self.queue.recover(now=os.path.getmtime(self.queue.path) + eventqueue.CLAIM_TIMEOUT + 1)
+        assert self.queue.names() == [name]
+
+coverage_modules = ['MoinMoin.events.eventqueue']
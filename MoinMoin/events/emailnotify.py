@@ -110,8 +110,11 @@ def handle_page_changed(event):
     if subscribers:
         recipients = set()
 
-        # get a list of old revisions, and append a diff
-        revisions = page.getRevList()
+        # get a list of old revisions, and append a diff, those of
+        # the change if the event was queued
+        revisions = getattr(event, 'revisions', None)
+        if revisions is None:
+            revisions = page.getRevList()
 
         # send email to all subscribers
         for lang in subscribers:
@@ -0,0 +1,405 @@
+# -*- coding: iso-8859-1 -*-
+"""
+    MoinMoin - durable queue of events for slow event handlers
+
+    Events for the handlers named in cfg.event_queue_handlers are not
+    handled by the request sending them, but stored in a queue on disk and
+    delivered to those handlers by worker threads of the wiki processes or
+    by "moin maint eventqueue". Sending the event then only costs writing
+    a small file, no matter how slow the mail server or the jabber bot is.
+
+    Each event is a file in <data_dir>/event-queue with the event data and
+    the handlers it still has to be delivered to, named after the time it
+    is due. A handler that raises or returns a notification.Failure gets
+    the event again later, with the delay doubled for each retry, until it
+    was tried cfg.event_queue_retries times. Queued events are handled in
+    a new request for the URL and user of the request that sent them, with
+    the current state of the wiki at that time. Only the revisions of the
+    page of a page event are those it had when the event was queued, in
+    the revisions attribute of the event (newest first), so the mail of a
+    delayed notification still shows the change it is about.
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import os
+import time
+import errno
+import tempfile
+import threading
+
+from MoinMoin import log
+logging = log.getLogger(__name__)
+
+from MoinMoin import config, events, wikiutil
+from MoinMoin.events import notification
+from MoinMoin.util import filesys, pickle, PICKLE_PROTOCOL
+from MoinMoin.wikiutil import PluginAttributeError
+
+# Seconds after which an event claimed by a worker that did not finish
+# with it is delivered again
+CLAIM_TIMEOUT = 3600
+# Seconds workers wait for new events before checking for due retries
+POLL_INTERVAL = 30
+
+
+class EventQueueError(Exception):
+    """ raised for events that can not be queued """
+
+
+def get_queued_handlers(cfg):
+    """ Return a dict of name -> handler of the handlers that get their
+    events through the queue """
+    handlers = {}
+    for name in cfg.event_queue_handlers:
+        try:
+            handlers[name] = wikiutil.importPlugin(cfg, "events", name, "handle")
+        except PluginAttributeError:
+            pass
+    return handlers
+
+
+def _dump_value(value):
+    from MoinMoin.Page import Page
+    from MoinMoin.PageEditor import PageEditor
+    from MoinMoin.user import User
+
+    if isinstance(value, PageEditor):
+        return ('pageeditor', value.page_name, value.uid_override)
+    elif isinstance(value, Page):
+        return ('page', value.page_name)
+    elif isinstance(value, User):
+        return ('user', value.id)
+    return ('value', value)
+
+
+def _load_value(request, value):
+    from MoinMoin.Page import Page
+    from MoinMoin.PageEditor import PageEditor
+    from MoinMoin.user import User
+
+    kind = value[0]
+    if kind == 'pageeditor':
+        return PageEditor(request, value[1], uid_override=value[2])
+    elif kind == 'page':
+        return Page(request, value[1])
+    elif kind == 'user':
+        return User(request, value[1])
+    return value[1]
+
+
+def dump_event(event):
+    """ Return the data of an event as a dict that can be pickled """
+    if not event.queueable:
+        raise EventQueueError("%s can not be queued" % event.__class__.__name__)
+
+    request = event.request
+    attrs = {}
+    for name, value in event.__dict__.items():
+        if name != 'request':
+            attrs[name] = _dump_value(value)
+    page = getattr(event, 'page', None)
+    if isinstance(event, events.PageEvent) and page is not None:
+        # the page may have changed again by the time of the delivery
+        attrs['revisions'] = _dump_value(page.getRevList()[:2])
+    data = {
+        'event': event.__class__.__name__,
+        'attrs': attrs,
+        'url': request.url_root,
+        'user_id': request.user.valid and request.user.id or None,
+        'remote_addr': request.remote_addr,
+        'queued': time.time(),
+    }
+    try:
+        pickle.dumps(data, PICKLE_PROTOCOL)
+    except (pickle.PicklingError, TypeError), err:
+        raise EventQueueError(str(err))
+    return data
+
+
+def load_event(request, data):
+    """ Return the event of the data made by dump_event, for request """
+    cls = getattr(events, data['event'])
+    # not calling __init__, the event was already sent
+    event = cls.__new__(cls)
+    event.request = request
+    for name, value in data['attrs'].items():
+        setattr(event, name, _load_value(request, value))
+    return event
+
+
+def _make_request(data):
+    from MoinMoin.user import User
+    from MoinMoin.web.contexts import ScriptContext
+
+    request = ScriptContext(data['url'])
+    if data['remote_addr']:
+        request.environ['REMOTE_ADDR'] = data['remote_addr']
+    if data['user_id']:
+        request.user = User(request, data['user_id'])
+    return request
+
+
+class EventQueue(object):
+    """ The queued events of a wiki """
+
+    def __init__(self, path, retries=5, retry_delay=60):
+        self.path = path
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._count = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _ident(self):
+        self._lock.acquire()
+        try:
+            self._count += 1
+            count = self._count
+        finally:
+            self._lock.release()
+        return '%d.%d.%d' % (time.time() * 1000000, os.getpid(), count)
+
+    def _write(self, data):
+        """ Store data as an event file, named after when it is due """
+        due = min([retry for tries, retry in data['pending'].values()])
+        name = '%020d-%s.event' % (long(due * 1000000), data['id'])
+        fd, tmpname = tempfile.mkstemp('.tmp', 'event', self.path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(data, f, PICKLE_PROTOCOL)
+            finally:
+                f.close()
+            filesys.chmod(tmpname, 0666 & config.umask)
+            filesys.rename(tmpname, os.path.join(self.path, name))
+        except:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        return name
+
+    def put(self, data, handlers):
+        """ Queue the data of an event for the names of the handlers """
+        data = dict(data)
+        data['id'] = self._ident()
+        data['pending'] = dict([(name, (0, 0)) for name in handlers])
+        return self._write(data)
+
+    def names(self, due=None):
+        """ Return the names of the events queued, in the order they are
+        due, only those due at time <due> if given """
+        names = [name for name in os.listdir(self.path) if name.endswith('.event')]
+        names.sort()
+        if due is not None:
+            due = '%020d' % long(due * 1000000)
+            names = [name for name in names if name[:20] <= due]
+        return names
+
+    def load(self, name):
+        f = file(os.path.join(self.path, name), 'rb')
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+    def claim(self, name):
+        """ Take an event for delivery, None if another worker took it """
+        workname = name[:-len('.event')] + '.work'
+        try:
+            os.rename(os.path.join(self.path, name), os.path.join(self.path, workname))
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        # recover() goes by the time of the claim
+        os.utime(os.path.join(self.path, workname), None)
+        return workname
+
+    def recover(self, now=None):
+        """ Queue again the events of workers that did not finish with them """
+        if now is None:
+            now = time.time()
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                if now - os.path.getmtime(filename) < CLAIM_TIMEOUT:
+                    continue
+                if name.endswith('.work'):
+                    os.rename(filename, filename[:-len('.work')] + '.event')
+                elif name.endswith('.tmp'):
+                    os.remove(filename)
+            except OSError:
+                pass # taken care of by someone else
+
+    def deliver(self, name, now=None, make_request=_make_request, drain=False):
+        """ Deliver a claimed event to the handlers it is due for
+
+        @param name: name of the event, as returned by claim()
+        @param now: deliver the retries due at this time (default: now)
+        @param make_request: returns a request for the data of an event
+        @param drain: deliver to all handlers, also those waiting for a retry
+        """
+        if now is None:
+            now = time.time()
+        filename = os.path.join(self.path, name)
+        try:
+            data = self.load(name)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError), err:
+            logging.error("Dropping broken queued event %s: %s" % (name, err))
+            os.remove(filename)
+            return
+
+        due = [handler for handler, (tries, retry) in data['pending'].items() if drain or retry <= now]
+        if due:
+            self._deliver(data, due, now, make_request)
+
+        if data['pending']:
+            self._write(data)
+        os.remove(filename)
+
+    def _deliver(self, data, due, now, make_request):
+        request = make_request(data)
+        try:
+            event = load_event(request, data)
+            handlers = get_queued_handlers(request.cfg)
+            for name in due:
+                handle = handlers.get(name)
+                if handle is None:
+                    logging.warning("Dropping %s for unknown event handler %s" % (data['event'], name))
+                    del data['pending'][name]
+                    continue
+
+                try:
+                    result = handle(event)
+                except Exception, err:
+                    logging.exception("Event handler %s failed for %s" % (name, data['event']))
+                    result = notification.Failure(str(err))
+
+                tries = data['pending'][name][0] + 1
+                if not isinstance(result, notification.Failure):
+                    del data['pending'][name]
+                elif tries >= self.retries:
+                    logging.error("Dropping %s for event handler %s after %d tries: %s" % (
+                                  data['event'], name, tries, result))
+                    del data['pending'][name]
+                else:
+                    retry = now + self.retry_delay * 2 ** (tries - 1)
+                    data['pending'][name] = (tries, retry)
+        finally:
+            request.finish()
+
+    def remove(self, name):
+        """ Remove a claimed event without delivering it """
+        os.remove(os.path.join(self.path, name))
+
+    def process(self, now=None, make_request=_make_request, drain=False):
+        """ Deliver the events due, return how many were delivered
+
+        @param drain: deliver all events, also those waiting for a retry
+        """
+        if now is None:
+            now = time.time()
+        due = now
+        if drain:
+            due = None
+        count = 0
+        for name in self.names(due):
+            workname = self.claim(name)
+            if workname is not None:
+                self.deliver(workname, now, make_request, drain)
+                count += 1
+        return count
+
+
+class _Workers(object):
+    """ Threads of this process that deliver queued events """
+
+    def __init__(self, queue, count):
+        self.queue = queue
+        self.wakeup = threading.Condition()
+        self.threads = []
+        for i in range(count):
+            thread = threading.Thread(target=self.run, name='EventQueue-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def notify(self):
+        self.wakeup.acquire()
+        try:
+            self.wakeup.notifyAll()
+        finally:
+            self.wakeup.release()
+
+    def run(self):
+        recovered = 0
+        while True:
+            try:
+                now = time.time()
+                if now - recovered > CLAIM_TIMEOUT:
+                    self.queue.recover(now)
+                    recovered = now
+                self.queue.process(now)
+            except Exception:
+                logging.exception("Delivering queued events failed")
+
+            self.wakeup.acquire()
+            try:
+                self.wakeup.wait(POLL_INTERVAL)
+            finally:
+                self.wakeup.release()
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(request):
+    """ Return the event queue of the wiki """
+    cfg = request.cfg
+    path = os.path.join(cfg.data_dir, 'event-queue')
+    return EventQueue(path, cfg.event_queue_retries, cfg.event_queue_retry_delay)
+
+
+def _get_workers(request, queue):
+    count = request.cfg.event_queue_workers
+    if not count:
+        return None
+    _queues_lock.acquire()
+    try:
+        workers = _queues.get(queue.path)
+        if workers is None:
+            workers = _queues[queue.path] = _Workers(queue, count)
+        return workers
+    finally:
+        _queues_lock.release()
+
+
+def enqueue(event):
+    """ Queue the event for the handlers that get their events through
+    the queue, and return those handlers.
+
+    Events that can not be queued are not, and are handled by all
+    handlers right away.
+    """
+    request = event.request
+    handlers = get_queued_handlers(request.cfg)
+    if not handlers:
+        return []
+
+    try:
+        data = dump_event(event)
+    except EventQueueError, err:
+        logging.debug("Not queueing event: %s" % err)
+        return []
+
+    queue = get_queue(request)
+    queue.put(data, handlers.keys())
+    workers = _get_workers(request, queue)
+    if workers is not None:
+        workers.notify()
+    return handlers.values()
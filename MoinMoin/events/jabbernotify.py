@@ -102,10 +102,14 @@ def handle_page_changed(event):
     request = event.request
     page = event.page
 
+    revisions = getattr(event, 'revisions', None)
+    if revisions is None:
+        revisions = page.getRevList()
+
     subscribers = page.getSubscribers(request, return_users=1)
     notification.filter_subscriber_list(event, subscribers, True)
     return page_change("page_changed", request, page, subscribers, \
-                       revisions=page.getRevList(), comment=event.comment)
+                       revisions=revisions, comment=event.comment)
 
 
 def handle_page_deleted(event):
@@ -10,6 +10,7 @@
 """
 
 from MoinMoin import user, wikiutil
+from MoinMoin.Page import Page
 from MoinMoin.events import EventResult
 
 
@@ -62,7 +63,8 @@ def page_change_message(msgtype, request, page, lang, **kwargs):
     _ = lambda text: request.getText(text, lang=lang)
     cfg = request.cfg
     data = {}
-    data['revision'] = str(page.getRevList()[0])
+    revisions = kwargs.get('revisions') or page.getRevList()
+    data['revision'] = str(revisions[0])
     data['page_name'] = pagename = page.page_name
     sitename = page.cfg.sitename or request.url_root
     data['editor'] = editor = username = page.uid_override or user.getUserIdentification(request)
@@ -76,7 +78,8 @@ def page_change_message(msgtype, request, page, lang, **kwargs):
         revisions = kwargs['revisions']
         # append a diff (or append full page text if there is no diff)
         if len(revisions) < 2:
-            data['diff'] = _("New page:\n") + page.get_raw_body()
+            text = Page(request, page.page_name, rev=revisions[0]).get_raw_body()
+            data['diff'] = _("New page:\n") + text
         else:
             lines = wikiutil.pagediff(request, page.page_name, revisions[1],
                                       page.page_name, revisions[0])
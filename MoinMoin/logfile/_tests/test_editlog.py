@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.logfile.editlog Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+import shutil
+import tempfile
+
+from MoinMoin.logfile import editlog
+
+
+class TestEditLogIndex(object):
+    """ edit-log: reading the changes since a time with the index """
+    START = 1292630945000000
+
+    def setup_method(self, method):
+        self.interval = editlog.INDEX_INTERVAL
+        # a record every few lines
+        editlog.INDEX_INTERVAL = 256
+        self.tempdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tempdir, 'edit-log')
+
+    def teardown_method(self, method):
+        editlog.INDEX_INTERVAL = self.interval
+        shutil.rmtree(self.tempdir)
+
+    def add(self, log, first, count):
+        for i in range(first, first + count):
+            usecs = self.START + i * 1000000
+            log.add(self.request, usecs, i + 1, 'SAVE', u'Page%d' % i, comment=u'ümlaut')
+
+    def times(self, entries):
+        return [(entry.ed_time_usecs - self.START) // 1000000 for entry in entries]
+
+    def test_since(self):
+        log = editlog.EditLog(self.request, filename=self.fname)
+        self.add(log, 0, 50)
+        assert os.path.getsize(self.fname) > 10 * editlog.INDEX_INTERVAL
+
+        # built by the first reader
+        assert self.times(log.since(self.START + 40 * 1000000)) == range(40, 50)
+        assert os.path.exists(self.fname + '.index')
+        assert log.index_offset(self.START + 40 * 1000000) > 0
+        assert log.index_offset(self.START) == 0
+
+        # maintained by add
+        size = os.path.getsize(self.fname + '.index')
+        self.add(log, 50, 20)
+        assert os.path.getsize(self.fname + '.index') > size
+
+        log = editlog.EditLog(self.request, filename=self.fname)
+        assert self.times(log.since(self.START + 45 * 1000000)) == range(45, 70)
+        log = editlog.EditLog(self.request, filename=self.fname)
+        assert len(list(log.since(0))) == 70
+
+    def test_replaced_log(self):
+        log = editlog.EditLog(self.request, filename=self.fname)
+        self.add(log, 0, 50)
+        log.index_rebuild()
+
+        # the index does not fit the new log, it is not used
+        os.remove(self.fname)
+        log = editlog.EditLog(self.request, filename=self.fname)
+        self.add(log, 100, 30)
+        assert self.times(log.since(self.START + 30 * 1000000)) == range(100, 130)
+        assert not os.path.exists(self.fname + '.index')
+
+    def test_editor_name(self):
+        log = editlog.EditLog(self.request, filename=self.fname)
+        self.add(log, 0, 1)
+        entry = list(log.since(0))[0]
+        assert entry.getEditorName(self.request) == entry.hostname
+
+
+coverage_modules = ['MoinMoin.logfile.editlog']
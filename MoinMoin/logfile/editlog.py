@@ -15,12 +15,29 @@
     @license: GNU GPL, see COPYING for details.
 """
 
+import os
+import errno
+import struct
+import tempfile
+
 from MoinMoin import log
 logging = log.getLogger(__name__)
 
 from MoinMoin.logfile import LogFile
 from MoinMoin import wikiutil, user, config
 from MoinMoin.Page import Page
+from MoinMoin.util import filesys
+
+# The index of an edit-log has a record for the line crossing each
+# INDEX_INTERVAL bytes of the log: timestamp (usecs) and offset of the line
+INDEX_INTERVAL = 65536
+INDEX_RECORD = struct.Struct('<qQ')
+
+
+def _index_wanted(start, end):
+    """ Is the log line from <start> to <end> recorded in the index? """
+    return start % INDEX_INTERVAL == 0 or start // INDEX_INTERVAL != (end - 1) // INDEX_INTERVAL
+
 
 class EditLogLine:
     """
@@ -51,6 +68,22 @@ class EditLogLine:
             return user.id == self.userid
         return request.remote_addr == self.addr
 
+    def _getUser(self, request):
+        """ Return the User of the editor, loaded once per request """
+        if self.userid not in self._usercache:
+            self._usercache[self.userid] = user.User(request, self.userid, auth_method="editlog")
+        return self._usercache[self.userid]
+
+    def getEditorName(self, request):
+        """ Return the name of the user that did the edit, or the host name
+            if it was not done by a known user.
+        """
+        if self.userid:
+            userdata = self._getUser(request)
+            if userdata.name:
+                return userdata.name
+        return self.hostname
+
     def getEditorData(self, request):
         """ Return a tuple of type id and string or Page object
             representing the user that did the edit.
@@ -63,9 +96,7 @@ class EditLogLine:
         """
         result = 'ip', request.cfg.show_hosts and self.hostname or ''
         if self.userid:
-            if self.userid not in self._usercache:
-                self._usercache[self.userid] = user.User(request, self.userid, auth_method="editlog:53")
-            userdata = self._usercache[self.userid]
+            userdata = self._getUser(request)
             if userdata.name:
                 pg = wikiutil.getHomePage(request, username=userdata.name)
                 if pg:
@@ -87,9 +118,7 @@ class EditLogLine:
         if request.cfg.show_hosts and self.hostname:
             result = 'ip', self.hostname
         if self.userid:
-            if self.userid not in self._usercache:
-                self._usercache[self.userid] = user.User(request, self.userid, auth_method="editlog:75")
-            userdata = self._usercache[self.userid]
+            userdata = self._getUser(request)
             if userdata.mailto_author and userdata.email:
                 return ('email', userdata.email)
             elif userdata.name:
@@ -157,7 +186,13 @@ class EditLog(LogFile):
                 filename = request.rootpage.getPagePath('edit-log', isfile=1)
         LogFile.__init__(self, filename, buffer_size)
         self._NUM_FIELDS = 9
-        self._usercache = {}
+        # shared by all edit-logs of the request, see EditLogLine._getUser
+        try:
+            self._usercache = request.editlog_users
+        except AttributeError: # not a context, eg. for request.editlog
+            self._usercache = {}
+        self._log_filename = filename
+        self._index_filename = filename + '.index'
 
         # Used by antispam in order to show an internal name instead
         # of a confusing userid
@@ -207,7 +242,140 @@ class EditLog(LogFile):
                            extra,
                            comment,
                            )) + "\n"
-        self._add(line)
+        start, end = self._add(line)
+        if _index_wanted(start, end):
+            self._index_add(long(mtime), start)
+
+    def _add(self, line):
+        """ Append a line to the edit-log
+
+        @return: offsets of the start and end of the line in the log
+        """
+        data = line.encode(config.charset)
+        fd = os.open(self._log_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            os.write(fd, data)
+            # O_APPEND: this is right after our line, even if others append, too
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+        return end - len(data), end
+
+    # Timestamp index ----------------------------------------------------
+    #
+    # The index is maintained by add() once it exists and is built by the
+    # first reader that needs it. Lines without records in the index only
+    # make readers start reading from an earlier line, so lines added by
+    # other means or while the index is built are no problem.
+
+    def _index_add(self, mtime, offset):
+        try:
+            fd = os.open(self._index_filename, os.O_WRONLY | os.O_APPEND)
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            os.write(fd, INDEX_RECORD.pack(mtime, offset))
+        finally:
+            os.close(fd)
+
+    def index_rebuild(self):
+        """ Build the timestamp index of the whole log, O(n) """
+        dirname, basename = os.path.split(self._index_filename)
+        fd, tmpname = tempfile.mkstemp('.tmp', basename, dirname)
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                f = file(self._log_filename, 'rb')
+                try:
+                    start = 0
+                    for line in f:
+                        end = start + len(line)
+                        if _index_wanted(start, end):
+                            try:
+                                mtime = long(line.split('\t', 1)[0])
+                            except ValueError:
+                                pass # not recorded, broken line
+                            else:
+                                out.write(INDEX_RECORD.pack(mtime, start))
+                        start = end
+                finally:
+                    f.close()
+            finally:
+                out.close()
+            filesys.chmod(tmpname, 0666 & config.umask)
+            filesys.rename(tmpname, self._index_filename)
+        except:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+
+    def index_offset(self, usecs):
+        """ Return the offset of a line before the first one with a timestamp
+            of at least <usecs>, O(log n) with the index.
+
+            Like the rest of the code, this expects the lines to be in the
+            order of their timestamps.
+        """
+        try:
+            f = file(self._index_filename, 'rb')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            if self.size() < INDEX_INTERVAL:
+                return 0
+            self.index_rebuild()
+            f = file(self._index_filename, 'rb')
+
+        try:
+            f.seek(0, 2)
+            lo, hi = 0, f.tell() // INDEX_RECORD.size
+            found = None
+            # find the last record with a timestamp before usecs
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(mid * INDEX_RECORD.size)
+                record = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+                if record[0] < usecs:
+                    found = record
+                    lo = mid + 1
+                else:
+                    hi = mid
+        finally:
+            f.close()
+        if found is None:
+            return 0
+
+        # the log could have been replaced, check that the line is there
+        mtime, offset = found
+        f = file(self._log_filename, 'rb')
+        try:
+            f.seek(offset)
+            valid = f.readline().startswith('%d\t' % mtime)
+        finally:
+            f.close()
+        if not valid:
+            logging.warning("edit-log index %s does not match the log, removing it" % self._index_filename)
+            try:
+                os.remove(self._index_filename)
+            except OSError:
+                pass
+            return 0
+        return offset
+
+    def since(self, usecs):
+        """ Yield the entries with a timestamp of at least <usecs>, oldest first
+
+        @param usecs: timestamp in usecs
+        @rtype: iterator
+        """
+        self.seek(self.index_offset(usecs))
+        for line in self:
+            if line.ed_time_usecs >= usecs:
+                yield line
 
     def parser(self, line):
         """ Parse edit-log line into fields """
@@ -33,11 +33,13 @@ from urllib import quote
 from MoinMoin.Page import Page
 from MoinMoin.parser.text_moin_wiki import Parser
 from MoinMoin.wikiutil import form_writer
+from MoinMoin.util.lru import LRUCache
 
 from MoinMoin.metadata.constants import PROPERTIES
 from MoinMoin.metadata.util import url_escape
 from MoinMoin.metadata.query import (metatable_parseargs, get_metas,
-                                     get_properties, add_matching_redirs)
+                                     get_properties, add_matching_redirs,
+                                     metatable_dependencies)
 from MoinMoin.metadata.wikitextutil import format_wikitext
 
 try:
@@ -47,6 +49,11 @@ except ImportError:
 
 Dependencies = ['metadata']
 
+# Process-wide cache of rendered tables, see do_macro
+FRAGMENT_CACHE_SIZE = 256
+
+_fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
 # SVG color scheme
 COLORS = ['aliceblue', 'antiquewhite', 'aqua', 'aquamarine',
           'azure', 'beige', 'bisque', 'black', 'blanchedalmond',
@@ -481,7 +488,68 @@ def construct_table(request, pagelist, metakeys, legend='',
     return out
 
 
+def _fragment_key(request, args, kw):
+    user = request.user
+    cfg = request.cfg
+    # What the user may read and write only depends on these
+    acl_class = (user.valid and user.name or None,
+                 user.auth_method in cfg.auth_methods_trusted)
+    return (cfg.siteid, request.script_root, request.page.page_name,
+            args, tuple(sorted(kw.items())), acl_class,
+            request.theme.name, request.formatter.__class__, request.lang)
+
+
+def _fragment_dependencies(request, args, kw, pagelist, metakeys):
+    deps = metatable_dependencies(request, args, pagelist, metakeys)
+    if deps is None:
+        return None
+
+    # Properties of the keys, see construct_table
+    for option in ['propdefault', 'propoverride']:
+        name = kw.get(option)
+        if name:
+            if not name.endswith('Property'):
+                name = '%sProperty' % (name)
+            deps.pages.add(name)
+    return deps
+
+
 def do_macro(request, args, **kw):
+    """
+    Render a MetaTable. The rendered tables are cached along with
+    the pages and keys they depend on, and rendered again only after
+    the change feed of the graphdata shows changes to those.
+    """
+    graphdata = request.graphdata
+    # Versions of changes not committed yet are not final
+    if graphdata.has_pending_changes():
+        return _do_macro(request, args, kw)[0]
+
+    key = _fragment_key(request, args, kw)
+    version = graphdata.get_version()
+
+    entry = _fragment_cache.get(key)
+    if entry is not None:
+        old_version, deps, out = entry
+        if old_version == version:
+            return out
+        changed, version = graphdata.changes_since(old_version)
+        if not deps.affected_by(request, changed):
+            _fragment_cache[key] = (version, deps, out)
+            return out
+
+    out, pagelist, metakeys = _do_macro(request, args, kw)
+
+    deps = _fragment_dependencies(request, args, kw, pagelist, metakeys)
+    if deps is None:
+        _fragment_cache.pop(key, None)
+    else:
+        # Changes made while rendering show up as changes since version
+        _fragment_cache[key] = (version, deps, out)
+    return out
+
+
+def _do_macro(request, args, kw):
     formatter = request.formatter
     _ = request.getText
     out = list()
@@ -501,7 +569,7 @@ def do_macro(request, args, **kw):
             out.extend(t_cell(request, request.page,
                               ["%s '%s'" % (_("No matches for"), args)]))
         out.append(formatter.table(0) + u'</div>')
-        return "".join(out)
+        return "".join(out), pagelist, metakeys
 
     parser = Parser('', request)
 
@@ -527,7 +595,7 @@ def do_macro(request, args, **kw):
     out.append(action_link('metaCSV', 'csv', args))
     out.append(action_link('metaPackage', 'zip', args))
     out.append(formatter.div(0))
-    return "".join(out)
+    return "".join(out), pagelist, metakeys
 
 
 def execute(macro, args):
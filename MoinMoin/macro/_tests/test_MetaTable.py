@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.macro.MetaTable Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+import shutil
+import tempfile
+
+from MoinMoin.Page import Page
+from MoinMoin._tests import make_macro
+from MoinMoin.macro import MetaTable
+from MoinMoin.metadata.backend import sqlitedb
+
+
+class TestFragmentCache(object):
+    """ MetaTable: rendered tables are cached until their data changes """
+    pages = {
+        u'TablePageA': {u'Status': [u'Open'], u'Owner': [u'[[JohnDoe]]']},
+        u'TablePageB': {u'Status': [u'Closed']},
+        u'OtherPage': {u'Color': [u'red']},
+    }
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_graphdata = self.request.__dict__.pop('_graphdata', None)
+        dbfile = os.path.join(self.tempdir, 'graphdata.sqlite')
+        self.graphdata = sqlitedb.GraphData(self.request, dbfile=dbfile)
+        self.request.__dict__['_graphdata'] = self.graphdata
+        for pagename, metas in self.pages.items():
+            self.set_page(pagename, metas)
+        self.graphdata.commit()
+
+        self.rendered = list()
+        self.old_do_macro = MetaTable._do_macro
+        def do_macro(request, args, kw):
+            self.rendered.append(args)
+            return self.old_do_macro(request, args, kw)
+        MetaTable._do_macro = do_macro
+        MetaTable._fragment_cache.clear()
+
+    def teardown_method(self, method):
+        MetaTable._do_macro = self.old_do_macro
+        MetaTable._fragment_cache.clear()
+        self.request.__dict__.pop('_graphdata', None)
+        self.graphdata.close()
+        if self.old_graphdata is not None:
+            self.request.__dict__['_graphdata'] = self.old_graphdata
+        shutil.rmtree(self.tempdir)
+
+    def set_page(self, pagename, metas):
+        self.graphdata.set_page(self.request, pagename,
+                                {pagename: {u'meta': metas}})
+
+    def render(self, args):
+        macro = make_macro(self.request, Page(self.request, u'FrontPage'))
+        return macro.execute('MetaTable', args)
+
+    def test_cached(self):
+        first = self.render(u'TablePageA, TablePageB')
+        assert u'Closed' in first
+        assert self.render(u'TablePageA, TablePageB') == first
+        assert self.rendered == [u'TablePageA, TablePageB']
+
+        # Options are part of the key
+        self.render(u'TablePageA, TablePageB, gwikisilent')
+        assert len(self.rendered) == 2
+
+    def test_invalidated(self):
+        args = u'TablePageA, TablePageB'
+        self.render(args)
+        self.render(u'Status=Open')
+
+        # Changes to pages not shown, and without the keys queried
+        self.set_page(u'OtherPage', {u'Color': [u'blue']})
+        self.graphdata.commit()
+        self.render(args)
+        self.render(u'Status=Open')
+        assert len(self.rendered) == 2
+
+        # Changes to shown pages
+        self.set_page(u'TablePageB', {u'Status': [u'Reopened']})
+        self.graphdata.commit()
+        assert u'Reopened' in self.render(args)
+        assert len(self.rendered) == 3
+
+        # Pages that may now match an open query
+        self.render(u'Status=Open')
+        assert len(self.rendered) == 4
+        self.set_page(u'OtherPage', {u'Status': [u'Open']})
+        self.graphdata.commit()
+        assert u'OtherPage' in self.render(u'Status=Open')
+        assert len(self.rendered) == 5
+
+    def test_pending_changes(self):
+        args = u'TablePageA, TablePageB'
+        self.render(args)
+        self.set_page(u'TablePageB', {u'Status': [u'Reopened']})
+        assert u'Reopened' in self.render(args)
+        assert u'Reopened' in self.render(args)
+        assert len(self.rendered) == 3
+
+
+coverage_modules = ['MoinMoin.macro.MetaTable']
@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.backend Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from MoinMoin.metadata.backend import shelvedb, sqlitedb
+from MoinMoin.metadata.query import ordervalue_key
+
+
+def page_data(pagename, meta=None, out=None, acl=u''):
+    return {pagename: {u'meta': meta or dict(),
+                       u'out': out or dict(),
+                       u'acl': acl}}
+
+
+class BackendTests(object):
+    """ tests shared by all the graphdata backends """
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.graphdata = self.make_graphdata()
+
+    def teardown_method(self, method):
+        self.graphdata.close()
+        shutil.rmtree(self.tempdir)
+
+    def reopen(self):
+        self.graphdata.commit()
+        self.graphdata.close()
+        self.graphdata = self.make_graphdata()
+
+    def test_set_page(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'key': [u'1', u'2']},
+                              {u'friend': [u'PageB', u'http://example.org/']},
+                              u'All:read'))
+        self.reopen()
+        gd = self.graphdata
+
+        assert u'PageA' in gd
+        assert gd.is_saved(u'PageA')
+        assert gd.get_meta(u'PageA') == {u'key': [u'1', u'2']}
+        assert gd.get_out(u'PageA') == {u'friend': [u'PageB',
+                                                    u'http://example.org/']}
+        assert gd.getpage(u'PageA')[u'acl'] == u'All:read'
+        assert gd.get_metakeys(u'PageA') == set([u'key'])
+
+        # Only local pages get in-links
+        assert gd.get_in(u'PageB') == {u'friend': [u'PageA']}
+        assert not gd.is_saved(u'PageB')
+        assert u'http://example.org/' not in gd
+
+    def test_change_links(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', out={u'a': [u'PageB', u'PageC']}))
+        gd.set_page(self.request, u'PageD',
+                    page_data(u'PageD', out={u'a': [u'PageB']}))
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', out={u'a': [u'PageC'],
+                                             u'b': [u'PageB']}))
+        self.reopen()
+        gd = self.graphdata
+
+        assert gd.get_out(u'PageA') == {u'a': [u'PageC'], u'b': [u'PageB']}
+        inlinks = gd.get_in(u'PageB')
+        assert sorted(inlinks) == [u'a', u'b']
+        assert inlinks[u'a'] == [u'PageD']
+        assert inlinks[u'b'] == [u'PageA']
+        assert gd.get_in(u'PageC') == {u'a': [u'PageA']}
+
+    def test_clear_page(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'key': [u'1']}, {u'a': [u'PageB']}))
+        gd.set_page(self.request, u'PageB',
+                    page_data(u'PageB', {u'key': [u'2']}, {u'a': [u'PageA']}))
+
+        # Still linked to, the page is left behind unsaved
+        gd.set_page(self.request, u'PageA', page_data(u'PageA'))
+        gd.clear_page(u'PageA')
+        self.reopen()
+        gd = self.graphdata
+
+        assert u'PageA' in gd
+        assert not gd.is_saved(u'PageA')
+        assert gd.get_meta(u'PageA') == dict()
+        assert gd.get_in(u'PageA') == {u'a': [u'PageB']}
+        assert gd.get_in(u'PageB') == dict()
+
+        gd.set_page(self.request, u'PageB', page_data(u'PageB'))
+        gd.clear_page(u'PageB')
+        self.reopen()
+        gd = self.graphdata
+
+        assert u'PageB' not in gd
+
+    def test_pagenames(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', out={u'a': [u'PageB']}))
+        gd.set_page(self.request, u'Päge', page_data(u'Päge'))
+        self.reopen()
+
+        assert sorted(self.graphdata.pagenames()) == [u'PageA', u'PageB',
+                                                      u'Päge']
+
+    def test_sort_keys(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'key': [u'10.0.0.1', u'x']}))
+        gd.set_page(self.request, u'PageB', page_data(u'PageB'))
+        self.reopen()
+
+        sortkeys = self.graphdata.get_sort_keys([u'PageA', u'PageB'], u'key')
+        assert sorted(sortkeys[u'PageA']) == [ordervalue_key(u'10.0.0.1'),
+                                              ordervalue_key(u'x')]
+        assert sortkeys[u'PageB'] == list()
+
+    def test_get_acls(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', out={u'friend': [u'PageC']},
+                              acl=u'All:read\n'))
+        gd.set_page(self.request, u'PageB', page_data(u'PageB'))
+        self.reopen()
+
+        expected = {u'PageA': u'All:read\n', u'PageB': u''}
+        pagenames = [u'PageA', u'PageB', u'PageC', u'PageD']
+        assert self.graphdata.get_acls(pagenames) == expected
+        # Also when given more pages than are looked up one by one
+        pagenames.extend(u'Page%d' % x for x in range(1000))
+        assert self.graphdata.get_acls(pagenames) == expected
+
+    def test_sync_position(self):
+        assert self.graphdata.get_sync_position() is None
+        self.graphdata.set_sync_position(123)
+        self.reopen()
+
+        assert self.graphdata.get_sync_position() == 123
+        assert self.graphdata.keys() == list()
+
+    def test_changes_since(self):
+        assert self.graphdata.changes_since(0) == (set(), 0)
+
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', out={u'a': [u'PageB']}))
+        gd.set_page(self.request, u'PageC', page_data(u'PageC'))
+        self.reopen()
+        gd = self.graphdata
+
+        changed, version = gd.changes_since(0)
+        assert changed == set([u'PageA', u'PageB', u'PageC'])
+        assert version == gd.get_version() > 0
+        assert gd.changes_since(version) == (set(), version)
+
+        # Removing a link also changes its destination
+        gd.set_page(self.request, u'PageA', page_data(u'PageA'))
+        gd.clear_page(u'PageC')
+        self.reopen()
+
+        changed, newer = self.graphdata.changes_since(version)
+        assert changed == set([u'PageA', u'PageB', u'PageC'])
+        assert newer > version
+
+    def test_savepoints(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA', page_data(u'PageA'))
+        outer = gd.savepoint()
+        gd.set_page(self.request, u'PageB', page_data(u'PageB'))
+        inner = gd.savepoint()
+        gd.set_page(self.request, u'PageC', page_data(u'PageC'))
+        gd.rollback_to(inner)
+        assert u'PageC' not in gd
+        gd.release(outer)
+
+        # Nothing written after the savepoint
+        gd.rollback_to(gd.savepoint())
+        self.reopen()
+        gd = self.graphdata
+
+        assert u'PageA' in gd
+        assert u'PageB' in gd
+        assert u'PageC' not in gd
+
+    def test_rollback_links(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'key': [u'1']}, {u'a': [u'PageB']}))
+        savepoint = gd.savepoint()
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'key': [u'2']}, {u'a': [u'PageC']}))
+        gd.set_page(self.request, u'PageD',
+                    page_data(u'PageD', out={u'a': [u'PageB']}))
+        gd.rollback_to(savepoint)
+        self.reopen()
+        gd = self.graphdata
+
+        assert gd.get_meta(u'PageA') == {u'key': [u'1']}
+        assert gd.get_out(u'PageA') == {u'a': [u'PageB']}
+        assert gd.get_in(u'PageB') == {u'a': [u'PageA']}
+        assert u'PageC' not in gd
+        assert u'PageD' not in gd
+
+    def test_value_index(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'Status': [u'Open'],
+                                         u'Owner': [u'[[JohnDoe|John]]']},
+                              {u'gwikicategory': [u'CategoryTask']}))
+        gd.set_page(self.request, u'PageB',
+                    page_data(u'PageB', {u'Status': [u'Closed']}))
+        self.reopen()
+        gd = self.graphdata
+
+        assert gd.pages_with_key(u'Status') == set([u'PageA', u'PageB'])
+        assert gd.pages_with_value(u'Status', u'Open') == set([u'PageA'])
+        assert u'PageA' in gd.pages_with_value(u'Owner', u'JohnDoe')
+        assert gd.pages_with_key(u'gwikicategory') == set([u'PageA'])
+        assert gd.pages_with_value(u'gwikicategory',
+                                   u'CategoryTask') == set([u'PageA'])
+
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'Status': [u'Closed']}))
+        gd.set_page(self.request, u'PageB', page_data(u'PageB'))
+        gd.clear_page(u'PageB')
+        self.reopen()
+        gd = self.graphdata
+
+        assert gd.pages_with_key(u'Status') == set([u'PageA'])
+        assert gd.pages_with_value(u'Status', u'Open') == set()
+        assert gd.pages_with_value(u'Status', u'Closed') == set([u'PageA'])
+        assert gd.pages_with_key(u'gwikicategory') == set()
+
+    def test_replace_with(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA', page_data(u'PageA'))
+        self.reopen()
+        version = self.graphdata.get_version()
+
+        side = self.graphdata.side_copy()
+        try:
+            side.set_page(self.request, u'PageB',
+                          page_data(u'PageB', out={u'a': [u'PageC']}))
+            assert u'PageB' not in self.graphdata
+        except:
+            side.close()
+            raise
+        self.graphdata.replace_with(side)
+        self.reopen()
+        gd = self.graphdata
+
+        assert u'PageA' not in gd
+        assert gd.is_saved(u'PageB')
+        assert gd.get_in(u'PageC') == {u'a': [u'PageB']}
+        assert not [x for x in os.listdir(self.tempdir) if 'rehash' in x]
+
+        # Both the removed and the new pages show up as changed
+        changed, newer = gd.changes_since(version)
+        assert changed == set([u'PageA', u'PageB', u'PageC'])
+        assert newer > version
+
+    def test_replace_with_catch_up(self):
+        side = self.graphdata.side_copy()
+        side.set_page(self.request, u'PageB', page_data(u'PageB'))
+
+        def catch_up(graphdata):
+            # Saved while the side copy was being built
+            graphdata.set_page(self.request, u'PageC',
+                               page_data(u'PageC', out={u'a': [u'PageB']}))
+            graphdata.set_sync_position(42)
+        self.graphdata.replace_with(side, catch_up)
+        self.reopen()
+        gd = self.graphdata
+
+        assert gd.is_saved(u'PageB')
+        assert gd.is_saved(u'PageC')
+        assert gd.get_in(u'PageB') == {u'a': [u'PageC']}
+        assert gd.get_sync_position() == 42
+
+class TestShelveBackend(BackendTests):
+
+    def make_graphdata(self):
+        graphshelve = os.path.join(self.tempdir, 'graphdata.shelve')
+        return shelvedb.GraphData(self.request, graphshelve=graphshelve)
+
+    def link_pages(self, sources, dst):
+        for src in sources:
+            self.graphdata.set_page(self.request, src,
+                                    page_data(src, out={u'a': [dst]}))
+
+    def test_segmented_in_links(self):
+        old_size = shelvedb.SEGMENT_SIZE
+        shelvedb.SEGMENT_SIZE = 4
+        try:
+            sources = [u'Page%d' % x for x in range(20)]
+            self.link_pages(sources, u'Target')
+            self.reopen()
+            gd = self.graphdata
+
+            insegs = gd.getpage(u'Target')[u'insegs']
+            assert insegs[u'a'] > 1
+            assert u'in' not in gd.getpage(u'Target')
+            assert sorted(gd.get_in(u'Target')[u'a']) == sorted(sources)
+            assert u'Target' in gd.keys()
+            assert len([x for x in gd.keys() if x == u'Target']) == 1
+
+            # Adding one more link only rewrites one segment
+            self.link_pages([u'Other'], u'Target')
+            segments = [x for x in gd.out if
+                        x.startswith(shelvedb.IN_PREFIX)]
+            assert len(segments) == 1
+
+            for src in sources:
+                gd.set_page(self.request, src, page_data(src))
+                gd.clear_page(src)
+            self.reopen()
+
+            assert self.graphdata.get_in(u'Target') == {u'a': [u'Other']}
+        finally:
+            shelvedb.SEGMENT_SIZE = old_size
+
+    def test_segmented_value_index(self):
+        old_size = shelvedb.SEGMENT_SIZE
+        shelvedb.SEGMENT_SIZE = 4
+        try:
+            pages = [u'Page%d' % x for x in range(20)]
+            for pagename in pages:
+                self.graphdata.set_page(self.request, pagename,
+                                        page_data(pagename,
+                                                  {u'Status': [u'Open']}))
+            self.reopen()
+            gd = self.graphdata
+
+            key = gd._index_key((u'Status', u'Open'))
+            assert gd._get_raw(key) > 1
+            assert gd.pages_with_value(u'Status', u'Open') == set(pages)
+            assert gd.pages_with_key(u'Status') == set(pages)
+            assert gd.keys() and not [x for x in gd.keys()
+                                      if x not in pages]
+
+            for pagename in pages[:10]:
+                gd.set_page(self.request, pagename, page_data(pagename))
+            self.reopen()
+
+            assert self.graphdata.pages_with_value(u'Status', u'Open') == \
+                set(pages[10:])
+        finally:
+            shelvedb.SEGMENT_SIZE = old_size
+
+    def test_unindexed_shelve(self):
+        # Pages saved before the indexes were kept are not in them
+        graphshelve = os.path.join(self.tempdir, 'legacy.shelve')
+        db = shelvedb.shelve.open(graphshelve, 'c')
+        db[shelvedb.encode_page(u'PageA')] = {u'meta': {u'key': [u'1']}}
+        db.close()
+
+        gd = shelvedb.GraphData(self.request, graphshelve=graphshelve)
+        try:
+            assert gd.get_meta(u'PageA') == {u'key': [u'1']}
+            assert gd.pages_with_key(u'key') is None
+            assert gd.pages_with_value(u'key', u'1') is None
+        finally:
+            gd.close()
+
+    def test_change_records(self):
+        old_chunk = shelvedb.CHANGES_CHUNK
+        shelvedb.CHANGES_CHUNK = 2
+        try:
+            for x in range(6):
+                self.graphdata.set_page(self.request, u'PageA',
+                                        page_data(u'PageA'))
+                self.reopen()
+            gd = self.graphdata
+
+            # Only the latest change of a page is kept
+            chunks = [x for x in gd._open().keys() if
+                      x.startswith(shelvedb.CHANGES_PREFIX)]
+            assert len(chunks) == 1
+            assert gd.changes_since(5) == (set([u'PageA']), 6)
+            assert gd.getpage(u'PageA')[u'version'] == 6
+            assert gd.keys() == [u'PageA']
+        finally:
+            shelvedb.CHANGES_CHUNK = old_chunk
+
+    def test_unsegmented_records(self):
+        gd = self.graphdata
+        gd.savepage(u'Target', {u'in': {u'a': [u'PageA', u'PageB']}})
+        gd.savepage(u'PageA', {u'saved': True, u'out': {u'a': [u'Target']}})
+        gd.savepage(u'PageB', {u'saved': True, u'out': {u'a': [u'Target']}})
+        self.reopen()
+
+        assert self.graphdata.has_in(u'Target')
+        self.link_pages([u'PageC'], u'Target')
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA', page_data(u'PageA'))
+        self.reopen()
+        gd = self.graphdata
+
+        assert u'in' not in gd.getpage(u'Target')
+        assert sorted(gd.get_in(u'Target')[u'a']) == [u'PageB', u'PageC']
+
+    def test_old_sort_keys(self):
+        gd = self.graphdata
+        gd.savepage(u'PageA', {u'saved': True, u'meta': {u'key': [u'1']},
+                               u'sortkeys': {u'key': ['old']}})
+        self.reopen()
+
+        assert self.graphdata.get_sort_keys([u'PageA'], u'key') == \
+            {u'PageA': [ordervalue_key(u'1')]}
+
+    def test_snapshot(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA', page_data(u'PageA', {u'key': [u'1']}))
+        self.reopen()
+        assert self.graphdata.get_meta(u'PageA') == {u'key': [u'1']}
+        assert u'PageB' not in self.graphdata
+        self.reopen()
+
+        # Read from the snapshot without opening the shelve
+        gd = self.graphdata
+        assert gd.get_meta(u'PageA') == {u'key': [u'1']}
+        assert u'PageB' not in gd
+        assert gd.db is None
+
+        # Records being modified are not shared
+        writer = self.make_graphdata()
+        writer.set_page(self.request, u'PageA',
+                        page_data(u'PageA', {u'key': [u'2']}))
+        other = self.make_graphdata()
+        assert other.get_meta(u'PageA') == {u'key': [u'1']}
+        other.close()
+        writer.close()
+        self.reopen()
+        assert self.graphdata.get_meta(u'PageA') == {u'key': [u'2']}
+        self.reopen()
+
+        # Writers of other processes only leave a new generation
+        lock = shelvedb._Lock(self.graphdata._writelock._lock_path,
+                              exclusive=True)
+        lock.acquire()
+        try:
+            db = self.graphdata.shelveopen(self.graphdata.graphshelve, 'c')
+            db[shelvedb.encode_page(u'PageA')] = {u'meta': {u'key': [u'3']}}
+            db.close()
+            lock.write_generation('other')
+        finally:
+            lock.release()
+        assert self.graphdata.get_meta(u'PageA') == {u'key': [u'3']}
+
+
+class TestSQLiteBackend(BackendTests):
+
+    def make_graphdata(self):
+        dbfile = os.path.join(self.tempdir, 'graphdata.sqlite')
+        return sqlitedb.GraphData(self.request, dbfile=dbfile)
+
+    def test_is_acid(self):
+        assert self.graphdata.is_acid
+
+    def test_abort(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA', page_data(u'PageA'))
+        gd.commit()
+
+        gd.set_page(self.request, u'PageB',
+                    page_data(u'PageB', out={u'a': [u'PageA']}))
+        assert gd.get_in(u'PageA') == {u'a': [u'PageB']}
+        gd.abort()
+
+        assert u'PageB' not in gd
+        assert gd.get_in(u'PageA') == dict()
+
+    def test_close_discards_uncommitted(self):
+        self.graphdata.set_page(self.request, u'PageA', page_data(u'PageA'))
+        self.graphdata.close()
+        self.graphdata = self.make_graphdata()
+
+        assert u'PageA' not in self.graphdata
+
+    def test_concurrent_reader(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA', page_data(u'PageA',
+                                                      {u'key': [u'1']}))
+        gd.commit()
+
+        # The writer holds its transaction open, readers in other
+        # threads still see the last committed state without waiting
+        gd.set_page(self.request, u'PageA', page_data(u'PageA',
+                                                      {u'key': [u'2']}))
+        result = list()
+        def read():
+            reader = self.make_graphdata()
+            reader._timeout = 0
+            try:
+                result.append(reader.get_meta(u'PageA'))
+            finally:
+                reader.close()
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        gd.commit()
+
+        assert result == [{u'key': [u'1']}]
+        assert gd.get_meta(u'PageA') == {u'key': [u'2']}
+
+    def test_shared_connection(self):
+        # Nested requests of a thread share the transaction
+        other = self.make_graphdata()
+        try:
+            self.graphdata.set_page(self.request, u'PageA',
+                                    page_data(u'PageA'))
+            other.set_page(self.request, u'PageB', page_data(u'PageB'))
+            other.commit()
+        finally:
+            other.close()
+        self.graphdata.close()
+        self.graphdata = self.make_graphdata()
+
+        assert u'PageA' in self.graphdata
+        assert u'PageB' in self.graphdata
+
+    def test_stored_sort_keys(self):
+        gd = self.graphdata
+        gd.set_page(self.request, u'PageA',
+                    page_data(u'PageA', {u'key': [u'1']}))
+        gd._write("UPDATE metas SET ord = ?", (sqlite3.Binary('stored'), ))
+
+        assert gd.get_sort_keys([u'PageA'], u'key') == {u'PageA': ['stored']}
+
+    def make_old_database(self):
+        self.graphdata.close()
+        dbfile = os.path.join(self.tempdir, 'graphdata.sqlite')
+        if os.path.exists(dbfile):
+            os.unlink(dbfile)
+
+        db = sqlite3.connect(dbfile)
+        db.executescript("""
+            CREATE TABLE pages (id INTEGER PRIMARY KEY,
+                                name TEXT UNIQUE NOT NULL,
+                                saved INTEGER, mtime REAL, acl TEXT);
+            CREATE TABLE metas (page INTEGER, seq INTEGER,
+                                key TEXT, value TEXT);
+            CREATE TABLE links (src INTEGER, seq INTEGER, linktype TEXT,
+                                dst TEXT, dst_page INTEGER);
+            INSERT INTO pages VALUES (1, 'PageA', 1, 0, '');
+            INSERT INTO metas VALUES (1, 0, 'key', '[[5]]');
+            PRAGMA user_version = 1;
+        """)
+        db.commit()
+        db.close()
+        return dbfile
+
+    def test_upgrade(self):
+        self.make_old_database()
+
+        self.graphdata = self.make_graphdata()
+        gd = self.graphdata
+        assert gd.get_meta(u'PageA') == {u'key': [u'[[5]]']}
+        assert gd.pages_with_value(u'key', u'5') == set([u'PageA'])
+        assert gd.pages_with_order(u'key', '>', u'4') == set([u'PageA'])
+        assert gd.pages_with_order(u'key', '<', u'4') == set()
+
+    def test_concurrent_upgrade(self):
+        dbfile = self.make_old_database()
+
+        # Another connection upgrades the database after this one saw
+        # the old schema version, but before it got the write lock
+        other = sqlite3.connect(dbfile, isolation_level=None)
+        other.execute("PRAGMA journal_mode = WAL")
+        other.execute("BEGIN IMMEDIATE")
+        result = list()
+        def connect():
+            try:
+                conn = sqlitedb._Connection(dbfile, 10)
+                conn.db.close()
+                result.append(conn)
+            except Exception, err:
+                result.append(err)
+        thread = threading.Thread(target=connect)
+        thread.start()
+        time.sleep(0.5)
+        for upgrade in range(2, sqlitedb.SCHEMA_VERSION + 1):
+            sqlitedb.UPGRADES[upgrade](other)
+        other.execute("PRAGMA user_version = %d" % (sqlitedb.SCHEMA_VERSION, ))
+        other.execute("COMMIT")
+        other.close()
+        thread.join()
+
+        assert isinstance(result[0], sqlitedb._Connection)
+
+        self.graphdata = self.make_graphdata()
+        assert self.graphdata.get_meta(u'PageA') == {u'key': [u'[[5]]']}
+
+
+coverage_modules = ['MoinMoin.metadata.backend.shelvedb',
+                    'MoinMoin.metadata.backend.sqlitedb']
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.edit Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+import shutil
+import tempfile
+
+from MoinMoin._tests import become_trusted, create_page, nuke_page
+from MoinMoin.PageEditor import PageEditor
+from MoinMoin.metadata.backend import sqlitedb
+from MoinMoin.metadata.edit import parse_page, store_page, edited_pages, \
+    sync_graphdata
+
+
+class TestRehashHelpers(object):
+    pagename = u'EditHelperPage'
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        dbfile = os.path.join(self.tempdir, 'graphdata.sqlite')
+        self.graphdata = sqlitedb.GraphData(self.request, dbfile=dbfile)
+        self.old_graphdata = self.request.__dict__.pop('_graphdata', None)
+        self.request.__dict__['_graphdata'] = self.graphdata
+        become_trusted(self.request)
+
+    def teardown_method(self, method):
+        nuke_page(self.request, self.pagename)
+        nuke_page(self.request, self.pagename + u'Renamed')
+        self.request.__dict__.pop('_graphdata', None)
+        if self.old_graphdata is not None:
+            self.request.__dict__['_graphdata'] = self.old_graphdata
+        self.graphdata.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_parse_and_store(self):
+        create_page(self.request, self.pagename,
+                    u' key:: value\n[[OtherPage]]\n')
+
+        new_data, exists = parse_page(self.request, self.pagename)
+        assert exists
+        store_page(self.request, self.graphdata, self.pagename,
+                   new_data, exists)
+        assert self.graphdata.get_meta(self.pagename) == {u'key': [u'value']}
+        assert self.graphdata.is_saved(self.pagename)
+
+        nuke_page(self.request, self.pagename)
+        new_data, exists = parse_page(self.request, self.pagename)
+        assert not exists
+        store_page(self.request, self.graphdata, self.pagename,
+                   new_data, exists)
+        assert self.pagename not in self.graphdata
+
+        assert parse_page(self.request, u'Page/MoinEditorBackup') is None
+
+    def test_edited_pages(self):
+        pages, position = edited_pages(self.request)
+        assert edited_pages(self.request, position) == (set(), position)
+
+        create_page(self.request, self.pagename, u'Text\n')
+        pages, end = edited_pages(self.request, position)
+        assert pages == set([self.pagename])
+        assert end > position
+
+        # Past the end, eg. after rotating the log
+        assert self.pagename in edited_pages(self.request, end + 1)[0]
+
+    def test_edited_renamed_pages(self):
+        create_page(self.request, self.pagename, u'Text\n')
+        position = edited_pages(self.request)[1]
+
+        newname = self.pagename + u'Renamed'
+        PageEditor(self.request, self.pagename).renamePage(newname)
+        pages = edited_pages(self.request, position)[0]
+        assert pages == set([self.pagename, newname])
+
+    def test_sync_graphdata(self):
+        gd = self.graphdata
+        sync_graphdata(self.request)
+        assert gd.get_sync_position() == edited_pages(self.request)[1]
+        assert sync_graphdata(self.request) == set()
+
+        # Saved outside the wiki, eg. restored from a backup
+        create_page(self.request, self.pagename, u' key:: value\n')
+        gd.delpage(self.pagename)
+        gd.commit()
+
+        assert sync_graphdata(self.request) == set([self.pagename])
+        assert gd.get_meta(self.pagename) == {u'key': [u'value']}
+        assert sync_graphdata(self.request) == set()
+
+        nuke_page(self.request, self.pagename)
+        gd.set_page_meta(self.pagename, {u'key': [u'value']})
+        gd.set_saved(self.pagename, True, 0)
+        gd.commit()
+
+        assert sync_graphdata(self.request) == set([self.pagename])
+        assert self.pagename not in gd
+
+
+coverage_modules = ['MoinMoin.metadata.edit']
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.query Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+import shutil
+import tempfile
+
+from MoinMoin._tests import become_trusted, create_page, nuke_page
+from MoinMoin.metadata.backend import shelvedb, sqlitedb
+from MoinMoin.metadata.query import metatable_parseargs, ordervalue, \
+    ordervalue_key, _metatable_parseargs, _plan_cache, metatable_dependencies, \
+    indexed_pages
+
+
+class UnindexedGraphData(sqlitedb.GraphData):
+    """ sqlite backend acting as if it had no value indexes """
+
+    def pages_with_key(self, key):
+        return None
+
+    def pages_with_value(self, key, value):
+        return None
+
+    def pages_with_order(self, key, op, comp):
+        return None
+
+
+class TestOrdervalueKey(object):
+
+    def test_sorting(self):
+        values = [u'10', u'9.5', u'-3', u'-3.5', u'2.1.5', u'1e400',
+                  u'5', u'5 x', u'', u'b', u'A', u'[[Foo]]', u'foo bar',
+                  u'1.2.3.4', u'10.0.0.1', u'10.0.0.1/24', u'::1']
+        assert sorted(values, key=ordervalue) == \
+            sorted(values, key=ordervalue_key)
+
+    def test_exact_integers(self):
+        values = [u'9007199254740993', u'9007199254740992',
+                  u'4503599627370495.5', u'-9007199254740993',
+                  u'-9007199254740992', u'-4503599627370495.5',
+                  u'123456789012345678901234567890', u'-1', u'0',
+                  u'-0.5', u'0.5', u'1e400', u'-1e400', u'1e300', u'5.0 x']
+        keys = map(ordervalue_key, values)
+        assert len(set(keys)) == len(values)
+        assert sorted(values, key=ordervalue) == \
+            sorted(values, key=ordervalue_key)
+        assert ordervalue_key(u'5') == ordervalue_key(u'5.0')
+
+class GraphDataTests(object):
+    """ tests run against a temporary sqlite graphdata """
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_graphdata = self.request.__dict__.pop('_graphdata', None)
+
+    def teardown_method(self, method):
+        graphdata = self.request.__dict__.pop('_graphdata', None)
+        if graphdata is not None:
+            graphdata.close()
+        if self.old_graphdata is not None:
+            self.request.__dict__['_graphdata'] = self.old_graphdata
+        shutil.rmtree(self.tempdir)
+
+    def use_graphdata(self, cls):
+        graphdata = self.request.__dict__.pop('_graphdata', None)
+        if graphdata is not None:
+            graphdata.close()
+
+        if issubclass(cls, shelvedb.GraphData):
+            graphshelve = os.path.join(self.tempdir, 'graphdata.shelve')
+            graphdata = cls(self.request, graphshelve=graphshelve)
+        else:
+            dbfile = os.path.join(self.tempdir, 'graphdata.sqlite')
+            graphdata = cls(self.request, dbfile=dbfile)
+        self.request.__dict__['_graphdata'] = graphdata
+        return graphdata
+
+
+class TestIndexedQueries(GraphDataTests):
+    pages = {
+        u'QueryPageA': {u'Status': [u'Open'], u'Count': [u'3'],
+                        u'Owner': [u'[[JohnDoe]]']},
+        u'QueryPageB': {u'Status': [u'[[Open|open]]'], u'Count': [u'12'],
+                        u'Address': [u'10.0.0.2']},
+        u'QueryPageC': {u'Status': [u'Closed'], u'Count': [u'4.5'],
+                        u'Address': [u'10.0.0.10']},
+        u'QueryPageD': {u'Status': [u'Open 100%'], u'Count': [u'x']},
+        u'QueryPageE': {u'Owner': [u'JohnDoe']},
+    }
+
+    queries = [
+        u'Status=Open',
+        u'Status=Closed',
+        u'Status=open',
+        u'Status=Open 100%',
+        u'Status=/^Op/',
+        u'Status=/.+/, Count>3',
+        u'Count>3',
+        u'Count<=4.5',
+        u'Count==12',
+        u'Count!=12',
+        u'Count==',
+        u'Address>10.0.0.3',
+        u'Owner=JohnDoe',
+        u'Nonexisting=1',
+        u'Nonexisting<1',
+    ]
+
+    def query_results(self, cls):
+        graphdata = self.use_graphdata(cls)
+        if not len(graphdata.keys()):
+            for pagename, metas in self.pages.items():
+                graphdata.set_page(self.request, pagename,
+                                   {pagename: {u'meta': metas}})
+            graphdata.commit()
+            # The shelve only lists the pages written when closing
+            graphdata.close()
+
+        results = dict()
+        for query in self.queries:
+            results[query] = metatable_parseargs(self.request, query)[0]
+        return results
+
+    def test_indexed_results(self):
+        indexed = self.query_results(sqlitedb.GraphData)
+        assert indexed == self.query_results(UnindexedGraphData)
+
+    def test_shelve_narrowed_order(self):
+        self.query_results(shelvedb.GraphData)
+        # Without an order index, the pages that have the key
+        pages = indexed_pages(self.request, {}, {},
+                              {u'Count': [(u'3', '>')]})
+        assert pages == set([u'QueryPageA', u'QueryPageB', u'QueryPageC',
+                             u'QueryPageD'])
+        pages = indexed_pages(self.request, {}, {},
+                              {u'Nonexisting': [(u'1', '<')]})
+        assert pages == set()
+
+    def test_shelve_indexed_results(self):
+        indexed = self.query_results(shelvedb.GraphData)
+        assert indexed == self.query_results(UnindexedGraphData)
+
+    def test_value_lookup(self):
+        graphdata = self.use_graphdata(sqlitedb.GraphData)
+        for pagename, metas in self.pages.items():
+            graphdata.set_page(self.request, pagename,
+                               {pagename: {u'meta': metas}})
+
+        assert graphdata.pages_with_key(u'Address') == \
+            set([u'QueryPageB', u'QueryPageC'])
+        assert graphdata.pages_with_value(u'Status', u'Open') == \
+            set([u'QueryPageA', u'QueryPageB'])
+        assert graphdata.pages_with_order(u'Address', '>', u'10.0.0.3') == \
+            set([u'QueryPageC'])
+        assert graphdata.pages_with_order(u'Count', '!=', u'3') is None
+
+
+class TestOrdering(GraphDataTests):
+    pages = {
+        u'OrderPageA': {u'Address': [u'10.0.0.10'], u'Count': [u'2', u'7']},
+        u'OrderPageB': {u'Address': [u'10.0.0.9'], u'Count': [u'7']},
+        u'OrderPageC': {u'Address': [u'9.0.0.1', u'10.0.0.1'],
+                        u'Count': [u'7']},
+        u'OrderPageD': {u'Count': [u'x']},
+    }
+
+    def check(self, orderspec, expected):
+        for cls in [sqlitedb.GraphData, UnindexedGraphData]:
+            graphdata = self.use_graphdata(cls)
+            for pagename, metas in self.pages.items():
+                graphdata.set_page(self.request, pagename,
+                                   {pagename: {u'meta': metas}})
+            args = u','.join(self.pages) + u',' + orderspec
+            assert metatable_parseargs(self.request, args)[0] == expected
+
+    def test_ascending(self):
+        self.check(u'<<Address', [u'OrderPageC', u'OrderPageB',
+                                  u'OrderPageA', u'OrderPageD'])
+
+    def test_descending(self):
+        # Pages without values go last in both directions
+        self.check(u'>>Address', [u'OrderPageA', u'OrderPageB',
+                                  u'OrderPageC', u'OrderPageD'])
+
+    def test_multiple_keys(self):
+        self.check(u'>>Count<<gwikipagename',
+                   [u'OrderPageD', u'OrderPageA', u'OrderPageB',
+                    u'OrderPageC'])
+        self.check(u'<<Count>>gwikipagename',
+                   [u'OrderPageA', u'OrderPageC', u'OrderPageB',
+                    u'OrderPageD'])
+
+
+class TestParseargsCache(GraphDataTests):
+
+    def parse(self, args):
+        return _metatable_parseargs(self.request, args, None, None)
+
+    def test_plan_reuse(self):
+        args = u'||<style="color: red">Status||!Count||, Status=Open, Count>3'
+        first = self.parse(args)
+        pagename = getattr(self.request.page, 'page_name', None)
+        assert (self.request.cfg.siteid, pagename, args) in _plan_cache
+
+        # Changes made by the caller do not leak to the cached plan
+        first[2].append(u'Other')
+        first[5][u'Status'].clear()
+        first[7][u'Count'].append((u'5', '<'))
+        first[9][u'Status'][u'style'] = u''
+
+        second = self.parse(args)
+        assert second[2] == [u'Status']
+        assert second[3] == [u'Count']
+        assert len(second[5][u'Status']) == 1
+        assert second[7][u'Count'] == [(u'3', '>')]
+        assert second[9][u'Status'] == {u'style': u'"color: red"'}
+
+    def test_page_regexp(self):
+        graphdata = self.use_graphdata(sqlitedb.GraphData)
+        for pagename in [u'QueryPageA', u'QueryPageB', u'QueryPageC']:
+            graphdata.set_page(self.request, pagename,
+                               {pagename: {u'meta': dict()}})
+
+        args = u'/^Query(Page[AB]|Regexp)/'
+        assert self.parse(args)[0] == set([u'QueryPageA', u'QueryPageB'])
+
+        # Changes not recorded in the edit log are not noticed ...
+        graphdata.set_page(self.request, u'QueryRegexp',
+                           {u'QueryRegexp': {u'meta': dict()}})
+        assert self.parse(args)[0] == set([u'QueryPageA', u'QueryPageB'])
+
+        # ... until the next edit
+        become_trusted(self.request)
+        create_page(self.request, u'QueryRegexpPage', u'Text\n')
+        try:
+            assert self.parse(args)[0] == set([u'QueryPageA', u'QueryPageB',
+                                               u'QueryRegexp',
+                                               u'QueryRegexpPage'])
+        finally:
+            nuke_page(self.request, u'QueryRegexpPage')
+
+
+class TestMetaTableDependencies(GraphDataTests):
+
+    def dependencies(self, args):
+        pagelist, metakeys, styles = metatable_parseargs(self.request, args)
+        return metatable_dependencies(self.request, args, pagelist, metakeys)
+
+    def test_affected_by(self):
+        graphdata = self.use_graphdata(sqlitedb.GraphData)
+        graphdata.set_page(self.request, u'DepPageA',
+                           {u'DepPageA': {u'meta': {u'Owner': [u'[[JohnDoe]]']},
+                                          u'out': {u'Owner': [u'JohnDoe']}}})
+        graphdata.set_page(self.request, u'DepPageB',
+                           {u'DepPageB': {u'meta': {u'Count': [u'2']}}})
+
+        deps = self.dependencies(u'DepPageA, /^DepRegexp/')
+        affected = lambda *names: deps.affected_by(self.request, names)
+        assert affected(u'DepPageA')
+        # Link targets, properties of the keys, and pages the regexp matches
+        assert affected(u'JohnDoe')
+        assert affected(u'OwnerProperty')
+        assert affected(u'DepRegexpPage')
+        # Groups may change what can be read
+        assert affected(u'SomeGroup')
+        assert not affected(u'DepPageB')
+
+        deps = self.dependencies(u'Count>1')
+        affected = lambda *names: deps.affected_by(self.request, names)
+        assert affected(u'DepPageB')
+        assert not affected(u'DepPageA')
+        graphdata.set_page(self.request, u'DepPageA',
+                           {u'DepPageA': {u'meta': {u'Count': [u'3']}}})
+        assert affected(u'DepPageA')
+
+        deps = self.dependencies(u'Count!=1')
+        assert deps.affected_by(self.request, [u'DepPageC'])
+
+        deps = self.dependencies(u'DepPageA, ||Owner->Count||')
+        assert deps.affected_by(self.request, [u'DepPageC'])
+
+    def test_macros(self):
+        graphdata = self.use_graphdata(sqlitedb.GraphData)
+        graphdata.set_page(self.request, u'DepPageA',
+                           {u'DepPageA': {u'meta': {u'Date': [u'<<Date>>']}}})
+        assert self.dependencies(u'DepPageA') is None
+        assert self.dependencies(u'DepPageA, ||Other||') is not None
+
+
+coverage_modules = ['MoinMoin.metadata.query']
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.wikitextutil Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+
+import py
+
+from MoinMoin import wikiutil
+from MoinMoin.Page import Page
+from MoinMoin.formatter.text_html import Formatter
+from MoinMoin.metadata import wikitextutil
+from MoinMoin.parser.text_moin_wiki import Parser
+
+
+class TestFormatWikitext(object):
+    values = [u'open', u'closed by admin', u'2010-12-18', u'a & b <c>',
+              u'FrontPage', u'[[/SubPage|sub]]', u"''emphasis''",
+              u'http://example.org/', u'a :) b', u'']
+
+    def setup_method(self, method):
+        self.page = self.request.page
+        self.formatter = self.request.formatter
+        self.request.page = Page(self.request, u'FormatWikitextPage')
+        self.request.formatter = Formatter(self.request)
+        self.request.page.formatter = self.request.formatter
+        self.request.wikitext_cache.clear()
+
+    def teardown_method(self, method):
+        self.request.page = self.page
+        self.request.formatter = self.formatter
+
+    def test_same_as_parser(self):
+        request = self.request
+        parser = Parser(u'', request)
+        for value in self.values:
+            expected = wikitextutil._format_wikitext(request, value)
+            assert wikitextutil.format_wikitext(request, value) == expected
+            # From the cache
+            assert wikitextutil.format_wikitext(request, value, parser) == expected
+
+    def test_cache(self):
+        request = self.request
+        out = wikitextutil.format_wikitext(request, u'[[/SubPage]]')
+        assert len(request.wikitext_cache) == 1
+
+        # Relative links depend on the page
+        request.page = Page(request, u'OtherPage')
+        assert wikitextutil.format_wikitext(request, u'[[/SubPage]]') != out
+        assert len(request.wikitext_cache) == 2
+
+        # Neither plain text nor macros are cached
+        wikitextutil.format_wikitext(request, u'plain text')
+        wikitextutil.format_wikitext(request, u'<<Date>>')
+        assert len(request.wikitext_cache) == 2
+
+
+class TestParseText(object):
+    """ wikitextutil: MetaScanner gives the data of the link_collect parser """
+    texts = [
+        u"#acl Known:read,write All:read\n#format wiki\n##comment\n"
+        u" key:: value\n other key:: [[Page|desc]] and FrontPage\n",
+        u" a:: 1\n b:: ''two'' __three__ \n  nested:: http://example.org/\n"
+        u"  * item [[Link]]\n c:: \n  * FrontPage\n  * SubPage/Child\n",
+        u"Text [[Other|key: value]] and [[Other|not a key]]\n"
+        u" * list [[attachment:file.txt]] {{drawing:x}}\n",
+        u" key:: <<Include(IncludedPage, , 2)>> <<Date>>\n"
+        u"<<Include(^Regex)>>\n",
+        u"||a||[[TableLink]]||\n||b|| key:: not meta||\n"
+        u" key:: ||cell||\n\n||c||\n",
+        u"{{{\n key:: in pre FrontPage\n}}}\n"
+        u"{{{#!wiki\n key:: in wiki [[WikiLink]]\n}}}\n"
+        u"{{{\n#!wiki red\n key:: value\n}}}\n"
+        u"{{{#!python\nx = [[NotALink]]\n}}}\n",
+        u" key:: !WikiName !OtherName and WikiName\n"
+        u" mail:: someone@example.org MoinMoin:FrontPage\n",
+        u"= Heading [[Link]] =\n key:: value\n----\n ::  continued\n"
+        u" 1. one\n a. two\n  :: empty\n",
+        u" key:: `code` {{{inline}}} ^sup^ ,,sub,, --(strike)-- "
+        u"~+big+~ &amp; /* remark */\n",
+        u" key:: [[#anchor]] [[/Sub#a]] [[../Up]] [[http://example.org/#x]]\n",
+        u"Text\n\n----\nCategoryTest CategoryOther\n\n##comment\n",
+        u"CategoryTest\nMore text\n",
+        u"line\rCategoryTest\n",
+        u"#\n#acl All:\n\tkey:: tabbed\n",
+        u"",
+    ]
+
+    def setup_method(self, method):
+        self.page = self.request.page
+
+    def teardown_method(self, method):
+        self.request.page = self.page
+
+    def check(self, pagename, text):
+        request = self.request
+        page = Page(request, pagename)
+        expected = wikitextutil._parse_text_with_parser(request, page, text)
+        assert wikitextutil.parse_text(request, page, text) == expected
+
+    def test_texts(self):
+        for text in self.texts:
+            self.check(u'ParseTextPage/Sub', text)
+
+    def test_testpages(self):
+        """ wikitextutil: parse_text on the pages of the test wiki """
+        path = os.path.join(os.path.dirname(wikiutil.__file__), os.pardir,
+                            'testpages')
+        if not os.path.isdir(path):
+            py.test.skip("no test pages")
+
+        for name in sorted(os.listdir(path)):
+            pagedir = os.path.join(path, name)
+            try:
+                rev = open(os.path.join(pagedir, 'current')).read().strip()
+                text = open(os.path.join(pagedir, 'revisions', rev)).read()
+            except IOError:
+                continue
+            self.check(wikiutil.unquoteWikiname(name), text.decode('utf-8'))
+
+
+coverage_modules = ['MoinMoin.metadata.wikitextutil']
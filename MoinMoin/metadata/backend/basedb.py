@@ -1,5 +1,7 @@
 import UserDict
 
+from MoinMoin.metadata.query import ordervalue_key
+
 class GraphDataBase(UserDict.DictMixin):
     # Does this backend promise that operations provided by
     # this API are ACID and commit/abort work?
@@ -37,7 +39,30 @@ class GraphDataBase(UserDict.DictMixin):
 
     def close(self):
         raise NotImplementedError()
- 
+
+    # Savepoints in the uncommitted changes, so that a failed part of a
+    # larger change can be undone without the rest of it. Backends that
+    # do not do transactions keep all changes.
+
+    def savepoint(self):
+        """
+        Mark the current state of the uncommitted changes, return a
+        token for rollback_to and release
+        """
+        return None
+
+    def rollback_to(self, savepoint):
+        """
+        Undo the changes made after the savepoint, and forget it
+        """
+        pass
+
+    def release(self, savepoint):
+        """
+        Forget the savepoint, keeping the changes made after it
+        """
+        pass
+
     def getpage(self, pagename):
         # Always read data here regardless of user rights,
         # they should be handled elsewhere.
@@ -54,19 +79,131 @@ class GraphDataBase(UserDict.DictMixin):
         Return the complete set of page's (non-link) meta keys, plus gwiki category.
         """
         raise NotImplementedError()
- 
+
     def get_meta(self, pagename):
         raise NotImplementedError()
 
     def get_in(self, pagename):
         return self.getpage(pagename).get(u'in', {})
-       
+
     def get_out(self, pagename):
         return self.getpage(pagename).get(u'out', {})
 
+    def iter_in(self, pagename):
+        """
+        Generate the (linktype, source page) in-links of the page
+        """
+        for linktype, sources in self.get_in(pagename).iteritems():
+            for src in sources:
+                yield linktype, src
+
+    def has_in(self, pagename):
+        for edge in self.iter_in(pagename):
+            return True
+        return False
+
     def post_save(self, pagename):
         pass
 
+    # Value indexes for metatable queries. Each returns a set of
+    # candidate pages, possibly including pages that do not match, or
+    # None if the backend has no index for the lookup.
+
+    def pages_with_key(self, key):
+        return None
+
+    def pages_with_value(self, key, value):
+        return None
+
+    def pages_with_order(self, key, op, comp):
+        return None
+
+    def get_sort_keys(self, pagenames, key):
+        """
+        Return a dict with the ordervalue_key() sort keys of the values
+        of key on each of the given pages. Backends can store the sort
+        keys when saving pages, this computes them from the metas.
+        """
+        result = dict()
+        for pagename in pagenames:
+            values = self.get_meta(pagename).get(key, list())
+            result[pagename] = map(ordervalue_key, values)
+        return result
+
+    def get_acls(self, pagenames):
+        """
+        Return a dict with the stored ACL strings of those of the given
+        pages that are saved, see security.may_read_many
+        """
+        result = dict()
+        for pagename in pagenames:
+            pagedata = self.getpage(pagename)
+            if pagedata.get(u'saved', False):
+                result[pagename] = pagedata.get(u'acl', u'')
+        return result
+
+    # Position of the global edit log up to which the pages have been
+    # synced into this database, see metadata.edit.sync_graphdata
+
+    def get_sync_position(self):
+        """
+        Return the recorded edit log position, or None if not recorded
+        """
+        raise NotImplementedError()
+
+    def set_sync_position(self, position):
+        raise NotImplementedError()
+
+    # Change feed. Every change to the data of a page, including its
+    # in-links, gives the page a new version number that is greater
+    # than those of all earlier changes.
+
+    def get_version(self):
+        """
+        Return the version of the latest change, 0 if none
+        """
+        raise NotImplementedError()
+
+    def changes_since(self, version):
+        """
+        Return the names of the pages changed or removed after the
+        given version, and the current version. Pages not changed
+        since the feed was started are not included.
+        """
+        raise NotImplementedError()
+
+    def has_pending_changes(self):
+        """
+        Return whether there are changes not yet committed, and thus
+        not yet final in the change feed
+        """
+        raise NotImplementedError()
+
+    # Rebuilding the data in a side database, eg. when rehashing,
+    # without disturbing the users of this one
+
+    def side_copy(self, suffix='.rehash'):
+        """
+        Return an empty database of the same backend, stored next to
+        this one with the given suffix
+        """
+        raise NotImplementedError()
+
+    def replace_with(self, side, catch_up=None):
+        """
+        Atomically replace all the data with that of a side copy. If
+        given, catch_up(self) is called after the data is replaced,
+        while no one else can see or change it yet, to make the
+        changes done meanwhile.
+        """
+        raise NotImplementedError()
+
+    def drop(self):
+        """
+        Close the database and remove its files
+        """
+        raise NotImplementedError()
+
     def get_vals_on_keys(self):
         self.reverse_meta()
         return self.vals_on_keys
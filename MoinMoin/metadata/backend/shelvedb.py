@@ -7,19 +7,117 @@ This is the original gwiki backend. It's slow, it occasionally
 corrupts itself and it's pessimal at concurrency (uses a lock file).
 Needless to say, it doesn't do ACID.
 
+In-links are not kept in the page records but in separate segment
+records per page and link type, so that linking to a page with lots
+of in-links (eg. a category) does not rewrite all of them. A segment
+is split in two once it grows over SEGMENT_SIZE links.
+
+The pages with each meta key, and with each value of a key, are kept
+in segment records like the in-links, for the value indexes of
+metatable queries. Linked values, eg. [[Page|text]], are also indexed
+by what they link to. Shelves made before the indexes were kept are
+not used for lookups until rehashed, as the pages saved to them
+earlier are not in the indexes.
+
+The pages changed in a close() all get the same new version number,
+given while holding the write lock. The pages last changed in each
+range of CHANGES_CHUNK versions are kept in one change record.
+
+The records read are kept in a snapshot shared by all the requests of
+the process. Each close() that writes anything stores a new generation
+in the lock file while holding the write lock, so a request holding
+the read lock can tell from the lock file alone whether the snapshot
+of its process is still valid, even if the writer was another process.
+The shelve itself is only opened to read the records not in the
+snapshot. Records may thus be shared by many requests: they are copied
+before being modified.
+
+A savepoint keeps a copy of the dicts of the uncommitted changes. The
+records in them are shared with the changes made after the savepoint,
+so records that were in the changes when a savepoint was taken are
+copied again before being modified.
 """
+import re
 import shelve
 import random
 import errno
 import fcntl
 import os
+import copy
+import threading
 
 from basedb import GraphDataBase
-from MoinMoin.metadata.constants import NO_TYPE
-from MoinMoin.metadata.util import (encode_page, decode_page, 
+from MoinMoin.metadata.constants import NO_TYPE, CATEGORY_KEY
+from MoinMoin.metadata.query import (ordervalue_key, meta_sort_keys,
+                                     SORT_KEY_VERSION)
+from MoinMoin.metadata.util import (encode_page, decode_page,
                                     node_type, log)
+from MoinMoin.util.lru import LRUCache
 
 from time import time, sleep
+from zlib import crc32
+
+# Shelve keys of in-link segments, page names never start with NUL
+IN_PREFIX = '\x00in\x00'
+SEGMENT_SIZE = 512
+MAX_SEGMENT_BITS = 16
+
+# Shelve keys of the value indexes, with the number of bits of the
+# segments of a key or value, and the segments
+INDEX_PREFIX = '\x00index\x00'
+
+# Shelve keys of the state of the database itself
+STATE_PREFIX = '\x00state\x00'
+SYNC_POSITION = STATE_PREFIX + 'sync'
+# Set in shelves that have all their pages in the value indexes
+INDEXED = STATE_PREFIX + 'indexed'
+VERSION = STATE_PREFIX + 'version'
+CHANGES_PREFIX = STATE_PREFIX + 'changes\x00'
+CHANGES_CHUNK = 1024
+
+# Keys of records that are not pages
+INTERNAL_PREFIXES = (IN_PREFIX, INDEX_PREFIX, STATE_PREFIX)
+
+# Possible ends of the link in a value, eg. [[Page]] or [[Page|text]]
+LINK_END_RE = re.compile(r'(?=\]\]|\|)')
+
+# Files the dbm modules may use for a shelve
+DBM_SUFFIXES = ['', '.db', '.dat', '.dir', '.bak', '.pag']
+
+# Number of records kept in the snapshot of each shelve
+SNAPSHOT_SIZE = 8192
+
+_missing = object()
+
+def _linked_values(value):
+    "Return the values a meta value may link to"
+    result = list()
+    start = value.find(u'[[')
+    while start >= 0:
+        rest = value[start + 2:]
+        for match in LINK_END_RE.finditer(rest):
+            result.append(rest[:match.start()])
+        start = value.find(u'[[', start + 2)
+    return result
+
+def _index_terms(pagedata):
+    "Return the (key, ) and (key, value) terms a page is indexed by"
+    metas = dict(pagedata.get(u'meta', dict()))
+    categories = pagedata.get(u'out', dict()).get(CATEGORY_KEY, list())
+    if categories:
+        metas[CATEGORY_KEY] = list(metas.get(CATEGORY_KEY, list()))
+        metas[CATEGORY_KEY].extend(categories)
+
+    terms = set()
+    for key, values in metas.iteritems():
+        if not values:
+            continue
+        terms.add((key, ))
+        for value in values:
+            terms.add((key, value))
+            for linked in _linked_values(value):
+                terms.add((key, linked))
+    return terms
 
 class LockTimeout(Exception):
     pass
@@ -88,19 +186,61 @@ class _Lock(object):
         self._fd = None
         return True
 
+    def read_generation(self):
+        "Return the generation stored in the lock file, '' if none"
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, 64)
+
+    def write_generation(self, generation):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, generation)
+        os.ftruncate(self._fd, len(generation))
+
+class _Snapshot(object):
+    "Records of a shelve as of one generation"
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.records = LRUCache(SNAPSHOT_SIZE)
+
+_snapshots = dict()
+_snapshots_lock = threading.Lock()
+
+def _get_snapshot(graphshelve, generation):
+    if not generation:
+        # Not written since the lock file was made
+        return None
+
+    _snapshots_lock.acquire()
+    try:
+        snapshot = _snapshots.get(graphshelve)
+        if snapshot is None or snapshot.generation != generation:
+            snapshot = _Snapshot(generation)
+            _snapshots[graphshelve] = snapshot
+        return snapshot
+    finally:
+        _snapshots_lock.release()
+
 class GraphData(GraphDataBase):
     is_acid = False
 
     UNDEFINED = object()
 
-    def __init__(self, request, **kw):
+    def __init__(self, request, graphshelve=None, **kw):
         log.debug("shelve graphdb init")
         GraphDataBase.__init__(self, request, **kw)
 
         gddir = os.path.join(request.cfg.data_dir, 'graphdata')
         if not os.path.isdir(gddir):
             os.mkdir(gddir)
-        self.graphshelve = os.path.join(gddir, 'graphdata.shelve')
+
+        lock_path = os.path.join(gddir, "graphdata-lock")
+        if graphshelve is None:
+            graphshelve = os.path.join(gddir, 'graphdata.shelve')
+        else:
+            # Other shelves do not share the lock of the wiki's shelve
+            lock_path = graphshelve + '-lock'
+        self.graphshelve = graphshelve
 
         self.use_sq_dict = getattr(request.cfg, 'use_sq_dict', False)
         if self.use_sq_dict:
@@ -109,35 +249,83 @@ class GraphData(GraphDataBase):
         else:
             self.shelveopen = shelve.open
 
-        # XXX (falsely) assumes shelve.open creates file with same name;
-        # it happens to work with the bsddb backend.
-        if not os.path.exists(self.graphshelve):
+        # The dbm modules name their files differently. A new shelve
+        # has all its pages in the value indexes.
+        exists = [x for x in DBM_SUFFIXES
+                  if os.path.exists(self.graphshelve + x)]
+        if not exists:
             db = self.shelveopen(self.graphshelve, 'c')
+            db[INDEXED] = True
             db.close()
 
         self.db = None
         self.cache = dict()
+        # The shared snapshot valid for the lock held, if any
+        self._snapshot = None
         self.out = dict()
+        # Keys of the pages changed since the last close
+        self.changed = set()
+        # The index terms of the changed pages
+        self._terms = dict()
+        # (token, state) of the savepoints, and the ids of the records
+        # they refer to
+        self._savepoints = list()
+        self._saved_ids = set()
 
-        lock_path = os.path.join(gddir, "graphdata-lock")
         self._lock_timeout = getattr(request.cfg, 'graphdata_lock_timeout', None)
         self._readlock = _Lock(lock_path, exclusive=False)
         self._writelock = _Lock(lock_path, exclusive=True)
 
     def __getitem__(self, item):
-        page = encode_page(item)
+        return self._get_raw(encode_page(item))
 
-        if page in self.out:
-            if self.out[page] is self.UNDEFINED:
-                raise KeyError(page)
-            return self.out[page]
+    def _get_raw(self, key):
+        if key in self.out:
+            if self.out[key] is self.UNDEFINED:
+                raise KeyError(key)
+            return self.out[key]
 
-        if page in self.cache:
-            return self.cache[page]
+        if key in self.cache:
+            return self.cache[key]
 
         self.readlock()
-        self.cache[page] = self.db[page]
-        return self.cache[page]
+        records = None
+        if self._snapshot is not None:
+            records = self._snapshot.records
+            value = records.get(key, _missing)
+            if value is self.UNDEFINED:
+                raise KeyError(key)
+            if value is not _missing:
+                self.cache[key] = value
+                return value
+
+        try:
+            value = self._open()[key]
+        except KeyError:
+            if records is not None:
+                records[key] = self.UNDEFINED
+            raise
+
+        if records is not None:
+            records[key] = value
+        self.cache[key] = value
+        return value
+
+    def _get_copy(self, key):
+        "Return a record that this instance may modify"
+        if key in self.out:
+            value = self.out[key]
+            if value is self.UNDEFINED:
+                raise KeyError(key)
+            if id(value) not in self._saved_ids:
+                return value
+        return copy.deepcopy(self._get_raw(key))
+
+    def _getpage_copy(self, pagename):
+        try:
+            return self._get_copy(encode_page(pagename))
+        except KeyError:
+            return dict()
 
     def __setitem__(self, item, value):
         self.savepage(item, value)
@@ -146,8 +334,10 @@ class GraphData(GraphDataBase):
         log.debug("savepage %s = %s" % (repr(pagename), repr(pagedict)))
         page = encode_page(pagename)
 
+        self._reindex(pagename, page, _index_terms(pagedict))
         self.out[page] = pagedict
         self.cache.pop(page, None)
+        self.changed.add(page)
 
     def is_saved(self, pagename):
         return self.getpage(pagename).get('saved', False)
@@ -156,7 +346,28 @@ class GraphData(GraphDataBase):
         return self.getpage(pagename).get(u'out', {})
 
     def get_in(self, pagename):
-        return self.getpage(pagename).get(u'in', {})
+        result = dict()
+        for linktype, src in self.iter_in(pagename):
+            result.setdefault(linktype, list()).append(src)
+        return result
+
+    def iter_in(self, pagename):
+        pagedata = self.getpage(pagename)
+
+        # Records saved before in-links were segmented
+        for linktype, sources in pagedata.get(u'in', dict()).iteritems():
+            for src in sources:
+                yield linktype, src
+
+        for linktype, bits in pagedata.get(u'insegs', dict()).items():
+            for segment in range(1 << bits):
+                key = self._segment_key(pagename, linktype, segment)
+                try:
+                    sources = self._get_raw(key)
+                except KeyError:
+                    continue
+                for src in sources:
+                    yield linktype, src
 
     def get_meta(self, pagename):
         return self.getpage(pagename).get(u'meta', {})
@@ -186,16 +397,27 @@ class GraphData(GraphDataBase):
         self.delpage(item)
 
     def delpage(self, pagename):
-        log.debug("delpage %s" % (repr(pagename),))
+        log.debug("delpage %s" % (repr(pagename), ))
         page = encode_page(pagename)
 
+        insegs = self.getpage(pagename).get(u'insegs', dict())
+        for linktype, bits in insegs.iteritems():
+            for segment in range(1 << bits):
+                key = self._segment_key(pagename, linktype, segment)
+                self.out[key] = self.UNDEFINED
+                self.cache.pop(key, None)
+
+        self._reindex(pagename, page, set())
         self.out[page] = self.UNDEFINED
         self.cache.pop(page, None)
+        self.changed.add(page)
 
     def __iter__(self):
-        self.readlock()
+        db = self._open()
 
-        for key in self.db.keys():
+        for key in db.keys():
+            if key.startswith(INTERNAL_PREFIXES):
+                continue
             if self.out.get(key, None) is self.UNDEFINED:
                 continue
             yield decode_page(key)
@@ -205,58 +427,407 @@ class GraphData(GraphDataBase):
 
     def __contains__(self, item):
         page = encode_page(item)
+        if page.startswith(INTERNAL_PREFIXES):
+            return False
 
         if page in self.out:
             return self.out[page] is not self.UNDEFINED
 
-        if page in self.cache:
-            return True
+        try:
+            self._get_raw(page)
+        except KeyError:
+            return False
+        return True
 
-        self.readlock()
-        return page in self.db
+    def get_sort_keys(self, pagenames, key):
+        result = dict()
+        for pagename in pagenames:
+            pagedata = self.getpage(pagename)
+            if pagedata.get(u'sortkey_version') == SORT_KEY_VERSION:
+                result[pagename] = pagedata[u'sortkeys'].get(key, list())
+                continue
+
+            # Saved before sort keys were stored with the page, or
+            # with an older encoding of them
+            values = pagedata.get(u'meta', dict()).get(key, list())
+            result[pagename] = map(ordervalue_key, values)
+        return result
+
+    def savepoint(self):
+        token = object()
+        state = (dict(self.out), set(self.changed), dict(self.cache),
+                 dict(self._terms))
+        self._savepoints.append((token, state))
+        self._saved_ids.update(id(value) for value in self.out.itervalues())
+        return token
+
+    def _pop_savepoint(self, token):
+        for index, (other, state) in enumerate(self._savepoints):
+            if other is token:
+                del self._savepoints[index:]
+                if not self._savepoints:
+                    self._saved_ids = set()
+                return state
+        return None
+
+    def rollback_to(self, savepoint):
+        state = self._pop_savepoint(savepoint)
+        if state is not None:
+            out, changed, cache, terms = state
+            self.out = dict(out)
+            self.changed = set(changed)
+            self.cache = dict(cache)
+            self._terms = dict(terms)
+
+    def release(self, savepoint):
+        self._pop_savepoint(savepoint)
+
+    def _forget_savepoints(self):
+        self._savepoints = list()
+        self._saved_ids = set()
+
+    def get_sync_position(self):
+        try:
+            return self._get_raw(SYNC_POSITION)
+        except KeyError:
+            return None
+
+    def set_sync_position(self, position):
+        self.cache.pop(SYNC_POSITION, None)
+        self.out[SYNC_POSITION] = position
+
+    def get_version(self):
+        try:
+            return self._get_raw(VERSION)
+        except KeyError:
+            return 0
+
+    def changes_since(self, version):
+        current = self.get_version()
+
+        changed = set()
+        for chunk in range(version // CHANGES_CHUNK,
+                           current // CHANGES_CHUNK + 1):
+            try:
+                records = self._get_raw(CHANGES_PREFIX + str(chunk))
+            except KeyError:
+                continue
+            for pagename, changed_version in records.iteritems():
+                if changed_version > version:
+                    changed.add(pagename)
+
+        return changed, current
+
+    def has_pending_changes(self):
+        # The changed pages get their versions when closing
+        return bool(self.changed or self.out)
+
+    def _write_changes(self):
+        "Give the changed pages a new version, under the write lock"
+
+        version = self.db.get(VERSION, 0) + 1
+        self.out[VERSION] = version
+
+        chunks = dict()
+        def chunk(number):
+            key = CHANGES_PREFIX + str(number)
+            if key not in chunks:
+                chunks[key] = self.db.get(key, dict())
+            return chunks[key]
+
+        for page in self.changed:
+            pagename = decode_page(page)
+
+            # Forget the earlier change of the page
+            old = self.db.get(page, None)
+            if old is not None and u'version' in old:
+                chunk(old[u'version'] // CHANGES_CHUNK).pop(pagename, None)
+            chunk(version // CHANGES_CHUNK)[pagename] = version
+
+            pagedata = self.out.get(page, old)
+            if pagedata is not None and pagedata is not self.UNDEFINED:
+                pagedata[u'version'] = version
+                self.out[page] = pagedata
+
+        for key, records in chunks.iteritems():
+            if records:
+                self.out[key] = records
+            else:
+                self.out[key] = self.UNDEFINED
+
+        self.changed = set()
+
+    def _segment_key(self, pagename, linktype, segment):
+        return "%s%s\x00%s\x00%d" % (IN_PREFIX, encode_page(pagename),
+                                      encode_page(linktype), segment)
+
+    def _segment_of(self, src, bits):
+        return crc32(encode_page(src)) & ((1 << bits) - 1)
+
+    def _set_segment(self, key, sources):
+        self.cache.pop(key, None)
+        if sources:
+            self.out[key] = sources
+        else:
+            self.out[key] = self.UNDEFINED
+
+    def _segment_in(self, pagename, pagedata):
+        "Move in-links of records saved before segmenting to segments"
+
+        legacy = pagedata.pop(u'in', None)
+        if not legacy:
+            return
+
+        insegs = pagedata.setdefault(u'insegs', dict())
+        for linktype, sources in legacy.iteritems():
+            bits = insegs.setdefault(linktype, 0)
+            key = self._segment_key(pagename, linktype, 0)
+            self._set_segment(key, list(sources))
+            while (bits < MAX_SEGMENT_BITS and
+                   len(sources) >> bits > SEGMENT_SIZE):
+                self._split_in(pagename, linktype, insegs)
+                bits = insegs[linktype]
+
+    def _split_in(self, pagename, linktype, insegs):
+        "Double the number of in-link segments of a link type"
+
+        bits = insegs[linktype]
+        sources = list()
+        for segment in range(1 << bits):
+            key = self._segment_key(pagename, linktype, segment)
+            try:
+                sources.extend(self._get_raw(key))
+            except KeyError:
+                pass
+
+        bits += 1
+        segments = [list() for x in range(1 << bits)]
+        for src in sources:
+            segments[self._segment_of(src, bits)].append(src)
+
+        for segment, sources in enumerate(segments):
+            key = self._segment_key(pagename, linktype, segment)
+            self._set_segment(key, sources)
+
+        insegs[linktype] = bits
+
+    # Value indexes
+
+    def _index_key(self, term):
+        "Shelve key of the number of segment bits of an index term"
+        if len(term) == 1:
+            return "%sk\x00%s" % (INDEX_PREFIX, encode_page(term[0]))
+        return "%sv\x00%s\x00%s" % (INDEX_PREFIX, encode_page(term[0]),
+                                      encode_page(term[1]))
+
+    def _set_bits(self, key, bits):
+        self.cache.pop(key, None)
+        if bits is None:
+            self.out[key] = self.UNDEFINED
+        else:
+            self.out[key] = bits
+
+    def _index_pages(self, term):
+        key = self._index_key(term)
+        try:
+            bits = self._get_raw(key)
+        except KeyError:
+            return set()
+
+        pages = set()
+        for segment in range(1 << bits):
+            try:
+                pages.update(self._get_raw("%s\x00%d" % (key, segment)))
+            except KeyError:
+                pass
+        return pages
+
+    def _index_add(self, term, pagename):
+        key = self._index_key(term)
+        try:
+            bits = self._get_raw(key)
+        except KeyError:
+            bits = 0
+            self._set_bits(key, bits)
+
+        segkey = "%s\x00%d" % (key, self._segment_of(pagename, bits))
+        try:
+            pages = self._get_copy(segkey)
+        except KeyError:
+            pages = list()
+        pages.append(pagename)
+        self._set_segment(segkey, pages)
+
+        if len(pages) > SEGMENT_SIZE and bits < MAX_SEGMENT_BITS:
+            # Double the number of segments
+            pages = self._index_pages(term)
+            bits += 1
+            segments = [list() for x in range(1 << bits)]
+            for page in pages:
+                segments[self._segment_of(page, bits)].append(page)
+            for segment, pages in enumerate(segments):
+                self._set_segment("%s\x00%d" % (key, segment), pages)
+            self._set_bits(key, bits)
+
+    def _index_remove(self, term, pagename):
+        key = self._index_key(term)
+        try:
+            bits = self._get_raw(key)
+        except KeyError:
+            return
+
+        segkey = "%s\x00%d" % (key, self._segment_of(pagename, bits))
+        try:
+            pages = self._get_copy(segkey)
+        except KeyError:
+            return
+
+        if pagename in pages:
+            pages.remove(pagename)
+            self._set_segment(segkey, pages)
+
+        if not pages and not bits:
+            self._set_bits(key, None)
+
+    def _reindex(self, pagename, page, terms):
+        "Move a page from the index terms it had to the given ones"
+        old = self._terms.get(page, None)
+        if old is None:
+            try:
+                old = _index_terms(self._get_raw(page))
+            except KeyError:
+                old = set()
+
+        for term in old - terms:
+            self._index_remove(term, pagename)
+        for term in terms - old:
+            self._index_add(term, pagename)
+        self._terms[page] = terms
+
+    def _is_indexed(self):
+        try:
+            return self._get_raw(INDEXED)
+        except KeyError:
+            return False
+
+    def pages_with_key(self, key):
+        if not self._is_indexed():
+            return None
+        return self._index_pages((key, ))
+
+    def pages_with_value(self, key, value):
+        if not self._is_indexed():
+            return None
+        return self._index_pages((key, value))
 
     def set_page_meta(self, pagename, newmeta):
-        pagedata = self.getpage(pagename)
+        pagedata = self._getpage_copy(pagename)
         pagedata[u'meta'] = newmeta
+        pagedata[u'sortkeys'] = meta_sort_keys(newmeta)
+        pagedata[u'sortkey_version'] = SORT_KEY_VERSION
         self.savepage(pagename, pagedata)
 
     def set_acl(self, pagename, acl):
-        pagedata = self.getpage(pagename)
+        pagedata = self._getpage_copy(pagename)
         pagedata[u'acl'] = acl
         self.savepage(pagename, pagedata)
 
     def set_saved(self, pagename, saved, mtime):
-        pagedata = self.getpage(pagename)
+        pagedata = self._getpage_copy(pagename)
         pagedata[u'mtime'] = mtime
         pagedata[u'saved'] = saved
         self.savepage(pagename, pagedata)
 
     def clear_page(self, pagename):
-        if self.get_in(pagename):
-            pagedata = self.getpage(pagename)
+        if self.has_in(pagename):
+            pagedata = self._getpage_copy(pagename)
             pagedata[u'saved'] = False
             pagedata[u'meta'] = dict()
+            pagedata[u'sortkeys'] = dict()
             pagedata[u'out'] = dict()
             self.savepage(pagename, pagedata)
         else:
             self.delpage(pagename)
 
+    def side_copy(self, suffix='.rehash'):
+        return GraphData(self.request, graphshelve=self.graphshelve + suffix)
+
+    def replace_with(self, side, catch_up=None):
+        side.close()
+
+        # Readers and writers open the shelve only while holding the
+        # lock, so they see either the old or the new one
+        self.writelock()
+        try:
+            self.out = dict()
+            self._terms = dict()
+            self.cache.clear()
+
+            # The versions keep growing over the swap, and all the
+            # pages of both the old and the new data have changed
+            version = self.db.get(VERSION, 0)
+            changed = set(self.db.keys())
+
+            self.db.close()
+            self.db = None
+            for suffix in DBM_SUFFIXES:
+                path = self.graphshelve + suffix
+                if os.path.exists(side.graphshelve + suffix):
+                    os.rename(side.graphshelve + suffix, path)
+                elif os.path.exists(path):
+                    os.unlink(path)
+
+            self.db = self.shelveopen(self.graphshelve, "c")
+            changed.update(self.db.keys())
+            self.db[VERSION] = max(version, self.db.get(VERSION, 0))
+            self.changed = set(x for x in changed
+                               if not x.startswith(INTERNAL_PREFIXES))
+
+            # Still holding the write lock
+            if catch_up is not None:
+                self._snapshot = None
+                catch_up(self)
+        finally:
+            self.close()
+
+        side.drop()
+
+    def drop(self):
+        self.out = dict()
+        self._terms = dict()
+        self.changed = set()
+        self.close()
+
+        for suffix in DBM_SUFFIXES + ['-lock']:
+            try:
+                os.unlink(self.graphshelve + suffix)
+            except OSError:
+                pass
+
     def readlock(self):
         if self._writelock.is_locked():
             return
         if self._readlock.is_locked():
             return
 
-        log.debug("getting a read lock for %r" % (self.graphshelve,))
+        log.debug("getting a read lock for %r" % (self.graphshelve, ))
         try:
             self._readlock.acquire(self._lock_timeout)
         except LockTimeout:
             items = self.graphshelve, self._lock_timeout
             log.error("getting a read lock for %r timed out after %.02fs" % items)
             raise
-        log.debug("got a read lock for %r" % (self.graphshelve,))
+        log.debug("got a read lock for %r" % (self.graphshelve, ))
 
-        self.db = self.shelveopen(self.graphshelve, "r")
+        self._snapshot = _get_snapshot(self.graphshelve,
+                                       self._readlock.read_generation())
+
+    def _open(self):
+        "Return the shelve, opened for reading if not already open"
+        self.readlock()
+        if self.db is None:
+            self.db = self.shelveopen(self.graphshelve, "r")
+        return self.db
 
     def writelock(self):
         if self._writelock.is_locked():
@@ -267,23 +838,29 @@ class GraphData(GraphDataBase):
                 self.db.close()
                 self.db = None
             self._readlock.release()
-            log.debug("released a write lock for %r" % (self.graphshelve,))
+            log.debug("released a write lock for %r" % (self.graphshelve, ))
 
-        log.debug("getting a write lock for %r" % (self.graphshelve,))
+        log.debug("getting a write lock for %r" % (self.graphshelve, ))
         try:
             self._writelock.acquire(self._lock_timeout)
         except LockTimeout:
             items = self.graphshelve, self._lock_timeout
             log.error("getting a write lock for %r timed out after %.02fs" % items)
             raise
-        log.debug("got a write lock for %r" % (self.graphshelve,))
+        log.debug("got a write lock for %r" % (self.graphshelve, ))
 
+        # Others may have written between the locks
+        self._snapshot = _get_snapshot(self.graphshelve,
+                                       self._writelock.read_generation())
         self.db = self.shelveopen(self.graphshelve, "c")
 
     def close(self):
-        if self.out:
+        if self.out or self.changed:
             self.writelock()
 
+            if self.changed:
+                self._write_changes()
+
             for key, value in self.out.items():
                 if value is self.UNDEFINED:
                     self.db.pop(key, None)
@@ -291,22 +868,30 @@ class GraphData(GraphDataBase):
                     self.db[key] = value
 
             self.out = dict()
+            self._terms = dict()
+
+            # Invalidate the snapshots of all processes
+            generation = '%x' % (random.getrandbits(64), )
+            self._writelock.write_generation(generation)
+            _get_snapshot(self.graphshelve, generation)
 
         self.cache.clear()
+        self._snapshot = None
+        self._forget_savepoints()
 
         if self.db is not None:
             self.db.close()
             self.db = None
 
         if self._writelock.release():
-            log.debug("released a write lock for %r" % (self.graphshelve,))
+            log.debug("released a write lock for %r" % (self.graphshelve, ))
         else:
-            log.debug("did not release any write locks for %r" % (self.graphshelve,))
+            log.debug("did not release any write locks for %r" % (self.graphshelve, ))
 
         if self._readlock.release():
-            log.debug("released a read lock for %r" % (self.graphshelve,))
+            log.debug("released a read lock for %r" % (self.graphshelve, ))
         else:
-            log.debug("did not released any read locks for %r" % (self.graphshelve,))
+            log.debug("did not released any read locks for %r" % (self.graphshelve, ))
 
     def set_page(self, request, pagename, new_data):
         # Get a copy of current data
@@ -416,7 +1001,7 @@ class GraphData(GraphDataBase):
 
         # Adding and removing in-links are the most expensive operation in a
         # shelve, so we'll try to minimise them. Eg. if page TestPage is
-        #  a:: ["b"]\n a:: ["a"] 
+        #  a:: ["b"]\n a:: ["a"]
         # and it is resaved as
         #  a:: ["a"]\n a:: ["b"]
         # the ordering of out-links in TestPage changes, but we do not have
@@ -442,7 +1027,7 @@ class GraphData(GraphDataBase):
 
                 change_count = add_count - del_count
 
-                # If in-links added and deleted as many times, 
+                # If in-links added and deleted as many times,
                 # there are effectively no changes to be saved
                 if change_count == 0:
                     for x in range(add_count):
@@ -495,35 +1080,46 @@ class GraphData(GraphDataBase):
     def _remove_in(self, (frm, to), linktype):
         "Remove in-links from local nodes to current node"
 
-        temp = self.getpage(to)
-        if not temp.has_key(u'in'):
+        temp = self._getpage_copy(to)
+        self._segment_in(to, temp)
+        insegs = temp.get(u'insegs', dict())
+        if not insegs:
             return
 
         for type in linktype:
-            # sys.stderr.write("Removing %s %s %s\n" % (frm, to, linktype))
             # eg. when the shelve is just started, it's empty
-            if not temp[u'in'].has_key(type):
-                # sys.stderr.write("No such type: %s\n" % type)
+            if not insegs.has_key(type):
                 continue
-            if frm in temp[u'in'][type]:
-                temp[u'in'][type].remove(frm)
+
+            bits = insegs[type]
+            key = self._segment_key(to, type, self._segment_of(frm, bits))
+            try:
+                sources = self._get_copy(key)
+            except KeyError:
+                sources = list()
+
+            if frm in sources:
+                sources.remove(frm)
+                self._set_segment(key, sources)
 
                 # Notification that the destination has changed
                 temp[u'mtime'] = time()
 
-            if not temp[u'in'][type]:
-                del temp[u'in'][type]
+            if not sources and not bits:
+                del insegs[type]
+
+        if not insegs:
+            del temp[u'insegs']
 
-        # sys.stderr.write("Hey man, I think I did it!\n")
         self[to] = temp
 
     def _remove_out(self, (frm, to), linktype):
         "remove outlinks"
 
-        temp = self.get(frm, {})
+        temp = self._getpage_copy(frm)
 
         if not temp.has_key(u'out'):
-            return 
+            return
 
         for type in linktype:
             # print "Removing %s %s %s" % (frm, to, linktype)
@@ -550,14 +1146,22 @@ class GraphData(GraphDataBase):
         if not linktype:
             linktype = NO_TYPE
 
-        temp = self.get(to, {})
+        temp = self._getpage_copy(to)
+        self._segment_in(to, temp)
+        insegs = temp.setdefault(u'insegs', dict())
+        bits = insegs.setdefault(linktype, 0)
 
-        if not temp.has_key(u'in'):
-            temp[u'in'] = {linktype: [frm]}
-        elif not temp[u'in'].has_key(linktype):
-            temp[u'in'][linktype] = [frm]
-        else:
-            temp[u'in'][linktype].append(frm)
+        # Only the segment of the source is rewritten
+        key = self._segment_key(to, linktype, self._segment_of(frm, bits))
+        try:
+            sources = self._get_copy(key)
+        except KeyError:
+            sources = list()
+        sources.append(frm)
+        self._set_segment(key, sources)
+
+        if len(sources) > SEGMENT_SIZE and bits < MAX_SEGMENT_BITS:
+            self._split_in(to, linktype, insegs)
 
         # Notification that the destination has changed
         temp[u'mtime'] = time()
@@ -570,7 +1174,7 @@ class GraphData(GraphDataBase):
         if not linktype:
             linktype = NO_TYPE
 
-        temp = self.get(frm, {})
+        temp = self._getpage_copy(frm)
 
         if not temp.has_key(u'out'):
             temp[u'out'] = {linktype: [to]}
@@ -0,0 +1,773 @@
+# -*- coding: utf-8 -*-
+
+"""
+SQLite backend for gwiki
+
+Stores pages, metas and links in normalized tables of a single SQLite
+database (data/graphdata/graphdata.sqlite by default). The database is
+kept in WAL mode, so readers never block the writer and vice versa.
+Writes are done in a real transaction that is opened on the first
+modification and closed by commit() or abort(). Savepoints taken
+before modifications are only set in the transaction on the next
+write, so taking them costs nothing when nothing is written.
+
+Out-links and in-links share the same edge table: an edge whose
+destination is a local page also refers to the page row of the
+destination, and in-links are looked up through that reference.
+
+The changes table keeps the latest version of each page that has
+changed. Its autoincremented key gives every change a version number
+greater than those of all the earlier ones.
+
+Enable in wikiconfig with:
+
+    dbconfig = {'backend': 'sqlite'}
+
+Existing shelve data can be converted with moin-meta-migrate.
+"""
+import os
+import sqlite3
+import itertools
+import threading
+
+from time import time
+
+from basedb import GraphDataBase
+from MoinMoin.metadata.constants import NO_TYPE, CATEGORY_KEY
+from MoinMoin.metadata.util import node_type, log
+from MoinMoin.metadata.query import ordervalue_key
+
+SCHEMA_VERSION = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    saved INTEGER,
+    mtime REAL,
+    acl TEXT
+);
+
+CREATE TABLE IF NOT EXISTS metas (
+    page INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    ord BLOB,
+    linked INTEGER
+);
+CREATE INDEX IF NOT EXISTS metas_page ON metas (page, seq);
+CREATE INDEX IF NOT EXISTS metas_key_value ON metas (key, value);
+CREATE INDEX IF NOT EXISTS metas_key_ord ON metas (key, ord);
+CREATE INDEX IF NOT EXISTS metas_key_linked ON metas (key, linked);
+
+CREATE TABLE IF NOT EXISTS links (
+    src INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    linktype TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    dst_page INTEGER
+);
+CREATE INDEX IF NOT EXISTS links_src ON links (src, seq);
+CREATE INDEX IF NOT EXISTS links_dst_page ON links (dst_page);
+CREATE INDEX IF NOT EXISTS links_type_dst ON links (linktype, dst);
+
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+"""
+
+TABLES = ['pages', 'metas', 'links', 'state']
+
+# Operators of metatable value comparisons in SQL
+SQL_OPERATORS = {'<': '<', '<=': '<=', '==': '=', '>=': '>=', '>': '>'}
+
+DEFAULT_TIMEOUT = 60.0
+
+# Up to this many pages, get_acls looks the pages up by name. SQLite
+# allows at most 999 query parameters.
+ACL_QUERY_NAMES = 500
+
+def _u(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _execute_script(db, script):
+    for statement in script.split(';'):
+        if statement.strip():
+            db.execute(statement)
+
+def _upgrade_2(db):
+    # Value indexes for metatable queries
+    db.execute("ALTER TABLE metas ADD COLUMN ord BLOB")
+    db.execute("ALTER TABLE metas ADD COLUMN linked INTEGER")
+    rows = db.execute("SELECT rowid, value FROM metas").fetchall()
+    for rowid, value in rows:
+        db.execute("UPDATE metas SET ord = ?, linked = ? WHERE rowid = ?",
+                   (sqlite3.Binary(ordervalue_key(value)),
+                    int(u'[[' in value), rowid))
+    _execute_script(db, SCHEMA)
+
+def _upgrade_3(db):
+    # State of the database, eg. the edit log sync position
+    _execute_script(db, SCHEMA)
+
+def _upgrade_4(db):
+    # Change feed
+    _execute_script(db, SCHEMA)
+
+def _upgrade_5(db):
+    # Exact sort keys of integers
+    rows = db.execute("SELECT rowid, value FROM metas").fetchall()
+    for rowid, value in rows:
+        db.execute("UPDATE metas SET ord = ? WHERE rowid = ?",
+                   (sqlite3.Binary(ordervalue_key(value)), rowid))
+
+UPGRADES = {2: _upgrade_2, 3: _upgrade_3, 4: _upgrade_4, 5: _upgrade_5}
+
+class _Connection(object):
+    """
+    A database connection shared by all the GraphData instances of a
+    thread. Like the fcntl locks of the shelve backend, nested
+    requests of the same thread must not block each other.
+    """
+
+    def __init__(self, dbfile, timeout):
+        log.debug("opening sqlite graphdata %r" % (dbfile, ))
+        self.dbfile = dbfile
+        self.users = 0
+        self.in_transaction = False
+        # Savepoints set in the current transaction
+        self.savepoints = set()
+
+        self.db = sqlite3.connect(dbfile, timeout=timeout,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA synchronous = NORMAL")
+
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            # WAL mode is persistent, it only needs to be set once
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.begin()
+            try:
+                # Another connection may have upgraded the database
+                # while this one was waiting for the write lock
+                version = self.db.execute("PRAGMA user_version").fetchone()[0]
+                if version < SCHEMA_VERSION:
+                    self._upgrade(version)
+            except:
+                self.rollback()
+                raise
+            self.commit()
+
+    def _upgrade(self, version):
+        if version == 0:
+            _execute_script(self.db, SCHEMA)
+        else:
+            for upgrade in range(version + 1, SCHEMA_VERSION + 1):
+                log.info("upgrading %r to schema version %d" %
+                         (self.dbfile, upgrade))
+                UPGRADES[upgrade](self.db)
+        self.db.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION, ))
+
+    def begin(self):
+        if self.in_transaction:
+            return
+        log.debug("beginning a transaction on %r" % (self.dbfile, ))
+        self.db.execute("BEGIN IMMEDIATE")
+        self.in_transaction = True
+
+    def commit(self):
+        if not self.in_transaction:
+            return
+        self.db.execute("COMMIT")
+        self.in_transaction = False
+        self.savepoints.clear()
+        log.debug("committed a transaction on %r" % (self.dbfile, ))
+
+    def rollback(self):
+        if not self.in_transaction:
+            return
+        self.db.execute("ROLLBACK")
+        self.in_transaction = False
+        self.savepoints.clear()
+        log.debug("rolled back a transaction on %r" % (self.dbfile, ))
+
+_connections = threading.local()
+
+# Savepoint names are unique among the GraphData instances sharing a
+# connection
+_savepoint_ids = itertools.count(1)
+
+def _acquire_connection(dbfile, timeout):
+    connections = _connections.__dict__.setdefault('open', dict())
+    conn = connections.get(dbfile)
+    if conn is None:
+        conn = connections[dbfile] = _Connection(dbfile, timeout)
+    conn.users += 1
+    return conn
+
+def _release_connection(conn):
+    conn.users -= 1
+    if conn.users > 0:
+        return
+
+    # Anything not explicitly committed by now is discarded
+    conn.rollback()
+    conn.db.close()
+    _connections.open.pop(conn.dbfile, None)
+
+class GraphData(GraphDataBase):
+    is_acid = True
+
+    def __init__(self, request, dbfile=None, **kw):
+        log.debug("sqlite graphdb init")
+        GraphDataBase.__init__(self, request, **kw)
+
+        if dbfile is None:
+            gddir = os.path.join(request.cfg.data_dir, 'graphdata')
+            if not os.path.isdir(gddir):
+                os.mkdir(gddir)
+            dbfile = os.path.join(gddir, 'graphdata.sqlite')
+        self.dbfile = os.path.abspath(dbfile)
+
+        timeout = getattr(request.cfg, 'graphdata_lock_timeout', None)
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        self._timeout = timeout
+
+        self._conn = None
+        self.cache = dict()
+        # Savepoints taken, in order, each a list of its name and
+        # whether it has been set in the transaction
+        self._savepoints = list()
+
+    # Connection and transaction handling
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = _acquire_connection(self.dbfile, self._timeout)
+        return self._conn
+
+    def _read(self, query, args=()):
+        return self._connect().db.execute(query, args)
+
+    def _write(self, query, args=()):
+        conn = self._connect()
+        conn.begin()
+        for savepoint in self._savepoints:
+            if not savepoint[1]:
+                conn.db.execute("SAVEPOINT %s" % (savepoint[0], ))
+                conn.savepoints.add(savepoint[0])
+                savepoint[1] = True
+        return conn.db.execute(query, args)
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+        self._savepoints = list()
+
+    def abort(self):
+        if self._conn is not None:
+            self._conn.rollback()
+        self._savepoints = list()
+        self.cache.clear()
+
+    def _pop_savepoint(self, name):
+        for index, (other, is_set) in enumerate(self._savepoints):
+            if other == name:
+                del self._savepoints[index:]
+                # Set in a transaction that is still open
+                return (is_set and self._conn is not None and
+                        name in self._conn.savepoints)
+        return False
+
+    def savepoint(self):
+        name = "graphdata_%d" % (_savepoint_ids.next(), )
+        self._savepoints.append([name, False])
+        return name
+
+    def rollback_to(self, savepoint):
+        if self._pop_savepoint(savepoint):
+            db = self._conn.db
+            db.execute("ROLLBACK TO %s" % (savepoint, ))
+            db.execute("RELEASE %s" % (savepoint, ))
+            self._conn.savepoints.discard(savepoint)
+        self.cache.clear()
+
+    def release(self, savepoint):
+        if self._pop_savepoint(savepoint):
+            self._conn.db.execute("RELEASE %s" % (savepoint, ))
+            self._conn.savepoints.discard(savepoint)
+
+    def close(self):
+        self.cache.clear()
+        self._savepoints = list()
+        if self._conn is not None:
+            _release_connection(self._conn)
+            self._conn = None
+
+    def get_sync_position(self):
+        row = self._read("SELECT value FROM state WHERE name = 'sync'")
+        row = row.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_sync_position(self, position):
+        self._write("INSERT OR REPLACE INTO state (name, value) "
+                    "VALUES ('sync', ?)", (position, ))
+
+    def get_version(self):
+        row = self._read("SELECT MAX(version) FROM changes").fetchone()
+        return row[0] or 0
+
+    def changes_since(self, version):
+        current = self.get_version()
+        changed = self._names("SELECT name FROM changes "
+                              "WHERE version > ? AND version <= ?",
+                              (version, current))
+        return changed, current
+
+    def has_pending_changes(self):
+        return self._conn is not None and self._conn.in_transaction
+
+    def _changed(self, pagename):
+        self._write("INSERT OR REPLACE INTO changes (name) VALUES (?)",
+                    (_u(pagename), ))
+
+    def _changed_id(self, page_id):
+        self._write("INSERT OR REPLACE INTO changes (name) "
+                    "SELECT name FROM pages WHERE id = ?", (page_id, ))
+
+    # Rebuilding
+
+    def side_copy(self, suffix='.rehash'):
+        return GraphData(self.request, dbfile=self.dbfile + suffix)
+
+    def replace_with(self, side, catch_up=None):
+        side.commit()
+        side.close()
+
+        # Databases can only be attached outside transactions
+        self.commit()
+        self.cache.clear()
+        conn = self._connect()
+        conn.db.execute("ATTACH DATABASE ? AS side", (side.dbfile, ))
+        try:
+            # Readers keep seeing the old data until the commit
+            conn.begin()
+            try:
+                # The versions keep growing over the swap, and all the
+                # pages of both the old and the new data have changed
+                mark = ("INSERT OR REPLACE INTO main.changes (name) "
+                        "SELECT name FROM main.pages")
+                conn.db.execute(mark)
+                for table in TABLES:
+                    columns = ', '.join(row[1] for row in conn.db.execute(
+                        "PRAGMA side.table_info(%s)" % (table, )))
+                    conn.db.execute("DELETE FROM main.%s" % (table, ))
+                    conn.db.execute("INSERT INTO main.%s (%s) "
+                                    "SELECT %s FROM side.%s" %
+                                    (table, columns, columns, table))
+                conn.db.execute(mark)
+
+                # In the same transaction
+                if catch_up is not None:
+                    self.cache.clear()
+                    catch_up(self)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        finally:
+            conn.db.execute("DETACH DATABASE side")
+
+        side.drop()
+
+    def drop(self):
+        self.abort()
+        self.close()
+
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.unlink(self.dbfile + suffix)
+            except OSError:
+                pass
+
+    # Page record access
+
+    def _page_row(self, pagename):
+        return self._read("SELECT id, saved, mtime, acl FROM pages "
+                          "WHERE name = ?", (_u(pagename), )).fetchone()
+
+    def _page_id(self, pagename, create=False):
+        row = self._page_row(pagename)
+        if row is not None:
+            return row[0]
+        if not create:
+            return None
+        cursor = self._write("INSERT INTO pages (name) VALUES (?)",
+                             (_u(pagename), ))
+        return cursor.lastrowid
+
+    def _load(self, pagename):
+        row = self._page_row(pagename)
+        if row is None:
+            raise KeyError(pagename)
+        page_id, saved, mtime, acl = row
+
+        pagedict = dict()
+        if mtime is not None:
+            pagedict[u'mtime'] = mtime
+        if saved is not None:
+            pagedict[u'saved'] = bool(saved)
+            pagedict[u'acl'] = acl or u''
+            pagedict[u'meta'] = dict()
+
+        for key, value in self._read("SELECT key, value FROM metas "
+                                     "WHERE page = ? ORDER BY seq",
+                                     (page_id, )):
+            pagedict.setdefault(u'meta', dict()).setdefault(key,
+                                                            list()).append(value)
+
+        for linktype, dst in self._read("SELECT linktype, dst FROM links "
+                                        "WHERE src = ? ORDER BY seq",
+                                        (page_id, )):
+            pagedict.setdefault(u'out', dict()).setdefault(linktype,
+                                                           list()).append(dst)
+
+        for linktype, src in self._read("SELECT links.linktype, pages.name "
+                                        "FROM links JOIN pages "
+                                        "ON pages.id = links.src "
+                                        "WHERE links.dst_page = ? "
+                                        "ORDER BY links.rowid",
+                                        (page_id, )):
+            pagedict.setdefault(u'in', dict()).setdefault(linktype,
+                                                          list()).append(src)
+
+        return pagedict
+
+    def __getitem__(self, item):
+        item = _u(item)
+        if item in self.cache:
+            return self.cache[item]
+
+        self.cache[item] = self._load(item)
+        return self.cache[item]
+
+    def __setitem__(self, item, value):
+        self.savepage(item, value)
+
+    def cacheset(self, item, value):
+        self.cache[_u(item)] = value
+
+    def __contains__(self, item):
+        item = _u(item)
+        if item in self.cache:
+            return True
+        return self._page_row(item) is not None
+
+    def has_key(self, item):
+        return item in self
+
+    def __iter__(self):
+        for (name, ) in self._read("SELECT name FROM pages").fetchall():
+            yield name
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def pagenames(self):
+        return self.__iter__()
+
+    def is_saved(self, pagename):
+        return self.getpage(pagename).get('saved', False)
+
+    def get_out(self, pagename):
+        return self.getpage(pagename).get(u'out', {})
+
+    def get_in(self, pagename):
+        return self.getpage(pagename).get(u'in', {})
+
+    def get_meta(self, pagename):
+        return self.getpage(pagename).get(u'meta', {})
+
+    def get_metakeys(self, name):
+        """
+        Return the complete set of page's (non-link) meta keys, plus gwiki category.
+        """
+        page = self.getpage(name)
+        keys = set(page.get('meta', dict()))
+
+        if page.get('out', dict()).has_key('gwikicategory'):
+            keys.add('gwikicategory')
+
+        return keys
+
+    def get_sort_keys(self, pagenames, key):
+        result = dict((_u(x), list()) for x in pagenames)
+        for name, sortkey in self._read("SELECT pages.name, metas.ord "
+                                        "FROM metas JOIN pages "
+                                        "ON pages.id = metas.page "
+                                        "WHERE metas.key = ?",
+                                        (_u(key), )):
+            if name in result:
+                result[name].append(str(sortkey))
+        return result
+
+    def get_acls(self, pagenames):
+        names = set(_u(x) for x in pagenames)
+        if len(names) <= ACL_QUERY_NAMES:
+            query = "SELECT name, acl FROM pages WHERE saved AND name IN " + \
+                "(%s)" % (", ".join("?" * len(names)))
+            args = tuple(names)
+        else:
+            # Cheaper to go through all the pages than to look them up
+            query = "SELECT name, acl FROM pages WHERE saved"
+            args = ()
+
+        result = dict()
+        for name, acl in self._read(query, args):
+            if name in names:
+                result[name] = acl or u''
+        return result
+
+    # Value indexes
+
+    def _names(self, query, args):
+        return set(name for (name, ) in self._read(query, args))
+
+    def pages_with_key(self, key):
+        pages = self._names("SELECT pages.name FROM metas JOIN pages "
+                            "ON pages.id = metas.page "
+                            "WHERE metas.key = ?", (_u(key), ))
+        if key == CATEGORY_KEY:
+            pages.update(self._names("SELECT pages.name FROM links "
+                                     "JOIN pages ON pages.id = links.src "
+                                     "WHERE links.linktype = ?",
+                                     (_u(key), )))
+        return pages
+
+    def pages_with_value(self, key, value):
+        key, value = _u(key), _u(value)
+        pages = self._names("SELECT pages.name FROM metas JOIN pages "
+                            "ON pages.id = metas.page "
+                            "WHERE metas.key = ? AND metas.value = ?",
+                            (key, value))
+
+        # Values where the value is linked, eg. [[value|text]]. LIKE
+        # may match a bit too much, the query filters will tell.
+        pattern = u'[[' + value
+        for char in u'\\%_':
+            pattern = pattern.replace(char, u'\\' + char)
+        pages.update(self._names("SELECT pages.name FROM metas JOIN pages "
+                                 "ON pages.id = metas.page "
+                                 "WHERE metas.key = ? AND metas.linked = 1 "
+                                 "AND metas.value LIKE ? ESCAPE '\\'",
+                                 (key, u'%' + pattern + u'%')))
+
+        if key == CATEGORY_KEY:
+            pages.update(self._names("SELECT pages.name FROM links "
+                                     "JOIN pages ON pages.id = links.src "
+                                     "WHERE links.linktype = ? "
+                                     "AND links.dst = ?", (key, value)))
+        return pages
+
+    def pages_with_order(self, key, op, comp):
+        # Categories are compared by their link values
+        if key == CATEGORY_KEY or op not in SQL_OPERATORS:
+            return None
+
+        query = ("SELECT pages.name FROM metas JOIN pages "
+                 "ON pages.id = metas.page "
+                 "WHERE metas.key = ? AND metas.ord %s ?" %
+                 (SQL_OPERATORS[op], ))
+        return self._names(query, (_u(key),
+                                   sqlite3.Binary(ordervalue_key(comp))))
+
+    # Modifications
+
+    def _in_edges(self, page_id):
+        return self._read("SELECT linktype, dst_page FROM links "
+                          "WHERE src = ? AND dst_page IS NOT NULL",
+                          (page_id, )).fetchall()
+
+    def _has_inlinks(self, page_id):
+        return self._read("SELECT 1 FROM links WHERE dst_page = ? LIMIT 1",
+                          (page_id, )).fetchone() is not None
+
+    def _replace_metas(self, page_id, metas):
+        self._write("DELETE FROM metas WHERE page = ?", (page_id, ))
+        seq = 0
+        for key, values in metas.iteritems():
+            for value in values:
+                value = _u(value)
+                self._write("INSERT INTO metas "
+                            "(page, seq, key, value, ord, linked) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (page_id, seq, _u(key), value,
+                             sqlite3.Binary(ordervalue_key(value)),
+                             int(u'[[' in value)))
+                seq += 1
+
+    def _replace_links(self, page_id, outs, touch=True):
+        old_edges = self._in_edges(page_id)
+
+        self._write("DELETE FROM links WHERE src = ?", (page_id, ))
+        seq = 0
+        for linktype, dsts in outs.iteritems():
+            if not linktype:
+                linktype = NO_TYPE
+            for dst in dsts:
+                dst_page = None
+                # Only save in-links to local pages, not eg. url or interwiki
+                if node_type(self.request, dst) == 'page':
+                    dst_page = self._page_id(dst, create=True)
+                self._write("INSERT INTO links "
+                            "(src, seq, linktype, dst, dst_page) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (page_id, seq, _u(linktype), _u(dst), dst_page))
+                seq += 1
+
+        new_edges = self._in_edges(page_id)
+        self._touch_changed(old_edges, new_edges, touch)
+
+    def _touch_changed(self, old_edges, new_edges, touch=True):
+        # In-links do not have any sensible order, so only the
+        # destinations whose in-links were really added or removed
+        # need to be notified.
+        counts = dict()
+        for edge in old_edges:
+            counts[edge] = counts.get(edge, 0) - 1
+        for edge in new_edges:
+            counts[edge] = counts.get(edge, 0) + 1
+
+        changed = set(dst for (linktype, dst), count in counts.iteritems()
+                      if count)
+        if not changed:
+            return
+
+        cur_time = time()
+        for dst in changed:
+            self._changed_id(dst)
+            if not touch:
+                self._prune(dst)
+                continue
+            # Notification that the destination has changed
+            self._write("UPDATE pages SET mtime = ? WHERE id = ?",
+                        (cur_time, dst))
+            self._prune(dst)
+
+    def _prune(self, page_id):
+        # Forget link-only pages that nobody links to anymore
+        row = self._read("SELECT saved FROM pages WHERE id = ?",
+                         (page_id, )).fetchone()
+        if row is None or row[0]:
+            return
+        if self._has_inlinks(page_id):
+            return
+        if self._read("SELECT 1 FROM links WHERE src = ? LIMIT 1",
+                      (page_id, )).fetchone() is not None:
+            return
+        self._write("DELETE FROM metas WHERE page = ?", (page_id, ))
+        self._write("DELETE FROM pages WHERE id = ?", (page_id, ))
+
+    def savepage(self, pagename, pagedict):
+        log.debug("savepage %s = %s" % (repr(pagename), repr(pagedict)))
+        self.cache.clear()
+
+        page_id = self._page_id(pagename, create=True)
+        self._changed(pagename)
+        saved = pagedict.get(u'saved', None)
+        if saved is not None:
+            saved = int(bool(saved))
+        self._write("UPDATE pages SET saved = ?, mtime = ?, acl = ? "
+                    "WHERE id = ?",
+                    (saved, pagedict.get(u'mtime', None),
+                     _u(pagedict.get(u'acl', None)), page_id))
+
+        self._replace_metas(page_id, pagedict.get(u'meta', dict()))
+        # In-links are derived from the out-links of the linking
+        # pages. Raw saves leave the mtimes of the destinations alone.
+        self._replace_links(page_id, pagedict.get(u'out', dict()),
+                            touch=False)
+
+    def __delitem__(self, item):
+        self.delpage(item)
+
+    def delpage(self, pagename):
+        log.debug("delpage %s" % (repr(pagename), ))
+        self.cache.clear()
+
+        page_id = self._page_id(pagename)
+        if page_id is None:
+            return
+
+        self._changed(pagename)
+        self._replace_links(page_id, dict())
+        self._write("DELETE FROM metas WHERE page = ?", (page_id, ))
+
+        # Keep a bare record of pages that are still linked to, the
+        # linking pages refer to it
+        if self._has_inlinks(page_id):
+            self._write("UPDATE pages SET saved = NULL, acl = NULL "
+                        "WHERE id = ?", (page_id, ))
+        else:
+            self._write("DELETE FROM pages WHERE id = ?", (page_id, ))
+
+    def set_page_meta(self, pagename, newmeta):
+        self.cache.clear()
+        page_id = self._page_id(pagename, create=True)
+        self._changed(pagename)
+        self._replace_metas(page_id, newmeta)
+
+    def set_acl(self, pagename, acl):
+        self.cache.clear()
+        page_id = self._page_id(pagename, create=True)
+        self._changed(pagename)
+        self._write("UPDATE pages SET acl = ? WHERE id = ?",
+                    (_u(acl), page_id))
+
+    def set_saved(self, pagename, saved, mtime):
+        self.cache.clear()
+        page_id = self._page_id(pagename, create=True)
+        self._changed(pagename)
+        self._write("UPDATE pages SET saved = ?, mtime = ? WHERE id = ?",
+                    (int(bool(saved)), mtime, page_id))
+
+    def clear_page(self, pagename):
+        self.cache.clear()
+
+        page_id = self._page_id(pagename)
+        if page_id is None:
+            return
+
+        if self._has_inlinks(page_id):
+            self._changed(pagename)
+            self._replace_links(page_id, dict())
+            self._write("DELETE FROM metas WHERE page = ?", (page_id, ))
+            self._write("UPDATE pages SET saved = 0 WHERE id = ?",
+                        (page_id, ))
+        else:
+            self.delpage(pagename)
+
+    def set_page(self, request, pagename, new_data):
+        self.cache.clear()
+
+        pagedata = new_data.get(pagename, dict())
+        page_id = self._page_id(pagename, create=True)
+        self._changed(pagename)
+
+        self._replace_metas(page_id, pagedata.get(u'meta', dict()))
+        self._write("UPDATE pages SET saved = 1, mtime = ?, acl = ? "
+                    "WHERE id = ?",
+                    (time(), _u(pagedata.get(u'acl', '')), page_id))
+        self._replace_links(page_id, pagedata.get(u'out', dict()))
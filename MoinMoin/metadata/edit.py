@@ -3,11 +3,14 @@ import os
 from wikitextutil import parse_text
 
 def savegraphdata(pagename, request, text, pagedir, pageitem):
-    try:
-        # Skip MoinEditorBackups
-        if pagename.endswith('/MoinEditorBackup'):
-            return
+    # Skip MoinEditorBackups
+    if pagename.endswith('/MoinEditorBackup'):
+        return
 
+    # Only undo the changes to this page if something goes wrong, the
+    # other pages saved in the same request keep theirs
+    savepoint = request.graphdata.savepoint()
+    try:
         # parse_text, add_link, add_meta return dict with keys like
         # 'BobPerson' -> {u'out': {'friend': ['GeorgePerson']}}
         # (ie. same as what graphdata contains)
@@ -19,24 +22,25 @@ def savegraphdata(pagename, request, text, pagedir, pageitem):
 
         ## Remove deleted pages from the backend
         # 1. Removing data at the moment of deletion
-        # Deleting == saving a revision with the text 'deleted/n', then 
+        # Deleting == saving a revision with the text 'deleted/n', then
         # removing the revision. This seems to be the only way to notice.
         if text == 'deleted\n':
-            request.graphdata.clear_page(request, pagename)
+            request.graphdata.clear_page(pagename)
         else:
-            # 2. Removing data when rehashing. 
+            # 2. Removing data when rehashing.
             # New pages do not exist, but return a revision of 99999999 ->
             # Check these both to avoid deleting new pages.
-            pf, rev, exists = pageitem.get_rev() 
+            pf, rev, exists = pageitem.get_rev()
             if rev != 99999999:
                 if not exists:
-                    request.graphdata.clear_page(request, pagename)
+                    request.graphdata.clear_page(pagename)
 
         pageitem.delete_caches()
         request.graphdata.post_save(pagename)
     except:
-        request.graphdata.abort()
+        request.graphdata.rollback_to(savepoint)
         raise
+    request.graphdata.release(savepoint)
 
 def underlay_to_pages(req, p):
     underlaydir = req.cfg.data_underlay_dir
@@ -52,17 +56,108 @@ def underlay_to_pages(req, p):
 
     return pagepath
 
+def parse_page(request, pagename):
+    """
+    Parse the current revision of a page into graph data. Returns the
+    parsed data and whether the page exists, or None for pages that
+    are not kept in the graph data.
+    """
+    from MoinMoin.Page import Page
+
+    # Skip MoinEditorBackups
+    if pagename.endswith('/MoinEditorBackup'):
+        return None
+
+    pageitem = Page(request, pagename)
+    request.page = pageitem
+    # Page.exists() answers from the graph data, look at the revisions
+    pf, rev, exists = pageitem.get_rev()
+    if not exists:
+        return dict(), False
+
+    new_data = parse_text(request, pageitem, pageitem.get_raw_body())
+    pageitem.delete_caches()
+    return new_data, True
+
+def store_page(request, graphdata, pagename, new_data, exists):
+    """
+    Store the graph data from parse_page, the same way savegraphdata
+    would have stored it.
+    """
+    graphdata.set_page(request, pagename, new_data)
+    if not exists:
+        graphdata.clear_page(pagename)
+    graphdata.post_save(pagename)
+
+def edited_pages(request, position=0):
+    """
+    Return the names of the pages with entries in the global edit log
+    after the given byte position, and the position of the end of the
+    log. Positions past the end, eg. after the log has been rotated,
+    start from the beginning.
+    """
+    from MoinMoin.logfile import editlog
+
+    log = editlog.EditLog(request)
+    end = log.size()
+    if position > end:
+        position = 0
+
+    pages = set()
+    if position < end:
+        log.seek(position)
+        while log.position() < end:
+            try:
+                line = log.next()
+            except StopIteration:
+                break
+            pages.add(line.pagename)
+            if line.action == 'SAVE/RENAME':
+                # The old name of a renamed page
+                pages.add(line.extra)
+
+    return pages, end
+
+def sync_graphdata(request):
+    """
+    Parse again the pages edited, renamed or deleted after the edit log
+    position recorded in the graph data, eg. after restoring a backup,
+    and record the new position. The first sync goes through the whole
+    edit log. Returns the names of the synced pages.
+    """
+    graphdata = request.graphdata
+
+    position = graphdata.get_sync_position()
+    pagenames, end = edited_pages(request, position or 0)
+    if not pagenames and position == end:
+        return pagenames
+
+    for pagename in sorted(pagenames):
+        parsed = parse_page(request, pagename)
+        if parsed is not None:
+            store_page(request, graphdata, pagename, *parsed)
+
+    graphdata.set_sync_position(end)
+    graphdata.commit()
+    return pagenames
+
 # Functions for properly opening, closing, saving and deleting
 # graphdata.
+def graphdata_backend(name):
+    # Backends live in MoinMoin.metadata.backend as <name>db modules
+    module = __import__('MoinMoin.metadata.backend.%sdb' % (name, ),
+                        globals(), {}, ['GraphData'])
+    return module.GraphData
+
 def graphdata_getter(self):
 #    from graphingwiki.backend.couchdbclient import GraphData
 #    from graphingwiki.backend.durusclient import GraphData
-    from MoinMoin.metadata.backend.shelvedb import GraphData
     if "_graphdata" not in self.__dict__:
-        dbconfig = getattr(self.cfg, 'dbconfig', {})
+        dbconfig = dict(getattr(self.cfg, 'dbconfig', {}))
         if "dbname" not in dbconfig:
             dbconfig["dbname"] = self.cfg.interwikiname
 
+        GraphData = graphdata_backend(dbconfig.pop("backend", "shelve"))
         self.__dict__["_graphdata"] = GraphData(self, **dbconfig)
     return self.__dict__["_graphdata"]
 
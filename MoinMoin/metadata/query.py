@@ -5,20 +5,34 @@
     @copyright: 2006-2016 by Jussi Eronen <exec@iki.fi>
 """
 import re
+import math
 import operator
 import socket
 import string
+import struct
 
 from MoinMoin.wikiutil import parseAttributes, AbsPageName
+from MoinMoin.security import may_read_many
+from MoinMoin.util.lru import LRUCache
 
-from constants import (CATEGORY_KEY, SPECIAL_ATTRS, 
+from constants import (CATEGORY_KEY, SPECIAL_ATTRS,
                        PROPERTIES)
-from util import (filter_categories, category_regex, 
+from util import (filter_categories, category_regex,
                   template_regex)
 from wikitextutil import is_meta_link
 
 REGEX_RE = re.compile('^/.+/$')
 
+INF = float('inf')
+
+# Process-wide caches of parsed MetaTable arguments and of the pages
+# matching page regexps in them
+PLAN_CACHE_SIZE = 1024
+PAGE_REGEXP_CACHE_SIZE = 128
+
+_plan_cache = LRUCache(PLAN_CACHE_SIZE)
+_page_regexp_cache = LRUCache(PAGE_REGEXP_CACHE_SIZE)
+
 # Standard Python operators
 OPERATORS = {'<': operator.lt,
              '<=': operator.le,
@@ -80,15 +94,15 @@ def metas_to_abs_links(request, page, values):
         value = attachment + value
         if stripped:
             if value.endswith(']'):
-                value = '[[' + value 
+                value = '[[' + value
             elif value.endswith('}'):
-                value = '{{' + value 
+                value = '{{' + value
         new_values.append(value)
 
     return new_values
 
 # Fetch requested metakey value for the given page.
-def get_metas(request, name, metakeys, checkAccess=True, 
+def get_metas(request, name, metakeys, checkAccess=True,
               includeGenerated=True, formatLinks=False, **kw):
     if not includeGenerated:
         metakeys = [x for x in metakeys if not '->' in x]
@@ -102,6 +116,11 @@ def get_metas(request, name, metakeys, checkAccess=True,
 
     loadedPage = request.graphdata.getpage(name)
 
+    # In-links are not necessarily stored in the page record
+    if 'gwikiinlinks' in metakeys:
+        loadedPage = dict(loadedPage)
+        loadedPage[u'in'] = request.graphdata.get_in(name)
+
     # Make a real copy of loadedOuts and loadedMeta for tracking indirection
     loadedOuts = dict()
     outs = request.graphdata.get_out(name)
@@ -131,7 +150,7 @@ def get_metas(request, name, metakeys, checkAccess=True,
 
         # Meta key indirection support
         for key in metakeys:
-            add_matching_redirs(request, loadedPage, loadedOuts, 
+            add_matching_redirs(request, loadedPage, loadedOuts,
                                 loadedMeta, metakeys,
                                 key, name, key, formatLinks)
 
@@ -144,7 +163,7 @@ def get_metas(request, name, metakeys, checkAccess=True,
     if loadedOuts.has_key('gwikicategory'):
         # Empty (possible) current gwikicategory to fix a corner case
         pageMeta['gwikicategory'] = loadedOuts['gwikicategory']
-            
+
     return pageMeta
 
 def add_matching_redirs(request, loadedPage, loadedOuts, loadedMeta,
@@ -233,18 +252,18 @@ def string_aton(value):
     if '/' in value:
         value, end = value.split('/', 1)
         end = '/' + end
- 
-    # 00 is stylistic to avoid this: 
-    # >>> sorted(['a', socket.inet_aton('100.2.3.4'), 
-    #             socket.inet_aton('1.2.3.4')]) 
-    # ['\x01\x02\x03\x04', 'a', 'd\x02\x03\x04'] 
+
+    # 00 is stylistic to avoid this:
+    # >>> sorted(['a', socket.inet_aton('100.2.3.4'),
+    #             socket.inet_aton('1.2.3.4')])
+    # ['\x01\x02\x03\x04', 'a', 'd\x02\x03\x04']
     if '.' in value:
-        return u'00' + unicode(socket.inet_pton(socket.AF_INET, 
-                                                value).replace('\\', '\\\\'), 
+        return u'00' + unicode(socket.inet_pton(socket.AF_INET,
+                                                value).replace('\\', '\\\\'),
                                "unicode_escape") + end
     else:
-        return u'00' + unicode(socket.inet_pton(socket.AF_INET6, 
-                                                 value).replace('\\', '\\\\'), 
+        return u'00' + unicode(socket.inet_pton(socket.AF_INET6,
+                                                 value).replace('\\', '\\\\'),
                                "unicode_escape") + end
 
 def float_parts(part):
@@ -258,12 +277,12 @@ def float_parts(part):
 
     fp = float(fp)
     return fp, addon
-    
+
 ORDER_FUNCS = [
     # (conversion function, ignored exception type(s)) ipv4
     # addresses. Return values should be unicode strings. The sorting
     # of numbers is currently a bit hacky.
-    (lambda x: (string_aton(x), ''), 
+    (lambda x: (string_aton(x), ''),
      (socket.error, UnicodeEncodeError, TypeError)),
     # integers
     (lambda x: (int(x), ''), ValueError),
@@ -302,13 +321,79 @@ def ordervalue(value):
             pass
     return value
 
-def _metatable_parseargs(request, args, cat_re, temp_re):
+# Version of the ordervalue_key() encoding, for telling apart the sort
+# keys stored with an older one
+SORT_KEY_VERSION = 2
+
+def _integer_key(number):
+    # A sign byte, then the length and the big-endian bytes of the
+    # magnitude, all complemented for negatives so that larger
+    # magnitudes sort first
+    magnitude = '%x' % abs(number)
+    if magnitude == '0':
+        magnitude = ''
+    magnitude = ('0' * (len(magnitude) % 2) + magnitude).decode('hex')
+    key = struct.pack('>I', len(magnitude)) + magnitude
+    if number < 0:
+        return '\x01' + ''.join(chr(0xff ^ ord(x)) for x in key)
+    return '\x02' + key
+
+def _number_key(number):
+    # Integers are encoded exactly, floats as their integral part
+    # followed by the fraction, if any. Positive doubles sort as their
+    # big-endian bytes.
+    if isinstance(number, float):
+        if number != number:
+            return '\x04'
+        if number == INF:
+            return '\x03'
+        if number == -INF:
+            return '\x00'
+        whole = math.floor(number)
+        key = _integer_key(long(whole))
+        fraction = number - whole
+        if fraction:
+            key += '\x01' + struct.pack('>d', fraction)
+        return key
+    return _integer_key(number)
+
+def ordervalue_key(value):
+    r"""
+    Return a byte string that sorts like ordervalue(value) does, for
+    storing sort keys in a database. Numbers sort before strings, as
+    they do when comparing the ordervalue tuples.
+
+    >>> values = [u'10', u'9.5', u'b', u'A', u'1.2.3.4', u'2.1.5', u'']
+    >>> sorted(values, key=ordervalue) == sorted(values, key=ordervalue_key)
+    True
+    >>> ordervalue_key(u'9007199254740992') < ordervalue_key(u'9007199254740993')
+    True
+    """
+    out, addon = ordervalue(value)
+
+    if isinstance(out, (int, long, float)):
+        key = '\x01' + _number_key(out)
+    else:
+        key = '\x02' + unicode(out).encode('utf-8')
+
+    return key + '\x00' + unicode(addon).encode('utf-8')
+
+def meta_sort_keys(metas):
+    """
+    Return the ordervalue_key() sort keys of a dict of meta values
+    """
+    return dict((key, map(ordervalue_key, values))
+                for key, values in metas.iteritems())
+
+def _parse_metatable_args(request, args):
     # Arg placeholders
     argset = set([])
+    page_regexps = list()
     keyspec = list()
     excluded_keys = list()
     orderspec = list()
     limitregexps = dict()
+    limitvalues = dict()
     limitops = dict()
 
     # Capacity for storing indirection keys in metadata comparisons
@@ -342,7 +427,7 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
                 if key.startswith('!'):
                     excluded_keys.append(key.lstrip('!'))
                     continue
-                    
+
                 keyspec.append(key.strip())
 
             continue
@@ -352,7 +437,7 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
         for op in OPERATORS:
             if op in arg:
                 data = arg.rsplit(op)
-                
+
                 # If this is not a comparison but indirection,
                 # continue. Good: k->s>3, bad: k->s=/.+/
                 if op == '>' and data[0].endswith('-'):
@@ -411,16 +496,18 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
                 # but 'nonwikiword some text' would not match
                 # 'nonwikiword'
                 if re.match(Parser.word_rule_js, val):
-                    re_val = "(%s|" % (re.escape(val)) 
+                    re_val = "(%s|" % (re.escape(val))
                 else:
-                    re_val = "(^%s$|" % (re.escape(val)) 
+                    re_val = "(^%s$|" % (re.escape(val))
+                    # Exact values can be looked up from value indexes
+                    limitvalues.setdefault(key, set()).add(val)
                 # or as bracketed link
-                re_val += "(?P<sta>\[\[)%s(?(sta)\]\])|" % (re.escape(val)) 
+                re_val += "(?P<sta>\[\[)%s(?(sta)\]\])|" % (re.escape(val))
 
                 # or as commented bracketed link
                 re_val += "(?P<stb>\[\[)%s(?(stb)\|[^\]]*\]\]))" % \
-                    (re.escape(val)) 
-                
+                    (re.escape(val))
+
                 limitregexps.setdefault(
                     key, set()).add(re.compile(re_val, re.UNICODE))
 
@@ -430,7 +517,7 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
                     val = val[1:-1]
 
                 limitregexps.setdefault(
-                    key, set()).add(re.compile(val, 
+                    key, set()).add(re.compile(val,
                                                re.IGNORECASE | re.UNICODE))
             continue
 
@@ -467,13 +554,182 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
         except:
             continue
 
-        # Get all pages, check which of them match to the supplied regexp
-        for page in request.graphdata:
-            if page_re.match(page):
-                argset.add(page)
+        page_regexps.append(page_re)
+
+    return (argset, page_regexps, pageargs, keyspec, excluded_keys,
+            orderspec, limitregexps, limitvalues, limitops,
+            indirection_keys, styles)
 
-    return (argset, pageargs, keyspec, excluded_keys, orderspec, 
-            limitregexps, limitops, indirection_keys, styles)
+def _edit_log_position(request):
+    from MoinMoin.logfile import editlog
+    return editlog.EditLog(request).size()
+
+def _expand_page_regexp(request, page_re):
+    # Every page save and delete is appended to the edit log, so the
+    # set of pages matching the regexp can only have changed if the
+    # log has grown since the expansion was cached
+    key = (request.cfg.siteid, page_re.pattern)
+    position = _edit_log_position(request)
+
+    cached = _page_regexp_cache.get(key)
+    if cached is not None and cached[0] == position:
+        return cached[1]
+
+    # Get all pages, check which of them match to the supplied regexp
+    pages = frozenset(page for page in request.graphdata
+                      if page_re.match(page))
+    _page_regexp_cache[key] = (position, pages)
+    return pages
+
+class _Descending(object):
+    """
+    Wrapper reversing the order of a value in sort keys.
+
+    >>> sorted([1, 3, 2], key=_Descending)
+    [3, 2, 1]
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+def order_keys(request, pagenames, orderspec):
+    """
+    Return a dict of sort keys for the pages, ordering them as given
+    by orderspec, eg. [('<<', 'key'), ('>>', 'other')]. Within each
+    key the value lists are compared in ascending or descending order,
+    pages without values go last in both directions, and ties are
+    broken by the page names.
+
+    Plain meta keys use the sort keys stored by the graphdata backend,
+    the keys generated at query time are computed from their values.
+    """
+    keys = dict((page, list()) for page in pagenames)
+
+    for direction, key in orderspec:
+        reverse = direction == '>>'
+
+        if key == 'gwikipagename':
+            for page in keys:
+                keys[page].append(reverse and _Descending(page) or page)
+            continue
+
+        if '->' in key or key in ['gwikiinlinks', CATEGORY_KEY]:
+            sortkeys = dict()
+            for page in keys:
+                metas = get_metas(request, page, [key], checkAccess=False)
+                sortkeys[page] = map(ordervalue_key, metas[key])
+        else:
+            sortkeys = request.graphdata.get_sort_keys(pagenames, key)
+
+        for page in keys:
+            values = sorted(sortkeys.get(page, list()), reverse=reverse)
+            keys[page].append(not values)
+            keys[page].append(reverse and _Descending(values) or values)
+
+    for page in keys:
+        keys[page].append(ordervalue_key(page))
+        keys[page] = tuple(keys[page])
+
+    return keys
+
+def _metatable_plan(request, args):
+    # The parsed and compiled arguments only depend on the argument
+    # string and, through relative page names, the current page
+    page = getattr(request, 'page', None)
+    pagename = getattr(page, 'page_name', None)
+    key = (request.cfg.siteid, pagename, args)
+
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = _parse_metatable_args(request, args)
+        _plan_cache[key] = plan
+    return plan
+
+def _metatable_parseargs(request, args, cat_re, temp_re):
+    plan = _metatable_plan(request, args)
+
+    (argset, page_regexps, pageargs, keyspec, excluded_keys, orderspec,
+     limitregexps, limitvalues, limitops, indirection_keys, styles) = plan
+
+    # The plan is shared, hand out copies the callers may modify
+    argset = set(argset)
+    for page_re in page_regexps:
+        argset.update(_expand_page_regexp(request, page_re))
+
+    return (argset, pageargs, list(keyspec), list(excluded_keys),
+            list(orderspec),
+            dict((x, set(y)) for x, y in limitregexps.iteritems()),
+            dict((x, set(y)) for x, y in limitvalues.iteritems()),
+            dict((x, list(y)) for x, y in limitops.iteritems()),
+            list(indirection_keys),
+            dict((x, dict(y)) for x, y in styles.iteritems()))
+
+def indexed_pages(request, limitregexps, limitvalues, limitops):
+    """
+    Narrow down the pages that may match the metadata limits using
+    the value indexes of the graphdata backend. Returns None if there
+    was nothing to narrow down with. The limits still need to be
+    checked for the returned pages.
+    """
+    graphdata = request.graphdata
+    candidates = None
+
+    def narrow(pages):
+        if pages is None:
+            return candidates
+        if candidates is None:
+            return set(pages)
+        return candidates & pages
+
+    def indexable(key):
+        return not '->' in key and key != 'gwikiinlinks'
+
+    # Regexps can only match to pages that have the key
+    for key in limitregexps:
+        if not indexable(key):
+            continue
+
+        if key in limitvalues:
+            for value in limitvalues[key]:
+                candidates = narrow(graphdata.pages_with_value(key, value))
+        else:
+            candidates = narrow(graphdata.pages_with_key(key))
+
+        if candidates is not None and not candidates:
+            return candidates
+
+    for key, complist in limitops.iteritems():
+        if not indexable(key):
+            continue
+
+        for comp, op in complist:
+            # Pages without the key match these
+            if op == '!=' or (op == '==' and not comp):
+                continue
+            pages = graphdata.pages_with_order(key, op, comp)
+            if pages is None:
+                # Without an order index, the comparisons can still
+                # only match to pages that have the key
+                pages = graphdata.pages_with_key(key)
+            candidates = narrow(pages)
+
+        if candidates is not None and not candidates:
+            return candidates
+
+    return candidates
 
 def metatable_parseargs(request, args,
                         get_all_keys=False,
@@ -495,12 +751,15 @@ def metatable_parseargs(request, args,
     temp_re = template_regex(request)
 
     argset, pageargs, keyspec, excluded_keys, orderspec, \
-        limitregexps, limitops, indirection_keys, styles = \
+        limitregexps, limitvalues, limitops, indirection_keys, styles = \
         parsefunc(request, args, cat_re, temp_re)
 
-    # If there were no page args, default to all pages
+    # If there were no page args, default to all pages, or the pages
+    # the value indexes say may match
     if not pageargs and not argset:
-        pages = request.graphdata.pagenames()
+        pages = indexed_pages(request, limitregexps, limitvalues, limitops)
+        if pages is None:
+            pages = request.graphdata.pagenames()
     else:
         pages = set()
         categories = set(filter_categories(request, argset))
@@ -589,7 +848,7 @@ def metatable_parseargs(request, args,
                 # If all of the comparisons for a single page were not True
                 if not clear:
                     break
-                            
+
         # Add page if all the regexps and operators have matched
         if clear:
             pagelist.add(page)
@@ -600,14 +859,11 @@ def metatable_parseargs(request, args,
             return True
         return request.graphdata.is_saved(name)
 
-    def can_be_read(name):
-        return request.user.may.read(name)
-
     # Only give saved pages
     pagelist = filter(is_saved, pagelist)
     # Only give pages that can be read by the current user
     if checkAccess:
-        pagelist = filter(can_be_read, pagelist)
+        pagelist = may_read_many(request.user, pagelist)
 
     metakeys = set([])
     if not keyspec:
@@ -637,47 +893,125 @@ def metatable_parseargs(request, args,
     if not orderspec:
         pagelist = sorted(pagelist, key=ordervalue)
     else:
-        orderkeys = [key for (direction, key) in orderspec]
-        orderpages = dict()
-
-        for page in pagelist:
-            ordermetas = get_metas(request, page, orderkeys, checkAccess=False)
-            for key, values in ordermetas.iteritems():
-                values = map(ordervalue, values)
-                ordermetas[key] = values
-            orderpages[page] = ordermetas
-
-        def comparison(page1, page2):
-            for direction, key in orderspec:
-                reverse = False
-                if direction == ">>":
-                    reverse = True
-
-                if key == "gwikipagename":
-                    values1 = [page1]
-                    values2 = [page2]
-                else:
-                    values1 = sorted(orderpages[page1][key], reverse=reverse)
-                    values2 = sorted(orderpages[page2][key], reverse=reverse)
-            
-                result = cmp(values1, values2)
-                if result == 0:
-                    continue
-            
-                if not values1:
-                    return 1
-                if not values2:
-                    return -1
-
-                if reverse:
-                    return -result
-                return result
-            return cmp(ordervalue(page1), ordervalue(page2))
-
-        pagelist = sorted(pagelist, cmp=comparison)
+        pagelist = sorted(pagelist, key=order_keys(request, pagelist,
+                                                   orderspec).__getitem__)
 
     return pagelist, metakeys, styles
 
+class MetaTableDependencies(object):
+    """
+    The pages and keys the result of a MetaTable query, and the values
+    shown for it, depend on. Used to tell whether the changes of the
+    graphdata change feed may have changed the rendered table.
+    """
+
+    def __init__(self):
+        # Pages whose data (including in-links) is used
+        self.pages = set()
+        # Regexps of page names that may be added to the query
+        self.page_regexps = list()
+        # For queries not limited to given pages, the keys a page
+        # must have to match the query, an empty set if any page may
+        self.keys = None
+        # Any change may change the result
+        self.everything = False
+
+    def affected_by(self, request, pagenames):
+        """
+        Return whether changes of the given pages may change the
+        result. Checks the current data of the pages, so the pages
+        that no longer match the query still need to be in self.pages.
+        """
+        if self.everything:
+            return bool(pagenames)
+
+        cache = request.cfg.cache
+        graphdata = request.graphdata
+        for name in pagenames:
+            if name in self.pages:
+                return True
+            # Groups and dicts affect who may read what
+            if (cache.page_group_regexact.search(name) or
+                cache.page_dict_regexact.search(name)):
+                return True
+            for page_re in self.page_regexps:
+                if page_re.match(name):
+                    return True
+            if self.keys is None:
+                continue
+            if not self.keys:
+                return True
+            keys = set(graphdata.get_metakeys(name))
+            keys.update(graphdata.get_out(name))
+            if keys & self.keys:
+                return True
+        return False
+
+def metatable_dependencies(request, args, pagelist, metakeys):
+    """
+    Return the MetaTableDependencies of a query, given the pages and
+    keys metatable_parseargs returned for it, or None if the values
+    shown include macros, whose output may depend on anything.
+    """
+    if not args:
+        args = request.page.page_name
+    if '<<' in args:
+        return None
+
+    (argset, page_regexps, pageargs, keyspec, excluded_keys, orderspec,
+     limitregexps, limitvalues, limitops, indirection_keys, styles) = \
+        _metatable_plan(request, args)
+
+    deps = MetaTableDependencies()
+
+    keys = set(metakeys) | set(limitregexps) | set(limitops)
+    keys.update(key for direction, key in orderspec)
+    # Values through indirection come from pages not known here
+    if [key for key in keys if '->' in key]:
+        deps.everything = True
+        return deps
+
+    if pageargs or argset:
+        # Category members are in-links of the category page
+        deps.pages.update(argset)
+        deps.page_regexps.extend(page_regexps)
+    else:
+        deps.keys = set(limitregexps) | set(limitops)
+        # Pages without the key may match these
+        for key, complist in limitops.iteritems():
+            for comp, op in complist:
+                if op == '!=' or (op == '==' and not comp):
+                    deps.keys = set()
+        if 'gwikiinlinks' in deps.keys:
+            deps.keys = set()
+
+    graphdata = request.graphdata
+    for name in pagelist:
+        name = name.split('-gwikirevision-')[0]
+        deps.pages.add(name)
+        metas = graphdata.get_meta(name)
+        for key in metakeys:
+            for value in metas.get(key, ()):
+                if '<<' in value:
+                    return None
+        # Links are shown differently for pages that do not exist
+        for targets in graphdata.get_out(name).itervalues():
+            deps.pages.update(targets)
+        if 'gwikiinlinks' in keys:
+            for sources in graphdata.get_in(name).itervalues():
+                deps.pages.update(sources)
+
+    for key in metakeys:
+        if '<<' in key:
+            return None
+        # Key names are shown as wiki text, too
+        deps.pages.add(key)
+        if not key.endswith('Property'):
+            key = '%sProperty' % (key)
+        deps.pages.add(key)
+
+    return deps
+
 def get_properties(request, pagename):
     properties = dict()
     if pagename:
@@ -87,9 +87,503 @@ def is_meta_link(value):
             return val
     return str()
 
+# Processing instructions the wiki parser skips at the top of a page
+PROCESSING_INSTRUCTIONS = ("##", "#format", "#refresh", "#redirect",
+                           "#deprecated", "#pragma", "#form", "#acl",
+                           "#language")
+
+# Line breaks of unicode.splitlines the wiki parser does not break at
+SPLITLINES_RE = re.compile(u'\r(?!\n)|[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+class MetaScanner(object):
+    """
+    Collect the definitions (metas and typed links) of a page in one
+    pass over its lines. Gives the same definitions as formatting the
+    page with the link_collect parser and the null formatter, without
+    formatting anything: the lines are scanned with the regexps of the
+    wiki parser, and its state is only followed as far as it affects
+    the definitions.
+    """
+
+    scan_re = Parser.scan_re
+    parser_end_re = re.compile(Parser.parser_scan_rule %
+                               re.escape(Parser.parser_unique),
+                               re.VERBOSE | re.UNICODE)
+    eol_re = Parser.eol_re
+    indent_re = Parser.indent_re
+    ol_re = Parser.ol_re
+    dl_re = Parser.dl_re
+
+    def __init__(self, request, pagename):
+        self.request = request
+        self.pagename = pagename
+        self.cat_re = request.cfg.cache.page_category_regex
+        self.bang_meta = request.cfg.bang_meta
+
+        self.definitions = dict()
+        self.currentitems = list()
+        self.curdef = ''
+        self.prevdef = ''
+        self.ddline = 0
+        # Text of the current definition, kept by the formatter of
+        # the link_collect parser
+        self.textstorage = list()
+        self.lines = list()
+        self.lineno = 0
+
+        self.in_dd = 0
+        self.in_li = 0
+        self.in_pre = None
+        self.in_table = 0
+        self.list_indents = list()
+        self.list_types = list()
+
+    def scan(self, text):
+        """ Scan the text of the page, see Parser.format """
+        self.lines = self.eol_re.split(text.expandtabs())
+        in_processing_instructions = True
+
+        for line in self.lines:
+            self.lineno += 1
+
+            if in_processing_instructions:
+                lower = line.lower()
+                for pi in PROCESSING_INSTRUCTIONS:
+                    if lower.startswith(pi):
+                        break
+                else:
+                    in_processing_instructions = False
+                if in_processing_instructions:
+                    continue
+
+            if not self.in_pre:
+                line += ' '
+
+                if not line.strip():
+                    self.in_table = 0
+                    continue
+
+                indlen = len(self.indent_re.match(line).group(0))
+                indtype = "ul"
+                if indlen:
+                    if self.ol_re.match(line):
+                        indtype = "ol"
+                    elif self.dl_re.match(line):
+                        indtype = "dl"
+                self._indent_to(indlen, indtype)
+
+                is_row = (line[indlen:indlen + 2] == "||" and
+                          line.endswith("|| ") and len(line) >= 5 + indlen)
+                if not self.in_table and is_row:
+                    if self.list_types and not self.in_li:
+                        self.in_li = 1
+                    self.in_table = True
+                elif self.in_table and not (line.startswith("##") or is_row):
+                    self.in_table = 0
+
+            self._scan_line(line)
+
+        self._undent()
+
+    def categories(self):
+        """ Return the categories at the end of the page scanned, see
+        parse_categories """
+        categories = list()
+        for line in reversed(self.lines):
+            if not line.strip() or line.startswith("##"):
+                continue
+            candidates = line.split()
+            confirmed = filter_categories(self.request, candidates)
+            if len(confirmed) < len(candidates):
+                break
+            categories.extend(confirmed)
+        return categories
+
+    def _scan_line(self, line):
+        """ See Parser.scan """
+        lastpos = 0
+        line_length = len(line)
+
+        while lastpos <= line_length:
+            if self.in_pre:
+                match = self.parser_end_re.search(line, lastpos)
+            else:
+                match = self.scan_re.search(line, lastpos)
+
+            if not match:
+                if self.in_pre:
+                    if not (lastpos > 0 and line[lastpos:] == ''):
+                        self._parser_content(line[lastpos:])
+                elif line[lastpos:]:
+                    self._text(line[lastpos:])
+                break
+
+            start = match.start()
+            if lastpos < start:
+                if self.in_pre:
+                    self._parser_content(line[lastpos:start])
+                else:
+                    self._text(line[lastpos:start])
+
+            # The first group in the order of the groupdict, as in
+            # Parser.replace, as it decides the word given
+            groups = match.groupdict()
+            for name, hit in groups.items():
+                if hit is not None and name != 'hmarker':
+                    getattr(self, '_%s_repl' % name)(hit, groups)
+                    break
+
+            lastpos = match.end()
+            if start == lastpos:
+                lastpos += 1
+
+    def _text(self, text):
+        # Only text on the line of the definition is kept
+        if self.lineno == self.ddline:
+            self.textstorage.append(text)
+
+    def _add_meta(self, word, groups=None):
+        if not word.strip():
+            return
+        if self.in_dd and self.ddline == self.lineno:
+            self.textstorage.append(word)
+
+    def _add_textmeta(self, word, groups):
+        if not self.in_dd:
+            return
+        for name, value in groups.iteritems():
+            if value and name not in ['strike', 'small', 'big', 'remark']:
+                self._add_meta(value)
+
+    # Lists
+
+    def _indent_level(self):
+        return len(self.list_indents) and self.list_indents[-1]
+
+    def _indent_to(self, new_level, list_type):
+        closed = opened = False
+
+        if self._indent_level() != new_level and self.in_table:
+            self.in_table = 0
+
+        while self._indent_level() > new_level:
+            closed = True
+            self._close_item()
+            del self.list_indents[-1]
+            del self.list_types[-1]
+
+            if self.list_types:
+                if self.list_types[-1] == 'dl':
+                    self.in_dd = 1
+                else:
+                    self.in_li = 1
+
+        if self._indent_level() < new_level:
+            opened = True
+            self.list_indents.append(new_level)
+            self.list_types.append(list_type)
+            self.in_li = 0
+            self.in_dd = 0
+
+        if self.in_table and (opened or closed):
+            self.in_table = 0
+
+    def _close_item(self):
+        if self.in_dd:
+            self._undent()
+
+    def _undent(self):
+        if self.in_dd:
+            curkey = self.definitions.setdefault(self.curdef, list())
+
+            if ''.join(self.textstorage).strip():
+                curkey.append(('meta', ''.join(self.textstorage)))
+                self.textstorage = list()
+            if self.currentitems:
+                curkey.extend(self.currentitems)
+        else:
+            self.definitions.setdefault('_notype',
+                                        list()).extend(self.currentitems)
+
+        self.in_dd = 0
+        self.prevdef = self.curdef
+        self.curdef = '_notype'
+        self.currentitems = list()
+
+    def _dl_repl(self, word, groups):
+        if self.in_pre:
+            return
+
+        if self.currentitems and not self.curdef:
+            self.definitions.setdefault('_notype',
+                                        list()).extend(self.currentitems)
+        elif self.currentitems:
+            self.definitions.setdefault(self.curdef,
+                                        list()).extend(self.currentitems)
+
+        self.currentitems = list()
+        self.ddline = self.lineno
+
+        self._close_item()
+        self.in_dd = 1
+        self.textstorage = list()
+
+        definition = word[1:-3].strip(' ')
+        if definition != "":
+            self.curdef = definition
+        else:
+            self.curdef = self.prevdef
+
+    def _li_repl(self, word, groups):
+        self._close_item()
+        self.in_li = 1
+
+    _ol_repl = _li_repl
+    _li_none_repl = _li_repl
+
+    def _indent_repl(self, word, groups):
+        if not (self.in_li or self.in_dd):
+            self.in_li = 1
+
+    def _rule_repl(self, word, groups):
+        self._undent()
+
+    def _table_repl(self, word, groups):
+        if not self.in_table:
+            self._text(word)
+
+    _tableZ_repl = _table_repl
+
+    def _heading_repl(self, word, groups):
+        self._text(groups.get('heading_text', ''))
+
+    _heading_text_repl = _heading_repl
+
+    def _comment_repl(self, word, groups):
+        pass
+
+    # Parser sections, only the contents of wiki sections are scanned
+
+    def _parser_repl(self, word, groups):
+        parser_name = groups.get('parser_name', None)
+
+        self.in_pre = 'search_parser'
+        if parser_name:
+            if parser_name == 'wiki':
+                self.in_pre = False
+            elif parser_name.strip():
+                self.in_pre = True
+
+        self._add_meta(word)
+
+    _parser_unique_repl = _parser_repl
+    _parser_line_repl = _parser_repl
+    _parser_name_repl = _parser_repl
+    _parser_args_repl = _parser_repl
+    _parser_nothing_repl = _parser_repl
+
+    def _parser_content(self, line):
+        if self.in_pre == 'search_parser' and line.strip():
+            line = line.strip()
+            if line.startswith("#!"):
+                parser_name = line[2:].split()
+                if parser_name and parser_name[0] == 'wiki':
+                    self.in_pre = False
+                    return
+            self.in_pre = True
+
+    def _parser_end_repl(self, word, groups):
+        self.in_pre = False
+        self._add_meta(word)
+
+    # Links
+
+    def _fix_attach_uri(self, target):
+        split = target.split(":", 1)
+        if len(split) != 2:
+            return target
+
+        scheme, att = split
+        if scheme in ('attachment', 'inline', 'drawing'):
+            if len(att.split('/')) == 1:
+                target = "%s:%s/%s" % (scheme, self.pagename, att)
+
+        return target
+
+    def _interwiki_repl(self, word, groups):
+        wikipage = "%s:%s" % (groups.get('interwiki_wiki'),
+                              groups.get('interwiki_page'))
+        self._add_meta(wikipage)
+        self.currentitems.append(('interwiki', (wikipage, wikipage)))
+
+    _interwiki_wiki_repl = _interwiki_repl
+    _interwiki_page_repl = _interwiki_repl
+
+    def _word_repl(self, word, groups):
+        if groups.get('word_bang'):
+            if self.bang_meta:
+                self._text("!%s" % word)
+                return
+            self._text('!')
+
+        abs_name = AbsPageName(self.pagename, groups.get('word_name'))
+        if abs_name == self.pagename:
+            self.currentitems.append(('wikilink', (abs_name, abs_name)))
+            self._add_meta(abs_name)
+            return
+
+        try:
+            abs_name, anchor = abs_name.rsplit("#", 1)
+        except ValueError:
+            anchor = ""
+
+        if self.cat_re.match(abs_name):
+            self.currentitems.append(('category', abs_name))
+            self._add_meta(abs_name)
+            return
+
+        if anchor:
+            wholename = "%s#%s" % (abs_name, anchor)
+        else:
+            wholename = abs_name
+        self.currentitems.append(('wikilink', (wholename, abs_name)))
+        self._add_meta(wholename)
+
+    _word_bang_repl = _word_repl
+    _word_name_repl = _word_repl
+    _word_anchor_repl = _word_repl
+
+    def _url_repl(self, word, groups):
+        target = groups.get('url_target', '')
+        self._add_meta(target)
+        self.currentitems.append(('url', (target, target)))
+
+    _url_target_repl = _url_repl
+    _url_scheme_repl = _url_repl
+
+    def _macro_repl(self, word, groups):
+        if groups.get('macro_name') == 'Include':
+            page_args = word.split(',')[0]
+            self.currentitems.append(('include', (page_args, word)))
+        self._add_meta(groups.get('macro'))
+
+    _macro_name_repl = _macro_repl
+    _macro_args_repl = _macro_repl
+
+    def _link_repl(self, word, groups):
+        raw = groups.get('link', '')
+        target = groups.get('link_target', '')
+        desc = groups.get('link_desc', '')
+
+        self._add_meta(raw)
+        target = self._fix_attach_uri(target)
+
+        # Extended links, like [[Page|key: description]]
+        if desc and ': ' in desc and not self.in_dd:
+            key = desc.split(': ')[0]
+            self.definitions.setdefault(key, list()).append(('wikilink',
+                                                             (raw, target)))
+        else:
+            self.currentitems.append(('wikilink', (raw, target)))
+
+    _link_target_repl = _link_repl
+    _link_desc_repl = _link_repl
+    _link_params_repl = _link_repl
+
+    def _transclude_repl(self, word, groups):
+        raw = groups.get('transclude', '')
+        target = groups.get('transclude_target', '')
+        self._add_meta(raw)
+
+        target = self._fix_attach_uri(target)
+        self.currentitems.append(('wikilink', (raw, target)))
+
+    _transclude_target_repl = _transclude_repl
+    _transclude_desc_repl = _transclude_repl
+    _transclude_params_repl = _transclude_repl
+
+    def _email_repl(self, word, groups):
+        self._add_meta(word)
+        self.currentitems.append(('wikilink', (word, 'mailto:%s' % word)))
+
+    # Markup kept in the values as written
+
+    _big_repl = _add_textmeta
+    _big_on_repl = _add_textmeta
+    _big_off_repl = _add_textmeta
+    _emph_ibb_repl = _add_textmeta
+    _emph_ibi_repl = _add_textmeta
+    _emph_ib_or_bi_repl = _add_textmeta
+    _emph_repl = _add_textmeta
+    _small_repl = _add_textmeta
+    _small_on_repl = _add_textmeta
+    _small_off_repl = _add_textmeta
+    _smiley_repl = _add_textmeta
+    _strike_repl = _add_textmeta
+    _strike_on_repl = _add_textmeta
+    _strike_off_repl = _add_textmeta
+
+    _entity_repl = _add_meta
+    _remark_repl = _add_meta
+    _remark_on_repl = _add_meta
+    _remark_off_repl = _add_meta
+    _sgml_entity_repl = _add_meta
+    _sub_repl = _add_meta
+    _sub_text_repl = _add_meta
+    _sup_repl = _add_meta
+    _sup_text_repl = _add_meta
+    _tt_bt_repl = _add_meta
+    _tt_bt_text_repl = _add_meta
+    _tt_repl = _add_meta
+    _tt_text_repl = _add_meta
+    _u_repl = _add_meta
+
+def _acl_lines(text):
+    """ Return the arguments of the acl processing instructions at the
+    top of the text, see get_processing_instructions """
+    acls = list()
+    pos = 0
+    while text.startswith('#', pos):
+        end = text.find('\n', pos)
+        if end < 0:
+            end = len(text)
+        line = text[pos:end]
+        pos = end + 1
+
+        # end parsing on empty (invalid) PI
+        if line == "#":
+            break
+
+        verb, args = (line[1:] + ' ').split(' ', 1)
+        if verb.lower() == u'acl':
+            acls.append(args.strip())
+    return acls
+
 def parse_text(request, page, text):
+    """
+    Return the graph data of a page with the given text: its metas,
+    typed links, categories and ACLs
+    """
     pagename = page.page_name
-    
+
+    scanner = MetaScanner(request, pagename)
+    scanner.scan(text)
+
+    if SPLITLINES_RE.search(text):
+        categories, _, _ = parse_categories(request, text)
+    else:
+        categories = scanner.categories()
+
+    return _page_data(pagename, scanner.definitions, categories,
+                      _acl_lines(text))
+
+def _parse_text_with_parser(request, page, text):
+    """
+    parse_text by formatting the page with the link_collect parser,
+    to compare MetaScanner with
+    """
+    pagename = page.page_name
+
     newreq = request
     newreq.page = lcpage = LinkCollectingPage(newreq, pagename, text)
     parserclass = lcparser
@@ -99,26 +593,30 @@ def parse_text(request, page, text):
     p = parserclass(lcpage.get_raw_body(), newreq, formatter=lcpage.formatter)
     lcpage.parser = p
     lcpage.format(p)
-    
-    # These are the match types that really should be noted
-    linktypes = ["wikiname_bracket", "word",                  
-                 "interwiki", "url", "url_bracket"]
-    
-    new_data = dict()
 
     # Add the page categories as links too
     categories, _, _ = parse_categories(request, text)
 
     # Process ACL:s
+    acls = list()
     pi, _ = get_processing_instructions(text)
     for verb, args in pi:
         if verb == u'acl':
-            # Add all ACL:s on multiple lines to an one-lines
-            acls = new_data.get(pagename, dict()).get('acl', '')
-            acls = acls.strip() + args
-            new_data.setdefault(pagename, dict())['acl'] = acls
+            acls.append(args)
+
+    return _page_data(pagename, p.definitions, categories, acls)
+
+def _page_data(pagename, definitions, categories, acls):
+    new_data = dict()
+
+    for args in acls:
+        # Keep the ACL lines apart, each ending with a newline,
+        # so that they can be parsed as the page does
+        acl = new_data.get(pagename, dict()).get('acl', '')
+        acl = acl + args + u'\n'
+        new_data.setdefault(pagename, dict())['acl'] = acl
 
-    for metakey, value in p.definitions.iteritems():
+    for metakey, value in definitions.iteritems():
         for ltype, item in value:
             dnode = None
 
@@ -784,6 +1282,31 @@ def format_wikitext(request, data, parser=None):
     request.page.formatter = request.formatter
     request.formatter.page = request.page
 
+    if parser is None or not parser.in_pre:
+        # Values without any markup are just text
+        if not Parser.scan_re.search(data):
+            request.formatter.in_p = 1
+            return request.formatter.text(data).strip()
+
+        # Values repeat a lot in metadata listings. Macros may give
+        # something different each time, and an unclosed preformatted
+        # section changes how the next values are parsed.
+        if '<<' not in data:
+            key = (data, request.page.page_name,
+                   request.formatter.__class__, request.lang)
+            cache = request.wikitext_cache
+            out = cache.get(key)
+            if out is None:
+                out = _format_wikitext(request, data, parser)
+                if parser is None or not parser.in_pre:
+                    cache[key] = out
+            else:
+                request.formatter.in_p = 1
+            return out
+
+    return _format_wikitext(request, data, parser)
+
+def _format_wikitext(request, data, parser=None):
     if not parser:
         parser = Parser(data, request)
     else:
@@ -0,0 +1,80 @@
+# -*- coding: iso-8859-1 -*-
+"""
+MoinMoin - eventqueue script
+
+@license: GNU GPL, see COPYING for details.
+"""
+
+import time
+
+from MoinMoin import config
+from MoinMoin.events import eventqueue
+from MoinMoin.script import MoinScript
+
+class PluginScript(MoinScript):
+    """\
+Purpose:
+========
+This script shows the events waiting in the event queue for the event
+handlers configured in event_queue_handlers, and delivers them.
+
+Detailed Instructions:
+======================
+General syntax: moin [options] maint eventqueue [eventqueue-options]
+
+[options] usually should be:
+    --config-dir=/path/to/my/cfg/ --wiki-url=http://wiki.example.org/
+
+[eventqueue-options] see below:
+    --drain    deliver all queued events now, also those waiting for a retry
+               (default: just show the queued events)
+    --drop     remove all queued events without delivering them
+"""
+
+    def __init__(self, argv, def_values):
+        MoinScript.__init__(self, argv, def_values)
+
+        self.parser.add_option(
+            "--drain", action="store_true", dest="drain",
+            help="deliver all queued events now, also those waiting for a retry"
+        )
+        self.parser.add_option(
+            "--drop", action="store_true", dest="drop",
+            help="remove all queued events without delivering them"
+        )
+
+    def mainloop(self):
+        self.init_request()
+        queue = eventqueue.get_queue(self.request)
+        queue.recover()
+
+        if self.options.drop:
+            for name in queue.names():
+                workname = queue.claim(name)
+                if workname is not None:
+                    queue.remove(workname)
+            return
+
+        if self.options.drain:
+            # each handler gets each event once
+            count = queue.process(drain=True)
+            print "%d events delivered, %d left in the queue." % (count, len(queue.names()))
+            return
+
+        names = queue.names()
+        for name in names:
+            try:
+                data = queue.load(name)
+            except (IOError, OSError):
+                continue # delivered meanwhile
+            queued = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data['queued']))
+            attrs = data['attrs']
+            pagename = (attrs.get('page') or attrs.get('pagename') or (None, u''))[1]
+            print "%s %s %s" % (queued, data['event'], pagename.encode(config.charset))
+            for handler, (tries, retry) in sorted(data['pending'].items()):
+                if tries:
+                    retry = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(retry))
+                    print "    %s: %d failed, retry at %s" % (handler, tries, retry)
+                else:
+                    print "    %s" % (handler, )
+        print "%d events in the queue." % len(names)
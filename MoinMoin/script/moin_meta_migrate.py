@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    moin-meta-migrate
+     - Converts the graph data shelve of a wiki into an SQLite database
+       usable with dbconfig = {'backend': 'sqlite'}.
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+
+import os, sys
+
+from codecs import getencoder
+from optparse import OptionParser
+
+from MoinMoin import config
+from MoinMoin.script import MinimalMoinScript
+
+def run():
+    usage = "usage: %prog [options] <path-to-wiki>\n"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-f", "--file", dest="filename",
+                      help="read shelve from FILE instead of the wiki's "
+                      "graphdata.shelve")
+
+    parser.add_option("-o", "--output", dest="output",
+                      help="write the SQLite database to OUTPUT instead "
+                      "of the wiki's graphdata.sqlite")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        print >> sys.stderr, parser.format_help()
+        sys.exit(3)
+
+    # Encoder from unicode to charset selected in config
+    encoder = getencoder(config.charset)
+    def _e(str):
+        return encoder(str, 'replace')[0]
+
+    wikipath = args[0]
+    configdir = os.path.abspath(os.path.join(wikipath, 'config'))
+    sys.path.insert(0, configdir)
+
+    request = MinimalMoinScript(parse=False)
+
+    from MoinMoin.metadata.backend import shelvedb, sqlitedb
+
+    source = shelvedb.GraphData(request)
+    if options.filename:
+        if not os.path.isfile(options.filename):
+            sys.stderr.write("Source not a file: %s\n" % (options.filename))
+            sys.exit(1)
+        source.graphshelve = options.filename
+
+    if options.output and os.path.exists(options.output):
+        sys.stderr.write("Destination already exists: %s\n" %
+                         (options.output))
+        sys.exit(1)
+    target = sqlitedb.GraphData(request, dbfile=options.output)
+    if not options.output and target.keys():
+        sys.stderr.write("Destination not empty: %s\n" % (target.dbfile))
+        sys.exit(1)
+
+    pages = source.keys()
+    total = len(pages)
+    padding = len(str(total))
+
+    try:
+        for count, pagename in enumerate(pages):
+            print "(%*d/%*d) Migrating %s " % (padding, count + 1,
+                                                padding, total, _e(pagename))
+            target.savepage(pagename, source[pagename])
+            # Keep the memory footprint of the read side flat
+            source.cache.clear()
+
+        position = source.get_sync_position()
+        if position is not None:
+            target.set_sync_position(position)
+    except:
+        target.abort()
+        raise
+    finally:
+        source.close()
+
+    target.commit()
+    target.close()
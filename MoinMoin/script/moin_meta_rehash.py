@@ -4,6 +4,13 @@
     moin-meta-rehash
      - (Re-)saves graph data from all or selected pages of a wiki.
 
+       With --jobs, pages are parsed in a pool of processes and the
+       graph data is built into a side database next to the wiki's
+       own, which keeps working meanwhile. Progress is checkpointed
+       after every batch, so an interrupted rehash can be continued
+       with --resume. Pages edited during the rehash are parsed again
+       before the side database atomically replaces the wiki's one.
+
     @copyright: 2006-2016 by Juhani Eronen <exec@iki.fi>
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 
@@ -40,10 +47,137 @@ from MoinMoin.script import MoinScript
 from MoinMoin.Page import Page, RootPage
 from MoinMoin import config
 
-from MoinMoin.metadata.edit import underlay_to_pages, savegraphdata
+from MoinMoin.metadata.edit import underlay_to_pages, savegraphdata, \
+    parse_page, store_page, edited_pages
 
 from MoinMoin.script import MinimalMoinScript
 
+# Request of a parser process
+_worker_request = None
+
+def _init_worker():
+    global _worker_request
+    _worker_request = MinimalMoinScript(parse=False)
+
+def _parse_worker(pagename):
+    return pagename, parse_page(_worker_request, pagename)
+
+def _read_checkpoint(path):
+    """ Return the edit log position and the last page rehashed """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        position, last = f.read().split('\n', 1)
+    finally:
+        f.close()
+    return int(position), last.decode('utf-8')
+
+def _write_checkpoint(path, position, last):
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        f.write('%d\n%s' % (position, last.encode('utf-8')))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def parallel_rehash(request, pagenames, jobs, batch, resume, _e):
+    """
+    Rehash pages into a side copy of the graph data and swap it in
+    """
+    # Fork the parsers before any databases are opened
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, _init_worker)
+    else:
+        pool = None
+        _init_worker()
+
+    graphdata = request.graphdata
+    checkpoint_path = os.path.join(request.cfg.data_dir, 'graphdata',
+                                   'rehash.checkpoint')
+
+    checkpoint = None
+    if resume:
+        checkpoint = _read_checkpoint(checkpoint_path)
+
+    if checkpoint is None:
+        # Start over from an empty side copy
+        graphdata.side_copy().drop()
+
+        # Edits after this are parsed again at the end
+        position = edited_pages(request)[1]
+        last = u''
+        _write_checkpoint(checkpoint_path, position, last)
+    else:
+        position, last = checkpoint
+        sys.stderr.write("Resuming after %s\n" % (_e(last)))
+
+    side = graphdata.side_copy()
+    pagenames = [x for x in sorted(pagenames) if x > last]
+    total = len(pagenames)
+    padding = len(str(total))
+
+    if pool is not None:
+        results = pool.imap(_parse_worker, pagenames, 16)
+    else:
+        results = (_parse_worker(x) for x in pagenames)
+
+    try:
+        for count, (pagename, parsed) in enumerate(results):
+            print "(%*d/%*d) Rehashing %s " % (padding, count + 1,
+                                               padding, total,
+                                               _e(pagename))
+            if parsed is not None:
+                store_page(request, side, pagename, *parsed)
+
+            if (count + 1) % batch == 0 or count + 1 == total:
+                side.commit()
+                side.close()
+                _write_checkpoint(checkpoint_path, position, pagename)
+                last = pagename
+    except:
+        side.abort()
+        side.close()
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Catch up with the edits made while rehashing, and with those
+    # made after that while the graph data is being replaced, so that
+    # no save lands between the last check and the swap
+    def catch_up(graphdata, position):
+        pagenames, end = edited_pages(request, position)
+        for pagename in sorted(pagenames):
+            print "Rehashing edited %s " % (_e(pagename))
+            parsed = parse_page(request, pagename)
+            if parsed is not None:
+                store_page(request, graphdata, pagename, *parsed)
+        return pagenames, end
+
+    while True:
+        pagenames, end = catch_up(side, position)
+        if not pagenames:
+            break
+        side.commit()
+        side.close()
+        position = end
+        _write_checkpoint(checkpoint_path, position, last)
+
+    def final_catch_up(graphdata):
+        end = catch_up(graphdata, position)[1]
+        graphdata.set_sync_position(end)
+
+    graphdata.replace_with(side, final_catch_up)
+    os.unlink(checkpoint_path)
+    sys.stderr.write("Replaced the graph data with the rehashed one\n")
+
 def run():
     pages = []
     retain_shelve = False
@@ -54,10 +188,25 @@ def run():
     parser.add_option("-f", "--file", dest="filename",
                       help="write shelve to FILE")
 
-    parser.add_option("-u", "--update_underlay", dest="underlay_only", 
+    parser.add_option("-u", "--update_underlay", dest="underlay_only",
                       action='store_true', default=False,
                       help="Only update underlay pages")
 
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=0,
+                      help="parse pages in JOBS processes and rebuild the "
+                      "graph data into a side database that replaces the "
+                      "current one when done")
+
+    parser.add_option("-b", "--batch", dest="batch", type="int",
+                      default=200,
+                      help="with --jobs, commit and checkpoint after every "
+                      "BATCH pages (default %default)")
+
+    parser.add_option("-r", "--resume", dest="resume",
+                      action='store_true', default=False,
+                      help="with --jobs, continue an interrupted rehash "
+                      "from its last checkpoint")
+
     (options, args) = parser.parse_args()
     help = parser.format_help()
 
@@ -80,7 +229,7 @@ def run():
 
         # Get a list of all pages
         root = RootPage(request)
-        filter=None
+        filter = None
         if options.underlay_only:
             retain_shelve = True
 
@@ -116,6 +265,18 @@ def run():
         print >> sys.stderr, help
         sys.exit(2)
 
+    if options.jobs or options.resume:
+        if options.filename or options.underlay_only or len(args) > 1:
+            print >> sys.stderr, "--jobs always rehashes all pages " + \
+                "into the wiki's graph data"
+            print >> sys.stderr, help
+            sys.exit(3)
+
+        parallel_rehash(request, [x.page_name for x in pages],
+                        max(options.jobs, 1), max(options.batch, 1),
+                        options.resume, _e)
+        return
+
     if not retain_shelve:
         gddir = os.path.join(datadir, 'graphdata')
         if os.path.exists(gddir):
@@ -137,6 +298,8 @@ def run():
     # Just init one request
     scriptcontext = MinimalMoinScript(parse=False)
     scriptcontext.graphdata.clear_metas()
+    # Edits after this are picked up by moin-meta-sync
+    position = edited_pages(scriptcontext)[1]
     # If you want to rehash into separate shelve, ignore locks, create a
     # new shelve from scratch
     if options.filename:
@@ -145,7 +308,7 @@ def run():
         scriptcontext._graphdata.close()
         if os.path.exists(options.filename):
             if not os.path.isfile(options.filename):
-                sys.stderr.write("Destination not a file: %s\n" % 
+                sys.stderr.write("Destination not a file: %s\n" %
                                  (options.filename))
                 sys.exit(1)
             os.unlink(options.filename)
@@ -168,5 +331,7 @@ def run():
 
     # Must finish the scriptcontext to ensure that metadata is saved & committed
     scriptcontext.finish()
+    if not retain_shelve:
+        scriptcontext.graphdata.set_sync_position(position)
     scriptcontext.graphdata.commit()
     scriptcontext.graphdata.close()
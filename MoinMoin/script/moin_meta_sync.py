@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    moin-meta-sync
+     - Updates the graph data of the pages edited, renamed or deleted
+       since the last sync, as found from the edit log of the wiki.
+       Useful eg. after restoring a backup or copying pages into the
+       wiki outside of it. Doing nothing is cheap, so it can be run
+       from cron every minute.
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+
+import os, sys
+
+from codecs import getencoder
+from optparse import OptionParser
+
+from MoinMoin import config
+from MoinMoin.script import MinimalMoinScript
+
+from MoinMoin.metadata.edit import sync_graphdata
+
+def run():
+    usage = "usage: %prog [options] <path-to-wiki>\n"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-q", "--quiet", dest="quiet",
+                      action='store_true', default=False,
+                      help="do not list the synced pages")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        print >> sys.stderr, parser.format_help()
+        sys.exit(3)
+
+    # Encoder from unicode to charset selected in config
+    encoder = getencoder(config.charset)
+    def _e(str):
+        return encoder(str, 'replace')[0]
+
+    wikipath = args[0]
+    configdir = os.path.abspath(os.path.join(wikipath, 'config'))
+    sys.path.insert(0, configdir)
+
+    request = MinimalMoinScript(parse=False)
+
+    try:
+        pagenames = sync_graphdata(request)
+    except:
+        request.graphdata.abort()
+        raise
+    finally:
+        request.graphdata.close()
+
+    if not options.quiet:
+        for pagename in sorted(pagenames):
+            print "Synced %s" % (_e(pagename))
@@ -23,6 +23,10 @@ import re
 
 from MoinMoin import wikiutil, user
 from MoinMoin.Page import Page
+from MoinMoin.util.lru import LRUCache
+
+# Parsed ACLs of the pages kept by cfg.cache.acl_strings
+ACL_STRINGS_CACHE_SIZE = 1024
 
 #############################################################################
 ### Basic Permissions Interface -- most features enabled by default
@@ -94,6 +98,137 @@ def _check(request, pagename, username, right):
     return False
 
 
+class PermissionMemo(object):
+    """ Results of the permission checks of several consecutive actions
+    within one request, eg. the calls of an xmlrpc system.multicall
+
+    Install an instance as request.permission_memo for the duration of
+    those actions. A result is kept until its page is edited, editing
+    a group or dict page forgets all of them, as does changing the user
+    of the request. With hierarchic ACLs the results also depend on the
+    parent pages, nothing is kept then.
+    """
+
+    def __init__(self, request):
+        self.results = {}
+        self.user = request.user
+        self.log_pos = request.editlog.size()
+
+    def refresh(self, request):
+        """ Forget the results that edits made since the last refresh
+        may have changed """
+        if request.user is not self.user:
+            self.user = request.user
+            self.results.clear()
+
+        self.log_pos, pagenames = request.editlog.news(self.log_pos)
+        cache = request.cfg.cache
+        for pagename in pagenames:
+            if (cache.page_group_regexact.search(pagename) or
+                cache.page_dict_regexact.search(pagename)):
+                self.results.clear()
+                break
+            self.results.pop(pagename, None)
+
+    def check(self, request, pagename, username, right):
+        """ Same as _check, but remembering the result """
+        if request.cfg.acl_hierarchic:
+            return _check(request, pagename, username, right)
+
+        self.refresh(request)
+        results = self.results.setdefault(pagename, {})
+        key = (username, right)
+        if key not in results:
+            results[key] = _check(request, pagename, username, right)
+        return results[key]
+
+
+def _check_memo(request, pagename, username, right):
+    """ _check through the permission memo of the request, if any """
+    memo = getattr(request, 'permission_memo', None)
+    if memo is None:
+        return _check(request, pagename, username, right)
+    return memo.check(request, pagename, username, right)
+
+
+def _stored_acl(cfg, aclstring):
+    """ Return the AccessControlList of an ACL string stored in graphdata
+
+    The string has the #acl lines of the page, each ending with a newline.
+    The parsed lists are shared by all the pages with the same ACL string.
+
+    @param cfg: current config
+    @param aclstring: ACL string stored in graphdata
+    @rtype: MoinMoin.security.AccessControlList
+    @return: ACL of the pages, or None if the string is of an old format
+    """
+    if aclstring and not aclstring.endswith(u'\n'):
+        # Saved before the lines were kept apart, several #acl lines
+        # were then concatenated together
+        return None
+
+    acl = cfg.cache.acl_strings.get(aclstring)
+    if acl is None:
+        acl = AccessControlList(cfg, aclstring.split(u'\n')[:-1])
+        cfg.cache.acl_strings[aclstring] = acl
+    return acl
+
+
+def may_read_many(user, pagenames):
+    """ Return the pages of pagenames that user may read, in order
+
+    Gives the same answers as calling user.may.read for each page, but
+    uses the page ACLs stored in graphdata instead of reading them from
+    the pages, and checks each different ACL only once. Pages with no
+    ACL stored, and all pages with hierarchic ACLs or a security policy
+    that checks reading on its own, are checked with user.may.read.
+
+    @param user: the user
+    @param pagenames: iterable of page names
+    @rtype: list
+    @return: the pages the user may read
+    """
+    request = user._request
+    may = user.may
+    pagenames = list(pagenames)
+
+    policy = may.__class__
+    if (request.cfg.acl_hierarchic or not isinstance(may, Permissions) or
+        hasattr(policy, 'read') or
+        policy.__getattr__.im_func is not Permissions.__getattr__.im_func):
+        return [name for name in pagenames if may.read(name)]
+
+    acls = request.graphdata.get_acls(pagenames)
+    cache = request.cfg.cache
+    username = user.name
+    results = {}
+
+    def check(acl):
+        allowed = cache.acl_rights_before.may(request, username, 'read')
+        if allowed is None:
+            allowed = acl.may(request, username, 'read')
+        if allowed is None:
+            allowed = cache.acl_rights_after.may(request, username, 'read')
+        return bool(allowed)
+
+    readable = []
+    for name in pagenames:
+        aclstring = acls.get(name)
+        if aclstring is None:
+            allowed = may.read(name)
+        elif aclstring in results:
+            allowed = results[aclstring]
+        else:
+            acl = _stored_acl(request.cfg, aclstring)
+            if acl is None:
+                allowed = may.read(name)
+            else:
+                allowed = results[aclstring] = check(acl)
+        if allowed:
+            readable.append(name)
+    return readable
+
+
 class Permissions:
     """ Basic interface for user permissions and system policy.
 
@@ -147,7 +282,7 @@ class Permissions:
         request = self.request
         if attr not in request.cfg.acl_rights_valid:
             raise AttributeError(attr)
-        return lambda pagename: _check(self.request, pagename, self.name, attr)
+        return lambda pagename: _check_memo(self.request, pagename, self.name, attr)
 
 
 # make an alias for the default policy
@@ -10,6 +10,10 @@
     @license: GNU GPL, see COPYING for details.
 """
 
+import os
+import shutil
+import tempfile
+
 import py
 
 from MoinMoin import security
@@ -17,6 +21,7 @@ acliter = security.ACLStringIterator
 AccessControlList = security.AccessControlList
 
 from MoinMoin.datastruct import ConfigGroups
+from MoinMoin.metadata.backend import sqlitedb
 from MoinMoin.PageEditor import PageEditor
 from MoinMoin.user import User
 
@@ -391,4 +396,117 @@ class TestPageAcls(object):
             for right in mayNot:
                 yield _not_have_right, u, right, pagename, hierarchic
 
+class TestMayReadMany(object):
+    """ security: reading many pages with the ACLs stored in graphdata
+    """
+    pages = [
+        # pagename, content
+        (u'MayReadManyPublic', u"#acl All:read\nEveryone may read me"),
+        (u'MayReadManyJoe', u"#acl JoeDoe:read\n#acl JaneDoe:\nOnly JoeDoe"),
+        (u'MayReadManyJane', u"#acl JaneDoe:read,write\nOnly JaneDoe"),
+        (u'MayReadManyEmpty', u"#acl\nNobody may read me"),
+        (u'MayReadManyDefault', u"No ACL here"),
+    ]
+
+    from MoinMoin._tests import wikiconfig
+    class Config(wikiconfig.Config):
+        acl_rights_before = u"WikiAdmin:admin,read,write,delete,revert"
+        acl_rights_default = u"Known:read All:"
+        acl_rights_after = u""
+        acl_hierarchic = False
+
+    def setup_class(self):
+        self.tempdir = tempfile.mkdtemp()
+        dbfile = os.path.join(self.tempdir, 'graphdata.sqlite')
+        self.graphdata = sqlitedb.GraphData(self.request, dbfile=dbfile)
+        self.old_graphdata = self.request.__dict__.pop('_graphdata', None)
+        self.request.__dict__['_graphdata'] = self.graphdata
+
+        self.savedUser = self.request.user.name
+        self.request.user = User(self.request, auth_username=u'WikiAdmin')
+        self.request.user.valid = True
+
+        for page_name, page_content in self.pages:
+            create_page(self.request, page_name, page_content)
+
+    def teardown_class(self):
+        self.request.user.name = self.savedUser
+
+        for page_name, dummy in self.pages:
+            nuke_page(self.request, page_name)
+
+        self.request.__dict__.pop('_graphdata', None)
+        if self.old_graphdata is not None:
+            self.request.__dict__['_graphdata'] = self.old_graphdata
+        self.graphdata.close()
+        shutil.rmtree(self.tempdir)
+
+    def testSameAsMayRead(self):
+        """ security: may_read_many agrees with may.read """
+        pagenames = [name for name, dummy in self.pages]
+        pagenames.append(u'MayReadManyNonexisting')
+
+        for username in [u'WikiAdmin', u'JoeDoe', u'JaneDoe', u'AnyUser']:
+            u = User(self.request, auth_username=username)
+            u.valid = True
+            expected = [name for name in pagenames if u.may.read(name)]
+            assert security.may_read_many(u, pagenames) == expected
+
+        u = User(self.request, auth_username=u'JoeDoe')
+        u.valid = True
+        assert security.may_read_many(u, pagenames) == [u'MayReadManyPublic',
+                                                        u'MayReadManyJoe']
+
+    def testStoredACLs(self):
+        """ security: ACL strings are parsed once and old ones are not used """
+        cfg = self.request.cfg
+        acls = self.graphdata.get_acls([u'MayReadManyJoe',
+                                        u'MayReadManyEmpty',
+                                        u'MayReadManyDefault',
+                                        u'MayReadManyNonexisting'])
+        assert acls == {u'MayReadManyJoe': u'JoeDoe:read\nJaneDoe:\n',
+                        u'MayReadManyEmpty': u'\n',
+                        u'MayReadManyDefault': u''}
+
+        acl = security._stored_acl(cfg, acls[u'MayReadManyJoe'])
+        assert acl.acl_lines == [u'JoeDoe:read', u'JaneDoe:']
+        assert security._stored_acl(cfg, acls[u'MayReadManyJoe']) is acl
+        assert security._stored_acl(cfg, u'\n').acl == []
+        assert security._stored_acl(cfg, u'').acl is None
+        assert security._stored_acl(cfg, u'JoeDoe:readJaneDoe:') is None
+
+class TestPermissionMemo(object):
+    """ security: remembering permission checks until the page is edited
+    """
+    pagename = u'PermissionMemoPage'
+
+    from MoinMoin._tests import wikiconfig
+    class Config(wikiconfig.Config):
+        acl_rights_before = u"WikiAdmin:admin,read,write,delete,revert"
+        acl_rights_default = u"All:read"
+        acl_hierarchic = False
+
+    def setup_method(self, method):
+        self.savedUser = self.request.user.name
+        self.request.user = User(self.request, auth_username=u'WikiAdmin')
+        self.request.user.valid = True
+        create_page(self.request, self.pagename, u"#acl JoeDoe:read\n")
+        self.request.permission_memo = security.PermissionMemo(self.request)
+
+    def teardown_method(self, method):
+        self.request.permission_memo = None
+        self.request.user.name = self.savedUser
+        nuke_page(self.request, self.pagename)
+
+    def testMemo(self):
+        u = User(self.request, auth_username=u'JaneDoe')
+        u.valid = True
+        memo = self.request.permission_memo
+        assert not u.may.read(self.pagename)
+        assert memo.results[self.pagename] == {(u'JaneDoe', 'read'): False}
+
+        # Editing the page forgets the results of the page
+        PageEditor(self.request, self.pagename).saveText(u"#acl JaneDoe:read\n", 0)
+        assert u.may.read(self.pagename)
+
 coverage_modules = ['MoinMoin.security']
@@ -20,7 +20,7 @@
     @license: GNU GPL, see COPYING for details.
 """
 
-import os, time, codecs, base64
+import os, re, time, codecs, base64
 from copy import deepcopy
 import md5crypt
 import errno
@@ -159,7 +159,8 @@ def setMemoryLookupCaches(request, cache):
 def loadLookupCaches(request):
     """load lookup cache contents into memory: cfg.cache.XXX2id"""
     scope, arena, cachekey = 'userdir', 'users', 'lookup'
-    diskcache = caching.CacheEntry(request, arena, cachekey, scope=scope, use_pickle=True)
+    diskcache = caching.CacheEntry(request, arena, cachekey, scope=scope, use_pickle=True,
+                                   use_memory=True)
     try:
         cache = diskcache.content()
     except caching.CacheError:
@@ -221,6 +222,176 @@ def addLowerCaseKeys(cache):
     return c
 
 
+# Characters that make a page subscription a regular expression
+SUBSCRIPTION_REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+class SubscriptionIndex(object):
+    """ Index of the page subscriptions of all users
+
+    Subscriptions are both page names and regular expressions matching
+    whole page names. Those without any regular expression characters
+    can only match a page of the same name, so they are looked up from
+    a dict. The others are also matched as patterns. Patterns that do
+    not change the meaning of others (no groups, no inline flags) are
+    first tried all at once with a single combined expression, so that
+    a page no pattern matches costs one search.
+
+    The content dict is what is stored on disk, the compiled expressions
+    are made in memory when first needed.
+    """
+
+    def __init__(self, content=None):
+        if content is None:
+            content = {
+                'users': {}, # uid -> name, email, subscribed_pages
+                'names': {}, # subscription -> set of uids
+                'patterns': {}, # regex subscription -> set of uids
+            }
+        self.content = content
+        self._compiled = None
+
+    def add(self, uid, name, email, subscribed_pages):
+        """ Set the subscriptions of a user """
+        self.remove(uid)
+        if not subscribed_pages:
+            return
+
+        self.content['users'][uid] = {
+            'name': name,
+            'email': email,
+            'subscribed_pages': subscribed_pages,
+        }
+        for subscription in subscribed_pages:
+            self.content['names'].setdefault(subscription, set()).add(uid)
+            if SUBSCRIPTION_REGEX_CHARS.intersection(subscription):
+                self.content['patterns'].setdefault(subscription,
+                                                    set()).add(uid)
+        self._compiled = None
+
+    def remove(self, uid):
+        """ Remove all subscriptions of a user """
+        entry = self.content['users'].pop(uid, None)
+        if entry is None:
+            return
+
+        for subscription in entry['subscribed_pages']:
+            for index in self.content['names'], self.content['patterns']:
+                uids = index.get(subscription)
+                if uids is None:
+                    continue
+                uids.discard(uid)
+                if not uids:
+                    del index[subscription]
+        self._compiled = None
+
+    def _compile(self):
+        compiled = self._compiled
+        if compiled is not None:
+            return compiled
+
+        combinable, separate = [], []
+        for pattern in self.content['patterns']:
+            # Skip bad patterns
+            try:
+                regex = re.compile(r'^%s$' % pattern, re.M)
+            except re.error:
+                continue
+            if regex.groups or regex.flags != re.M:
+                separate.append((pattern, regex))
+            else:
+                combinable.append((pattern, regex))
+
+        combined = None
+        if combinable:
+            try:
+                combined = re.compile(r'^(?:%s)$' % '|'.join(
+                    ['(?:%s)' % pattern for pattern, regex in combinable]),
+                    re.M)
+            except (re.error, OverflowError, RuntimeError):
+                # Too large to combine, try all
+                pass
+
+        self._compiled = compiled = (combined, combinable, separate)
+        return compiled
+
+    def subscribers(self, pages):
+        """ Get the users subscribed to any of the pages
+
+        @param pages: list of page names and interwiki page names
+        @rtype: set
+        @return: user ids of the subscribers
+        """
+        uids = set()
+        for pagename in pages:
+            uids.update(self.content['names'].get(pagename, ()))
+
+        if self.content['patterns']:
+            combined, combinable, separate = self._compile()
+            # Create text for regular expression search
+            text = '\n'.join(pages)
+            candidates = separate
+            if combined is None or combined.search(text):
+                candidates = combinable + separate
+            for pattern, regex in candidates:
+                if regex.search(text):
+                    uids.update(self.content['patterns'][pattern])
+
+        return uids
+
+    def get_user(self, uid):
+        """ Get the name, email and subscribed_pages of a user """
+        return self.content['users'][uid]
+
+
+def loadSubscriptionIndex(request):
+    """ Get the page subscription index, built if it does not exist
+
+    The index last loaded from disk is kept in memory: cfg.cache.subscriptions
+    """
+    scope, arena, key = 'userdir', 'users', 'pagesubscriptions'
+    diskcache = caching.CacheEntry(request, arena, key, scope=scope, use_pickle=True)
+    uid = diskcache.uid()
+    if uid is None:
+        return rebuildSubscriptionIndex(request)
+
+    cached = getattr(request.cfg.cache, 'subscriptions', None)
+    if cached is not None and cached[0] == uid:
+        return cached[1]
+
+    try:
+        content = diskcache.content()
+    except caching.CacheError:
+        return rebuildSubscriptionIndex(request)
+    if not isinstance(content, dict) or 'names' not in content:
+        # Saved in the format used before the index
+        return rebuildSubscriptionIndex(request)
+
+    index = SubscriptionIndex(content)
+    request.cfg.cache.subscriptions = (uid, index)
+    return index
+
+
+def rebuildSubscriptionIndex(request):
+    """ Rebuild the page subscription index from all user profiles """
+    scope, arena, key = 'userdir', 'users', 'pagesubscriptions'
+    diskcache = caching.CacheEntry(request, arena, key, scope=scope, use_pickle=True, do_locking=False)
+    # lock to stop anybody else interfering with the data while we're working
+    diskcache.lock('w')
+
+    index = SubscriptionIndex()
+    for userid in getUserList(request):
+        u = User(request, userid)
+        # we don't care about storing entries for users without any page subscriptions
+        if u.subscribed_pages:
+            index.add(u.id, u.name, u.email, u.subscribed_pages)
+
+    diskcache.update(index.content)
+    diskcache.unlock()
+    request.cfg.cache.subscriptions = (diskcache.uid(), index)
+    return index
+
+
 def getUserId(request, searchName):
     """ Get the user ID for a specific user NAME.
 
@@ -1041,19 +1212,24 @@ class User:
             return  # if no cache file exists, just don't do anything
 
         cache.lock('w')
-        page_sub = cache.content()
+        try:
+            content = cache.content()
+        except caching.CacheError:
+            content = None
+        if not isinstance(content, dict) or 'names' not in content:
+            # unreadable or in an old format, rebuilt when next needed
+            cache.remove()
+            cache.unlock()
+            return
+        index = SubscriptionIndex(content)
 
         # we only store entries for valid users with some page subscriptions
         if self.valid and self.subscribed_pages:
-            page_sub[self.id] = {
-                'name': self.name,
-                'email': self.email,
-                'subscribed_pages': self.subscribed_pages,
-            }
-        elif page_sub.get(self.id):
-            del page_sub[self.id]
+            index.add(self.id, self.name, self.email, self.subscribed_pages)
+        else:
+            index.remove(self.id)
 
-        cache.update(page_sub)
+        cache.update(index.content)
         cache.unlock()
 
     def updateLookupCaches(self):
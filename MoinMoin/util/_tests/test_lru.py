@@ -0,0 +1,57 @@
+# -*- coding: iso-8859-1 -*-
+"""
+    MoinMoin - MoinMoin.util.lru Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import py
+
+from MoinMoin.util.lru import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_eviction(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache[key] = key.upper()
+        assert cache.get('a') == 'A'
+
+        # b is now the least recently used entry
+        cache['d'] = 'D'
+        assert 'b' not in cache
+        assert len(cache) == 3
+        assert cache.keys() == ['d', 'a', 'c']
+
+    def test_update(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] = 3
+        cache['c'] = 4
+        assert cache.keys() == ['c', 'a']
+        assert cache['a'] == 3
+
+    def test_missing(self):
+        cache = LRUCache(2)
+        assert cache.get('a') is None
+        assert cache.get('a', 1) == 1
+        py.test.raises(KeyError, cache.__getitem__, 'a')
+        assert cache.pop('a') is None
+        assert cache.misses == 3
+
+    def test_remove(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert cache.pop('a') == 1
+        del cache['b']
+        assert len(cache) == 0
+        assert cache.keys() == []
+
+        cache['c'] = 3
+        cache.clear()
+        assert 'c' not in cache
+
+coverage_modules = ['MoinMoin.util.lru']
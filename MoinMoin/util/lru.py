@@ -0,0 +1,136 @@
+# -*- coding: iso-8859-1 -*-
+"""
+    MoinMoin - size bounded LRU cache
+
+    A mapping that keeps at most maxsize entries and drops the least
+    recently used ones first. All operations are O(1) and serialized
+    with a lock, so a single instance can be shared by all the threads
+    of a process.
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import threading
+
+# Indexes into the entries of the doubly linked list
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+_missing = object()
+
+
+class LRUCache(object):
+    """ Process-wide least recently used cache
+
+    The most recently used entry is kept right after the root of a
+    circular doubly linked list, so the entry to drop is always the one
+    right before the root.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, entry):
+        prev, next = entry[PREV], entry[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+
+    def _link_first(self, entry):
+        root = self._root
+        first = root[NEXT]
+        entry[PREV], entry[NEXT] = root, first
+        first[PREV] = root[NEXT] = entry
+
+    def get(self, key, default=None):
+        """ Return the value for key and mark it as recently used """
+        self._lock.acquire()
+        try:
+            entry = self._map.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(entry)
+            self._link_first(entry)
+            return entry[VALUE]
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            entry = self._map.get(key)
+            if entry is not None:
+                self._unlink(entry)
+                entry[VALUE] = value
+            else:
+                entry = [None, None, key, value]
+                self._map[key] = entry
+            self._link_first(entry)
+
+            while len(self._map) > self.maxsize:
+                last = self._root[PREV]
+                self._unlink(last)
+                del self._map[last[KEY]]
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._map.pop(key)
+            self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """ Remove key and return its value, or default if missing """
+        self._lock.acquire()
+        try:
+            entry = self._map.pop(key, None)
+            if entry is None:
+                return default
+            self._unlink(entry)
+            return entry[VALUE]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def keys(self):
+        """ Keys from the most to the least recently used """
+        self._lock.acquire()
+        try:
+            result = []
+            entry = self._root[NEXT]
+            while entry is not self._root:
+                result.append(entry[KEY])
+                entry = entry[NEXT]
+            return result
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.web.surge Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import os
+import shutil
+import tempfile
+
+import py
+
+from MoinMoin.web import surge
+from MoinMoin.web.exceptions import SurgeProtection
+from MoinMoin.web.utils import check_surge_protect
+
+
+class SurgeLogTests(object):
+    """ tests shared by the request logs """
+    maxnum, dt, lockout = 3, 60, 3600
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.surgelog = self.make_log()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tempdir)
+
+    def hit(self, id, now, **kw):
+        return self.surgelog.hit(id, 'show', self.maxnum, now - self.dt,
+                                 now, self.lockout, **kw)
+
+    def test_limit(self):
+        now = 1000000
+        for i in range(self.maxnum + 1):
+            assert not self.hit('client', now + i)
+        assert self.hit('client', now + self.maxnum + 1)
+        # Other clients are not affected
+        assert not self.hit(u'Jürgen', now + self.maxnum + 1)
+
+        # The window has passed, and the client did not keep going
+        assert not self.hit('client', now + self.dt + self.maxnum + 2)
+
+    def test_kick(self):
+        now = 1000000
+        assert self.hit('client', now, kick=2 * self.maxnum)
+        # Locked out until the lockout time has passed
+        assert self.hit('client', now + self.dt + 1)
+        assert self.hit('client', now + self.lockout)
+        assert not self.hit('client', now + self.lockout + self.dt + 1)
+
+    def test_bounded(self):
+        now = 1000000
+        for i in range(10 * self.maxnum):
+            self.hit('client', now)
+        assert self.hit('client', now + 1)
+
+
+class TestSurgeLog(SurgeLogTests):
+
+    def make_log(self):
+        return surge.SurgeLog(2 * self.maxnum + 1, self.dt)
+
+
+class TestSharedSurgeLog(SurgeLogTests):
+
+    def setup_class(self):
+        if surge.mmap is None:
+            py.test.skip("no mmap and fcntl")
+
+    def make_log(self):
+        path = os.path.join(self.tempdir, 'surge-table')
+        return surge.SharedSurgeLog(path, 2 * self.maxnum + 1, self.dt)
+
+    def test_shared(self):
+        """ surge: logs of the same file see the hits of each other """
+        now = 1000000
+        other = self.make_log()
+        for i in range(self.maxnum + 1):
+            assert not self.hit('client', now)
+        assert other.hit('client', 'show', self.maxnum, now - self.dt, now,
+                         self.lockout)
+
+        # A table made for other limits is made again
+        path = os.path.join(self.tempdir, 'surge-table')
+        other = surge.SharedSurgeLog(path, 4 * self.maxnum + 1, self.dt)
+        assert not other.hit('client', 'show', self.maxnum, now - self.dt,
+                             now, self.lockout)
+
+
+class TestCheckSurgeProtect(object):
+    """ surge: check_surge_protect with the configured limits """
+
+    from MoinMoin._tests import wikiconfig
+    class Config(wikiconfig.Config):
+        surge_action_limits = {
+            'auth-name': (2, 60),
+            'all': (100, 60),
+        }
+
+    def setup_method(self, method):
+        # Local requests are not checked
+        self.remote_addr = self.request.environ.get('REMOTE_ADDR')
+        self.request.environ['REMOTE_ADDR'] = '192.0.2.1'
+
+    def teardown_method(self, method):
+        if self.remote_addr is None:
+            del self.request.environ['REMOTE_ADDR']
+        else:
+            self.request.environ['REMOTE_ADDR'] = self.remote_addr
+
+    def test_auth_name(self):
+        username = u'__Surge Test User %s__' % (os.getpid(), )
+        for i in range(3):
+            check_surge_protect(self.request, action='auth-name',
+                                username=username)
+        py.test.raises(SurgeProtection, check_surge_protect, self.request,
+                       action='auth-name', username=username)
+        # Other names are not affected
+        check_surge_protect(self.request, action='auth-name',
+                            username=username + u'2')
+
+coverage_modules = ['MoinMoin.web.surge']
@@ -18,6 +18,7 @@ from MoinMoin.config import multiconfig
 from MoinMoin.formatter import text_html
 from MoinMoin.theme import load_theme_fallback
 from MoinMoin.util.clock import Clock
+from MoinMoin.util.lru import LRUCache
 from MoinMoin.web.request import Request, MoinMoinFinish
 from MoinMoin.web.utils import UniqueIDGenerator
 from MoinMoin.web.exceptions import Forbidden, SurgeProtection
@@ -122,6 +123,12 @@ class BaseContext(Context):
 
     page = EnvironProxy('page', None)
 
+    # user id -> User of the editors in the edit-logs read by the request
+    editlog_users = EnvironProxy('editlog_users', lambda o: dict())
+
+    # metadata values rendered by the request, see wikitextutil.format_wikitext
+    wikitext_cache = EnvironProxy('wikitext_cache', lambda o: LRUCache(1024))
+
     # now the more complex factories
     def cfg(self):
         if self.request.given_config is not None:
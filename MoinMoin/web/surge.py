@@ -0,0 +1,254 @@
+# -*- coding: iso-8859-1 -*-
+"""
+    MoinMoin - surge protection request log
+
+    Keeps the times of the recent requests of each client and action,
+    as needed by MoinMoin.web.utils.check_surge_protect.
+
+    The times are kept in a table of fixed size slots in a memory mapped
+    file, shared by all wiki processes on the same host. Updating the
+    table only locks the file for the time of the update, and the table
+    is written to disk by the system in the background or by us once in
+    a while. Where the table can not be used, the times are kept in the
+    memory of each process.
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+    import mmap
+except ImportError:
+    fcntl = mmap = None
+
+from MoinMoin import caching, log
+from MoinMoin.support.python_compatibility import hash_new
+
+logging = log.getLogger(__name__)
+
+# Number of slots in the shared table, and how many slots a client is
+# looked for from before reusing the least recently used one
+TABLE_SLOTS = 2048
+TABLE_PROBES = 16
+# Seconds between writing the shared table to disk
+FLUSH_INTERVAL = 60
+
+TABLE_MAGIC = 'MoinSurge1'
+# magic, number of slots, times kept per slot
+TABLE_HEADER = struct.Struct('<10sII')
+# client and action digest, latest time, number of times
+SLOT_HEADER = struct.Struct('<16sII')
+
+
+def _record(times, maxnum, since, now, lockout, kick, surge):
+    """ Add a request to the times of a client and action
+
+    @param times: earlier request times, sorted
+    @param maxnum: max. number of requests since <since>
+    @param since: start of the time window of the limit
+    @param now: time of this request
+    @param lockout: time a client is locked out
+    @param kick: number of lockout times to add
+    @param surge: a surge was already detected
+    @return: new request times, sorted, and if a surge was detected
+    """
+    times = [t for t in times if t >= since]
+    times.extend([now + lockout] * kick)
+
+    surge = surge or len(times) > maxnum
+    times.append(now)
+    if surge and len(times) < maxnum * 2:
+        times.append(now + lockout) # continue like that and get locked out
+
+    # The limits only depend on the latest 2 * maxnum + 1 times
+    times.sort()
+    return times[-(2 * maxnum + 1):], surge
+
+
+class SurgeLog(object):
+    """ Request times kept in the memory of this process """
+
+    def __init__(self, capacity, max_age):
+        self.capacity = capacity
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._times = {}
+        self._cleaned = 0
+
+    def hit(self, id, action, maxnum, since, now, lockout, kick=0,
+            surge=False):
+        """ Record a request and check if the client causes a surge
+
+        @param id: user name or remote address of the client
+        @param action: the action, or 'all' for the total limit
+        @param maxnum: max. number of requests since <since>
+        @param since: start of the time window of the limit
+        @param now: time of this request
+        @param lockout: time a client is locked out
+        @param kick: number of lockout times to add, to lock out NOW
+        @param surge: a surge was already detected for this request
+        @rtype: bool
+        @return: if a surge was detected
+        """
+        key = (id, action)
+        self._lock.acquire()
+        try:
+            times, surge = _record(self._times.get(key, []), maxnum, since,
+                                   now, lockout, kick, surge)
+            self._times[key] = times
+
+            if now - self._cleaned > self.max_age:
+                expired = now - self.max_age
+                for key, times in self._times.items():
+                    if times[-1] < expired:
+                        del self._times[key]
+                self._cleaned = now
+        finally:
+            self._lock.release()
+        return surge
+
+    def flush(self):
+        pass
+
+
+class SharedSurgeLog(SurgeLog):
+    """ Request times kept in a memory mapped table shared by processes
+
+    Each client and action has a slot, found by the digest of their
+    names. The table is made again if it was made for other limits.
+    """
+
+    def __init__(self, path, capacity, max_age):
+        SurgeLog.__init__(self, capacity, max_age)
+        self.slot_size = SLOT_HEADER.size + 4 * capacity
+        self.size = TABLE_HEADER.size + TABLE_SLOTS * self.slot_size
+        self._header = TABLE_HEADER.pack(TABLE_MAGIC, TABLE_SLOTS, capacity)
+        self._flushed = time.time()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+            self._map = mmap.mmap(self._fd, self.size)
+        except:
+            os.close(self._fd)
+            raise
+
+    def _init_table(self):
+        empty = '\0' * self.slot_size
+        offset = TABLE_HEADER.size
+        for index in xrange(TABLE_SLOTS):
+            self._map[offset:offset + self.slot_size] = empty
+            offset += self.slot_size
+        self._map[:TABLE_HEADER.size] = self._header
+
+    def _find(self, digest, expired):
+        """ Return the offset of the slot of the digest, the first free
+        slot or the least recently used slot, in this order """
+        start = struct.unpack('<I', digest[:4])[0]
+        free = oldest = None
+        oldest_latest = None
+        for probe in xrange(TABLE_PROBES):
+            index = (start + probe) % TABLE_SLOTS
+            offset = TABLE_HEADER.size + index * self.slot_size
+            key, latest, count = SLOT_HEADER.unpack_from(self._map, offset)
+            if key == digest:
+                return offset, True
+            if free is None and (not count or latest < expired):
+                free = offset
+            if oldest_latest is None or latest < oldest_latest:
+                oldest, oldest_latest = offset, latest
+
+        if free is not None:
+            return free, False
+        return oldest, False
+
+    def hit(self, id, action, maxnum, since, now, lockout, kick=0,
+            surge=False):
+        if isinstance(id, unicode):
+            id = id.encode('utf-8')
+        if isinstance(action, unicode):
+            action = action.encode('utf-8')
+        digest = hash_new('md5', '%s\0%s' % (id, action)).digest()
+
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if self._map[:TABLE_HEADER.size] != self._header:
+                    # New table, or one made for other limits
+                    self._init_table()
+
+                offset, found = self._find(digest, now - self.max_age)
+                times = []
+                if found:
+                    count = SLOT_HEADER.unpack_from(self._map, offset)[2]
+                    times = list(struct.unpack_from('<%dI' % count, self._map,
+                                                    offset + SLOT_HEADER.size))
+
+                times, surge = _record(times, maxnum, since, now, lockout,
+                                       kick, surge)
+                times = times[-self.capacity:]
+
+                SLOT_HEADER.pack_into(self._map, offset, digest, times[-1],
+                                      len(times))
+                struct.pack_into('<%dI' % len(times), self._map,
+                                 offset + SLOT_HEADER.size, *times)
+
+                if now - self._flushed > FLUSH_INTERVAL:
+                    self._map.flush()
+                    self._flushed = now
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+        return surge
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._map.flush()
+        finally:
+            self._lock.release()
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_surge_log(request):
+    """ Get the request log of the process for the wiki and its limits """
+    cfg = request.cfg
+    limits = cfg.surge_action_limits
+    default_limit = limits.get('default', (30, 60))
+    limits = limits.values() + [default_limit]
+    capacity = 2 * max([maxnum for maxnum, dt in limits]) + 1
+    max_age = max([dt for maxnum, dt in limits])
+
+    arena_dir = caching.get_arena_dir(request, 'surgeprotect', 'wiki')
+    key = (arena_dir, capacity, max_age)
+
+    _logs_lock.acquire()
+    try:
+        surgelog = _logs.get(key)
+        if surgelog is None:
+            if mmap is not None:
+                try:
+                    if not os.path.exists(arena_dir):
+                        os.makedirs(arena_dir)
+                    path = os.path.join(arena_dir, 'surge-table')
+                    surgelog = SharedSurgeLog(path, capacity, max_age)
+                except EnvironmentError, err:
+                    logging.warning("Surge protection table not shared "
+                                    "between processes: %s" % (err, ))
+            if surgelog is None:
+                surgelog = SurgeLog(capacity, max_age)
+            _logs[key] = surgelog
+        return surgelog
+    finally:
+        _logs_lock.release()
@@ -10,11 +10,11 @@ import time
 
 from werkzeug import abort, redirect, cookie_date, Response
 
-from MoinMoin import caching
 from MoinMoin import log
 from MoinMoin import wikiutil
 from MoinMoin.Page import Page
 from MoinMoin.web.exceptions import Forbidden, SurgeProtection
+from MoinMoin.web.surge import get_surge_log
 
 logging = log.getLogger(__name__)
 
@@ -83,64 +83,29 @@ def check_surge_protect(request, kick=False, action=None, username=None):
         current_id = validuser and request.user.name or remote_addr
 
     default_limit = limits.get('default', (30, 60))
+    lockout = request.cfg.surge_lockout_time
 
     now = int(time.time())
-    surgedict = {}
     surge_detected = False
 
     try:
-        # if we have common farm users, we could also use scope='farm':
-        cache = caching.CacheEntry(request, 'surgeprotect', 'surge-log', scope='wiki', use_encode=True)
-        if cache.exists():
-            data = cache.content()
-            data = data.split("\n")
-            for line in data:
-                try:
-                    id, t, action, surge_indicator = line.split("\t")
-                    t = int(t)
-                    maxnum, dt = limits.get(action, default_limit)
-                    if t >= now - dt:
-                        events = surgedict.setdefault(id, {})
-                        timestamps = events.setdefault(action, [])
-                        timestamps.append((t, surge_indicator))
-                except StandardError:
-                    pass
+        surgelog = get_surge_log(request)
 
         maxnum, dt = limits.get(current_action, default_limit)
-        events = surgedict.setdefault(current_id, {})
-        timestamps = events.setdefault(current_action, [])
-        surge_detected = len(timestamps) > maxnum
-
-        surge_indicator = surge_detected and "!" or ""
-        timestamps.append((now, surge_indicator))
-        if surge_detected:
-            if len(timestamps) < maxnum * 2:
-                timestamps.append((now + request.cfg.surge_lockout_time, surge_indicator)) # continue like that and get locked out
+        surge_detected = surgelog.hit(current_id, current_action, maxnum,
+                                      now - dt, now, lockout)
 
         if current_action not in ('cache', 'AttachFile', ): # don't add cache/AttachFile accesses to all or picture galleries will trigger SP
             action = 'all' # put a total limit on user's requests
             maxnum, dt = limits.get(action, default_limit)
-            events = surgedict.setdefault(current_id, {})
-            timestamps = events.setdefault(action, [])
 
+            kick_count = 0
             if kick: # ban this guy, NOW
-                timestamps.extend([(now + request.cfg.surge_lockout_time, "!")] * (2 * maxnum))
-
-            surge_detected = surge_detected or len(timestamps) > maxnum
-
-            surge_indicator = surge_detected and "!" or ""
-            timestamps.append((now, surge_indicator))
-            if surge_detected:
-                if len(timestamps) < maxnum * 2:
-                    timestamps.append((now + request.cfg.surge_lockout_time, surge_indicator)) # continue like that and get locked out
+                kick_count = 2 * maxnum
 
-        data = []
-        for id, events in surgedict.items():
-            for action, timestamps in events.items():
-                for t, surge_indicator in timestamps:
-                    data.append("%s\t%d\t%s\t%s" % (id, t, action, surge_indicator))
-        data = "\n".join(data)
-        cache.update(data)
+            surge_detected = surgelog.hit(current_id, action, maxnum,
+                                          now - dt, now, lockout,
+                                          kick_count, surge_detected)
     except StandardError:
         pass
 
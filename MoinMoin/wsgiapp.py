@@ -85,6 +85,8 @@ def run(context):
                 response = xmlrpc.xmlrpc(XMLRPCContext(request))
             elif action_name == 'xmlrpc2':
                 response = xmlrpc.xmlrpc2(XMLRPCContext(request))
+            elif action_name == 'rpc':
+                response = xmlrpc.rpc(XMLRPCContext(request))
             else:
                 response = dispatch(request, context, action_name)
             context.cfg.session_service.finalize(context, context.session)
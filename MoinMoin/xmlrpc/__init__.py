@@ -17,6 +17,9 @@
     when really necessary (like for transferring binary files like
     attachments maybe).
 
+    The v2 methods can also be called with requests and responses in JSON
+    or msgpack (action=rpc), see XmlRpcStream.
+
     @copyright: 2003-2009 MoinMoin:ThomasWaldmann,
                 2004-2006 MoinMoin:AlexanderSchremmer,
                 2007-2009 MoinMoin:ReimarBauer
@@ -26,7 +29,17 @@ from MoinMoin.util import pysupport
 
 modules = pysupport.getPackageModules(__file__)
 
-import os, sys, time, xmlrpclib
+import os, sys, time, base64, calendar, xmlrpclib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 from MoinMoin import log
 logging = log.getLogger(__name__)
@@ -38,6 +51,7 @@ from MoinMoin.logfile import editlog
 from MoinMoin.action import AttachFile
 from MoinMoin import caching
 from MoinMoin.metadata.edit import graphdata_close
+from MoinMoin.security import may_read_many, PermissionMemo
 
 def is_login_required(request):
     login_required = True
@@ -147,6 +161,20 @@ class XmlRpcBase:
             '\n'.join(traceback.format_tb(sys.exc_info()[2])),
         )
 
+    def _overwrite_user(self):
+        """
+        overwrite any user there might be, if you need a valid user for
+        xmlrpc, you have to use multicall and getAuthToken / applyAuthToken
+        """
+        request = self.request
+        if request.cfg.xmlrpc_overwrite_user:
+            login_required = is_login_required(request)
+            if (not request.user or
+                not request.user.valid or
+                login_required):
+                request.user = user.User(request,
+                                         auth_method='xmlrpc:invalid')
+
     def process(self):
         """
         xmlrpc v1 and v2 dispatcher
@@ -157,15 +185,7 @@ class XmlRpcBase:
                 # we do not handle xmlrpc v1 and v2 differently
                 response = xmlrpclib.Fault(1, "This moin wiki does not allow xmlrpc method calls.")
             else:
-                # overwrite any user there might be, if you need a valid user for
-                # xmlrpc, you have to use multicall and getAuthToken / applyAuthToken
-                if request.cfg.xmlrpc_overwrite_user:
-                    login_required = is_login_required(self.request)
-                    if (not self.request.user or
-                        not self.request.user.valid or
-                        login_required):
-                        self.request.user = user.User(self.request, 
-                                                      auth_method='xmlrpc:invalid')
+                self._overwrite_user()
 
                 data = request.read()
 
@@ -244,40 +264,67 @@ class XmlRpcBase:
     ### System methods
     #############################################################################
 
-    def xmlrpc_system_multicall(self, call_list):
+    def xmlrpc_system_multicall(self, call_list, atomic=False):
         """
         system.multicall([{'methodName': 'add', 'params': [2, 2]}, ...]) => [[4], ...]
 
         Allows the caller to package multiple XML-RPC calls into a single
         request.
 
+        The calls of the batch share the results of their permission
+        checks and the graph data of the request, whose changes are
+        committed once, after the last call. The graph data changes of
+        a failed call are rolled back. With atomic set, the calls after
+        a failed one are not made, and get a fault.
+
         See http://www.xmlrpc.com/discuss/msgReader$1208
 
         Copied from SimpleXMLRPCServer.py
         """
+        request = self.request
+        graphdata = request.graphdata
+        old_memo = getattr(request, 'permission_memo', None)
+        if old_memo is None:
+            request.permission_memo = PermissionMemo(request)
 
         results = []
-        for call in call_list:
-            method_name = call['methodName']
-            params = call['params']
+        try:
+            for call in call_list:
+                if atomic and results and isinstance(results[-1], dict):
+                    results.append(
+                        {'faultCode': 1,
+                         'faultString': "Not called after an earlier call failed"}
+                        )
+                    continue
 
-            try:
-                # XXX A marshalling error in any response will fail the entire
-                # multicall. If someone cares they should fix this.
-                result = self.dispatch(method_name, params)
+                method_name = call['methodName']
+                params = call['params']
 
-                if not isinstance(result, xmlrpclib.Fault):
-                    results.append([result])
-                else:
+                savepoint = graphdata.savepoint()
+                try:
+                    # XXX A marshalling error in any response will fail the entire
+                    # multicall. If someone cares they should fix this.
+                    result = self.dispatch(method_name, params)
+
+                    if not isinstance(result, xmlrpclib.Fault):
+                        results.append([result])
+                    else:
+                        results.append(
+                            {'faultCode': result.faultCode,
+                             'faultString': result.faultString}
+                            )
+                except:
                     results.append(
-                        {'faultCode': result.faultCode,
-                         'faultString': result.faultString}
+                        {'faultCode': 1,
+                         'faultString': "%s:%s" % (sys.exc_type, sys.exc_value)}
                         )
-            except:
-                results.append(
-                    {'faultCode': 1,
-                     'faultString': "%s:%s" % (sys.exc_type, sys.exc_value)}
-                    )
+
+                if isinstance(results[-1], dict):
+                    graphdata.rollback_to(savepoint)
+                else:
+                    graphdata.release(savepoint)
+        finally:
+            request.permission_memo = old_memo
 
         return results
 
@@ -383,30 +430,30 @@ class XmlRpcBase:
 
         return_items = []
 
+        if not isinstance(date, xmlrpclib.DateTime):
+            date = xmlrpclib.DateTime(date)
+        since = wikiutil.timestamp2version(calendar.timegm(date.timetuple()))
+
         edit_log = editlog.EditLog(self.request)
-        for log in edit_log.reverse():
-            # get last-modified UTC (DateTime) from log
-            gmtuple = tuple(time.gmtime(wikiutil.version2timestamp(log.ed_time_usecs)))
-            lastModified_date = xmlrpclib.DateTime(gmtuple)
+        entries = list(edit_log.since(since))
 
-            # skip if older than "date"
-            if lastModified_date < date:
-                break
+        # skip if knowledge not permitted
+        readable = set(may_read_many(self.request.user,
+                                     set([log.pagename for log in entries])))
 
-            # skip if knowledge not permitted
-            if not self.request.user.may.read(log.pagename):
+        for log in entries:
+            if log.pagename not in readable:
                 continue
 
+            # get last-modified UTC (DateTime) from log
+            gmtuple = tuple(time.gmtime(wikiutil.version2timestamp(log.ed_time_usecs)))
+            lastModified_date = xmlrpclib.DateTime(gmtuple)
+
             # get page name (str) from log
             pagename_str = self._outstr(log.pagename)
 
             # get user name (str) from log
-            author_str = log.hostname
-            if log.userid:
-                userdata = user.User(self.request, log.userid)
-                if userdata.name:
-                    author_str = userdata.name
-            author_str = self._outstr(author_str)
+            author_str = self._outstr(log.getEditorName(self.request))
 
             return_item = {'name': pagename_str,
                            'lastModified': lastModified_date,
@@ -414,6 +461,8 @@ class XmlRpcBase:
                            'version': int(log.rev) }
             return_items.append(return_item)
 
+        # latest changes first
+        return_items.reverse()
         return return_items
 
     def xmlrpc_getPageInfo(self, pagename):
@@ -1232,6 +1281,202 @@ class XmlRpc2(XmlRpcBase):
         return text
 
 
+# Streaming JSON and msgpack encoding --------------------------------------
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPES = ['application/x-msgpack', 'application/msgpack']
+
+# Items of lists and dicts this deep in a result are encoded and sent
+# one at a time, deeper ones are encoded as a whole
+STREAM_DEPTH = 2
+# Bytes sent at a time
+STREAM_CHUNK = 65536
+
+def _iterable(value):
+    return (isinstance(value, (list, tuple, set, frozenset)) or
+            hasattr(value, 'next'))
+
+def _rpc_default(value, binary):
+    """
+    Convert the values xmlrpc has special types for to values of the
+    encoding, binary converts the data of xmlrpclib.Binary values
+    """
+    if isinstance(value, xmlrpclib.Binary):
+        return {'__binary__': binary(value.data)}
+    elif isinstance(value, xmlrpclib.DateTime):
+        return {'__datetime__': value.value}
+    elif isinstance(value, xmlrpclib.Fault):
+        return {'faultCode': value.faultCode, 'faultString': value.faultString}
+    elif _iterable(value):
+        # iterators, sets
+        return list(value)
+    raise TypeError("%r can not be encoded" % (value, ))
+
+def _rpc_object_hook(value, binary):
+    if len(value) == 1:
+        if '__binary__' in value:
+            return xmlrpclib.Binary(binary(value['__binary__']))
+        elif '__datetime__' in value:
+            return xmlrpclib.DateTime(str(value['__datetime__']))
+    return value
+
+def _json_chunks(value, encoder, depth=0):
+    if depth >= STREAM_DEPTH:
+        yield encoder.encode(value)
+    elif isinstance(value, dict):
+        yield '{'
+        sep = ''
+        for key, item in value.iteritems():
+            yield sep + encoder.encode(key) + ':'
+            for chunk in _json_chunks(item, encoder, depth + 1):
+                yield chunk
+            sep = ','
+        yield '}'
+    elif _iterable(value):
+        yield '['
+        sep = ''
+        for item in value:
+            yield sep
+            for chunk in _json_chunks(item, encoder, depth + 1):
+                yield chunk
+            sep = ','
+        yield ']'
+    else:
+        yield encoder.encode(value)
+
+def _msgpack_chunks(value, packer, depth=0):
+    if depth >= STREAM_DEPTH:
+        yield packer.pack(value)
+    elif isinstance(value, dict):
+        yield packer.pack_map_header(len(value))
+        for key, item in value.iteritems():
+            yield packer.pack(key)
+            for chunk in _msgpack_chunks(item, packer, depth + 1):
+                yield chunk
+    elif _iterable(value):
+        if not isinstance(value, (list, tuple)):
+            # the length goes first
+            value = list(value)
+        yield packer.pack_array_header(len(value))
+        for item in value:
+            for chunk in _msgpack_chunks(item, packer, depth + 1):
+                yield chunk
+    else:
+        yield packer.pack(value)
+
+def rpc_loads(mimetype, data):
+    """
+    Decode a request body in JSON or msgpack
+    """
+    if mimetype == JSON_TYPE:
+        hook = lambda value: _rpc_object_hook(value, base64.b64decode)
+        return json.loads(data, object_hook=hook)
+    hook = lambda value: _rpc_object_hook(value, str)
+    return msgpack.unpackb(data, object_hook=hook)
+
+def rpc_dump_chunks(mimetype, value):
+    """
+    Generate the encoding of value in JSON or msgpack, in parts of about
+    STREAM_CHUNK bytes
+    """
+    if mimetype == JSON_TYPE:
+        default = lambda value: _rpc_default(value, base64.b64encode)
+        encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+        chunks = _json_chunks(value, encoder)
+    else:
+        default = lambda value: _rpc_default(value, str)
+        packer = msgpack.Packer(default=default)
+        chunks = _msgpack_chunks(value, packer)
+
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+class XmlRpcStream(XmlRpc2):
+    """
+    Dispatcher of the xmlrpc v2 methods and plugins for requests and
+    responses in JSON or msgpack
+
+    The request is {"method": name, "params": [...]}, the response
+    {"result": value} or {"fault": {"faultCode": .., "faultString": ..}}.
+    xmlrpclib.Binary and DateTime values are {"__binary__": data} and
+    {"__datetime__": "YYYYMMDDTHH:MM:SS"}, with the data base64 encoded in
+    JSON. The response is in the format of the request, unless the Accept
+    header asks for the other one.
+
+    Results are encoded while they are sent, item by item down to
+    STREAM_DEPTH, and iterators are consumed while encoding, so large
+    results are never held in memory in encoded form. Errors raised
+    while sending end the response.
+    """
+
+    def mimetypes(self):
+        if msgpack is None:
+            return [JSON_TYPE]
+        return [JSON_TYPE] + MSGPACK_TYPES
+
+    def process(self):
+        request = self.request
+        out = request.request
+        mimetypes = self.mimetypes()
+
+        in_type = request.environ.get('CONTENT_TYPE', '').split(';')[0].strip()
+        if in_type not in mimetypes:
+            out.status_code = 415
+            out.content_type = 'text/plain'
+            out.data = "Supported content types: %s" % ', '.join(mimetypes)
+            return out
+        if in_type in MSGPACK_TYPES:
+            mimetypes = [in_type, JSON_TYPE]
+        out_type = request.accept_mimetypes.best_match(mimetypes)
+        if out_type is None:
+            out_type = in_type
+
+        try:
+            if 'xmlrpc' in self.request.cfg.actions_excluded:
+                response = xmlrpclib.Fault(1, "This moin wiki does not allow xmlrpc method calls.")
+            else:
+                self._overwrite_user()
+                call = rpc_loads(in_type, request.read())
+                method, params = call['method'], call.get('params', [])
+                logging.debug('%s(%r)' % (method, params))
+                response = self.dispatch(method, params)
+        except:
+            logging.exception("An exception occurred (this is also sent as fault response to the client):")
+            response = xmlrpclib.Fault(1, self._dump_exc())
+
+        if isinstance(response, xmlrpclib.Fault):
+            response = {'fault': response}
+        else:
+            response = {'result': response}
+
+        out.content_type = out_type
+        out.response = self._send(out_type, response)
+        return out
+
+    def _send(self, mimetype, response):
+        # Runs after the request is finished
+        request = self.request
+        try:
+            try:
+                for chunk in rpc_dump_chunks(mimetype, response):
+                    yield chunk
+            except:
+                logging.exception("An exception occurred while sending the response:")
+                raise
+        finally:
+            graphdata_close(request)
+
+
 def xmlrpc(request):
     try:
         return XmlRpc1(request).process()
@@ -1244,3 +1489,8 @@ def xmlrpc2(request):
     finally:
         graphdata_close(request)
 
+def rpc(request):
+    try:
+        return XmlRpcStream(request).process()
+    finally:
+        graphdata_close(request)
@@ -6,10 +6,16 @@
     @license: GNU GPL, see COPYING for details.
 """
 
-from xmlrpclib import Fault
+import time
+from StringIO import StringIO
+from xmlrpclib import Binary, DateTime, Fault
 
 from MoinMoin.user import User
-from MoinMoin.xmlrpc import XmlRpcBase
+from MoinMoin.web.contexts import XMLRPCContext
+from MoinMoin.web.request import TestRequest
+from MoinMoin.xmlrpc import XmlRpcBase, XmlRpc2, XmlRpcStream, JSON_TYPE
+from MoinMoin.xmlrpc import rpc_loads, rpc_dump_chunks
+from MoinMoin._tests import become_trusted, create_page, nuke_page
 
 
 def test_fault_serialization(request):
@@ -30,10 +36,103 @@ def test_fault_serialization(request):
     assert type(result[0]) is dict
     assert result[0].has_key("faultCode") and result[0].has_key("faultString")
 
+def test_multicall_atomic(request):
+    """ Tests if an atomic multicall stops at the first failed call """
+    called = []
+    def xmlrpc_append(value):
+        assert request.permission_memo is not None
+        called.append(value)
+        return value
+
+    xmlrpc = XmlRpcBase(request)
+    xmlrpc.xmlrpc_append = xmlrpc_append
+    args = [{'methodName': 'append', 'params': [1]},
+            {'methodName': 'append', 'params': []},
+            {'methodName': 'append', 'params': [3]}]
+
+    result = xmlrpc.xmlrpc_system_multicall(args)
+    assert result[0] == [1] and result[2] == [3]
+    assert 'faultCode' in result[1]
+
+    result = xmlrpc.xmlrpc_system_multicall(args, True)
+    assert result[0] == [1]
+    assert 'faultCode' in result[1] and 'faultCode' in result[2]
+    assert called == [1, 3, 1]
+    assert getattr(request, 'permission_memo', None) is None
+
 def test_getAuthToken(request):
     """ Tests if getAuthToken passes without crashing """
     xmlrpc = XmlRpcBase(request)
     assert xmlrpc.xmlrpc_getAuthToken("Foo", "bar") == ""
 
+def test_getRecentChanges(request):
+    """ Tests if getRecentChanges lists the latest changes first """
+    become_trusted(request)
+    since = DateTime(time.gmtime(time.time() - 1))
+    pagenames = [u'XmlRpcRecentChangesPage1', u'XmlRpcRecentChangesPage2']
+    try:
+        for pagename in pagenames:
+            create_page(request, pagename, u'Text')
+        xmlrpc = XmlRpc2(request)
+        changes = xmlrpc.xmlrpc_getRecentChanges(since)
+        names = [change['name'] for change in changes]
+        first, second = [xmlrpc._outstr(pagename) for pagename in pagenames]
+        assert names[0] == second
+        assert names.index(second) < names.index(first)
+
+        assert xmlrpc.xmlrpc_getRecentChanges(DateTime(time.gmtime(time.time() + 3600))) == []
+    finally:
+        for pagename in pagenames:
+            nuke_page(request, pagename)
+
+def test_rpc_encoding():
+    """ Tests if JSON encoded values with the xmlrpc types round trip """
+    value = {'data': Binary('\x00\xff'), 'time': DateTime('20101218T00:00:00'),
+             'items': iter([1, [2, u'\xe4'], {'a': None}])}
+    data = ''.join(rpc_dump_chunks(JSON_TYPE, value))
+    value = rpc_loads(JSON_TYPE, data)
+    assert value['data'].data == '\x00\xff'
+    assert value['time'].value == '20101218T00:00:00'
+    assert value['items'] == [1, [2, u'\xe4'], {'a': None}]
+
+class TestRpc(object):
+    """ Tests calling methods with JSON requests and responses """
+
+    from MoinMoin._tests import wikiconfig
+    class Config(wikiconfig.Config):
+        actions_excluded = []
+
+    def rpc(self, body, content_type=JSON_TYPE):
+        environ = {'wsgi.input': StringIO(body)}
+        context = XMLRPCContext(TestRequest(method='POST', content_type=content_type,
+                                            content_length=len(body),
+                                            environ_overrides=environ))
+        context.cfg = self.request.cfg
+        context.user = self.request.user
+        response = XmlRpcStream(context).process()
+        return response, ''.join(response.response)
+
+    def test_call(self):
+        pagename = u'XmlRpcStreamPage'
+        become_trusted(self.request)
+        create_page(self.request, pagename, u'Text')
+        try:
+            since = ''.join(rpc_dump_chunks(JSON_TYPE, DateTime(time.gmtime(time.time() - 1))))
+            response, data = self.rpc('{"method": "getRecentChanges", "params": [%s]}' % since)
+            assert response.content_type == JSON_TYPE
+            result = rpc_loads(JSON_TYPE, data)['result']
+            assert result[0]['name'] == pagename
+            assert isinstance(result[0]['lastModified'], DateTime)
+        finally:
+            nuke_page(self.request, pagename)
+
+    def test_fault(self):
+        response, data = self.rpc('{"method": "noSuchMethod", "params": []}')
+        assert 'faultCode' in rpc_loads(JSON_TYPE, data)['fault']
+
+    def test_unsupported(self):
+        response, data = self.rpc('<methodCall/>', content_type='text/xml')
+        assert response.status_code == 415
+
 coverage_modules = ['MoinMoin.xmlrpc']
 
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    Graphingwiki - layout service tests
+
+    The layouts are run by a fake dot engine, a shell script that
+    echoes its input, records its runs and sleeps, fails or hangs when
+    asked to by the input.
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import py
+
+from graphingwiki import layout
+
+ENGINE = """#!/bin/sh
+PATH='%(path)s'
+export PATH
+input=`cat`
+echo "$input" >> '%(dir)s/runs'
+touch '%(dir)s/running.'$$
+ls '%(dir)s'/running.* | wc -l >> '%(dir)s/counts'
+case "$input" in
+    sleep*) sleep `echo "$input" | cut -d' ' -f2` ;;
+    hang*) sleep 30 & wait ;;
+    fail*) rm -f '%(dir)s/running.'$$; echo "syntax error" >&2; exit 1 ;;
+esac
+rm -f '%(dir)s/running.'$$
+printf '%%s' "$input"
+"""
+
+
+class TestLayoutPool(object):
+    """ layout: running layouts in a bounded set of processes """
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        engine = os.path.join(self.tempdir, 'dot')
+        f = file(engine, 'w')
+        f.write(ENGINE % {'path': os.environ.get('PATH', ''),
+                          'dir': self.tempdir})
+        f.close()
+        os.chmod(engine, 0755)
+
+        # Only the fake engine can be found
+        self.old_path = os.environ.get('PATH')
+        os.environ['PATH'] = self.tempdir
+
+    def teardown_method(self, method):
+        if self.old_path is None:
+            del os.environ['PATH']
+        else:
+            os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.tempdir)
+
+    def lines(self, name):
+        path = os.path.join(self.tempdir, name)
+        if not os.path.exists(path):
+            return list()
+        return file(path).read().splitlines()
+
+    def run_threads(self, pool, sources):
+        results = dict()
+        def run(source):
+            try:
+                results[source] = pool.layout(source, 'dot', 'svg')
+            except layout.LayoutError, error:
+                results[source] = error
+        threads = [threading.Thread(target=run, args=(source, ))
+                   for source in sources]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_for(self, condition):
+        expires = time.time() + 10
+        while not condition():
+            assert time.time() < expires
+            time.sleep(0.01)
+
+    def test_layout(self):
+        pool = layout.LayoutPool(timeout=10)
+        assert pool.layout('digraph {}', 'dot', 'svg') == 'digraph {}'
+
+        py.test.raises(layout.LayoutError, pool.layout, 'digraph {}',
+                       'nonexistent', 'svg')
+        py.test.raises(layout.LayoutError, pool.layout, 'digraph {}',
+                       'dot', 'svg; rm')
+
+        error = py.test.raises(layout.LayoutError, pool.layout, 'fail',
+                               'dot', 'svg').value
+        assert 'syntax error' in str(error)
+
+    def test_workers(self):
+        pool = layout.LayoutPool(workers=2, queue=10, timeout=10)
+        sources = ['sleep 0.3 %d' % (i, ) for i in range(5)]
+        threads, results = self.run_threads(pool, sources)
+        for thread in threads:
+            thread.join()
+
+        assert results == dict((source, source) for source in sources)
+        counts = [int(count) for count in self.lines('counts')]
+        assert len(counts) == 5
+        assert max(counts) == 2
+
+    def test_queue_full(self):
+        pool = layout.LayoutPool(workers=1, queue=1, timeout=10)
+        threads, results = self.run_threads(pool, ['sleep 1 running'])
+        self.wait_for(lambda: pool._running == 1)
+        more, more_results = self.run_threads(pool, ['sleep 0 waiting'])
+        self.wait_for(lambda: pool._waiting == 1)
+
+        error = py.test.raises(layout.LayoutError, pool.layout,
+                               'sleep 0 refused', 'dot', 'svg').value
+        assert 'queued' in str(error)
+
+        for thread in threads + more:
+            thread.join()
+        assert results == {'sleep 1 running': 'sleep 1 running'}
+        assert more_results == {'sleep 0 waiting': 'sleep 0 waiting'}
+        assert 'sleep 0 refused' not in self.lines('runs')
+
+    def test_timeout(self):
+        pool = layout.LayoutPool(timeout=0.5)
+        start = time.time()
+        error = py.test.raises(layout.LayoutError, pool.layout, 'hang',
+                               'dot', 'svg').value
+        assert 'timed out' in str(error)
+        # The background process of the engine would keep its output
+        # open if it was not killed with the rest of the process group
+        assert time.time() - start < 10
+        assert pool._running == 0
+
+    def test_same_layouts(self):
+        pool = layout.LayoutPool(timeout=10)
+        threads, results = self.run_threads(pool, ['sleep 0.5 same'] * 3)
+        for thread in threads:
+            thread.join()
+
+        assert results == {'sleep 0.5 same': 'sleep 0.5 same'}
+        assert self.lines('runs') == ['sleep 0.5 same']
+
+    def test_unavailable(self):
+        pool = layout.LayoutPool(timeout=10)
+        py.test.raises(layout.LayoutUnavailable, pool.layout, 'digraph {}',
+                       'neato', 'svg')
+        assert pool._running == 0
+
+        # Done in the wiki process instead
+        old_layout_in_process = layout._layout_in_process
+        layout._layout_in_process = lambda source, engine, format: \
+            'in process: ' + source
+        try:
+            result = layout.layout(self.request, 'digraph {}', 'neato', 'svg')
+        finally:
+            layout._layout_in_process = old_layout_in_process
+        assert result == 'in process: digraph {}'
+
+coverage_modules = ['graphingwiki.layout']
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+Graphingwiki Testing Framework
+------------------------------
+
+The tests of graphingwiki run on the test wiki of MoinMoin, with the
+MoinMoin testing framework, see MoinMoin/conftest.py.
+"""
+
+from MoinMoin.conftest import *
@@ -28,7 +28,9 @@
 
 """
 
+import os
 import sys
+import threading
 
 from graphingwiki.util import encode_page, decode_page, get_url_ns
 from graphingwiki.editing import ordervalue
@@ -331,6 +333,27 @@ class Graphviz:
             # Render to attrs
             gv.render(self.handle)
 
+    def source(self):
+        """ Returns the graph in dot format, without laying it out. """
+        # gv only writes graphs to named files, read it from a pipe
+        rfd, wfd = os.pipe()
+        data = list()
+        def read():
+            while True:
+                chunk = os.read(rfd, 65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+        reader = threading.Thread(target=read)
+        reader.start()
+        try:
+            gv.write(self.handle, '/dev/fd/%d' % (wfd, ))
+        finally:
+            os.close(wfd)
+            reader.join()
+            os.close(rfd)
+        return ''.join(data)
+
     def set(self, proto="", **attrs):
         """ Sets root graph attributes. """
         self._setattrs(handle=self.handle, proto=proto, **attrs)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+    layout service
+     - lays out and renders Graphviz graphs in separate processes
+
+    Each layout is run by the Graphviz command line tool of its engine,
+    reading the dot source from a pipe and writing the rendered result
+    to another. A pathological graph can then only hang or crash its
+    own process, which is killed after a timeout and limited in the
+    memory it can use. At most gwiki_layout_workers layouts run at a
+    time and at most gwiki_layout_queue more wait for their turn.
+    Identical layouts requested at the same time are only run once.
+
+    Where the Graphviz tools are not installed, layouts are done with
+    the Python bindings in the wiki process, as before.
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+
+import os
+import re
+import errno
+import signal
+import subprocess
+import threading
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from tempfile import mkstemp
+from time import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LAYOUT_WORKERS = 4
+LAYOUT_QUEUE = 16
+LAYOUT_TIMEOUT = 60.0
+# In megabytes
+LAYOUT_MEMORY = 1024
+
+ENGINES = ['dot', 'neato', 'fdp', 'sfdp', 'twopi', 'circo', 'osage',
+           'patchwork']
+format_re = re.compile(r'^[a-z0-9:_]+$')
+
+class LayoutError(Exception):
+    pass
+
+class LayoutUnavailable(LayoutError):
+    pass
+
+class _Job(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class LayoutPool(object):
+    """
+    Bounded set of layout processes shared by the threads of a process
+    """
+
+    def __init__(self, workers=LAYOUT_WORKERS, queue=LAYOUT_QUEUE,
+                 timeout=LAYOUT_TIMEOUT, memory=LAYOUT_MEMORY):
+        self.workers = workers
+        self.queue = queue
+        self.timeout = timeout
+        self.memory = memory
+
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+        self._jobs = dict()
+
+    def layout(self, source, engine, format):
+        """
+        Return the source laid out with engine and rendered in format
+        """
+        if engine not in ENGINES:
+            raise LayoutError("Unknown layout engine: %s" % (engine, ))
+        if not format_re.match(format):
+            raise LayoutError("Unknown output format: %s" % (format, ))
+
+        key = md5('\0'.join([engine, format, source])).hexdigest()
+
+        self._cond.acquire()
+        try:
+            job = self._jobs.get(key)
+            owner = job is None
+            if owner:
+                job = self._jobs[key] = _Job()
+        finally:
+            self._cond.release()
+
+        if not owner:
+            # The same layout is already being run by another thread
+            job.done.wait()
+        else:
+            try:
+                try:
+                    job.result = self._run(source, engine, format)
+                except Exception, error:
+                    job.error = error
+            finally:
+                self._cond.acquire()
+                try:
+                    del self._jobs[key]
+                finally:
+                    self._cond.release()
+                job.done.set()
+
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _acquire(self, expires):
+        self._cond.acquire()
+        try:
+            if self._running >= self.workers:
+                if self._waiting >= self.queue:
+                    raise LayoutError("Too many layouts queued")
+
+                self._waiting += 1
+                try:
+                    while self._running >= self.workers:
+                        remaining = expires - time()
+                        if remaining <= 0:
+                            raise LayoutError("Timed out waiting for layout")
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            self._running += 1
+        finally:
+            self._cond.release()
+
+    def _release(self):
+        self._cond.acquire()
+        try:
+            self._running -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _limits(self):
+        # Run in the layout process before executing Graphviz. In its
+        # own process group, so that anything it starts is killed too.
+        os.setsid()
+        if resource is None:
+            return
+        memory = self.memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        cpu = int(self.timeout) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+
+    def _run(self, source, engine, format):
+        expires = time() + self.timeout
+        self._acquire(expires)
+        try:
+            try:
+                process = subprocess.Popen([engine, '-T' + format],
+                                           stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE,
+                                           close_fds=True,
+                                           preexec_fn=self._limits)
+            except OSError, error:
+                if error.errno == errno.ENOENT:
+                    raise LayoutUnavailable("Graphviz tools not installed")
+                raise
+
+            killed = list()
+            def kill():
+                killed.append(True)
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+            timer = threading.Timer(max(expires - time(), 0), kill)
+            timer.start()
+            try:
+                output, errors = process.communicate(source)
+            finally:
+                timer.cancel()
+        finally:
+            self._release()
+
+        if killed:
+            raise LayoutError("Layout timed out")
+        if process.returncode != 0:
+            errors = errors.strip() or "exit status %d" % \
+                (process.returncode, )
+            raise LayoutError("Layout failed: %s" % (errors, ))
+
+        return output
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def layout_pool(request):
+    """
+    Return the layout pool of the process for the settings of the wiki
+    """
+    cfg = request.cfg
+    settings = (getattr(cfg, 'gwiki_layout_workers', LAYOUT_WORKERS),
+                getattr(cfg, 'gwiki_layout_queue', LAYOUT_QUEUE),
+                getattr(cfg, 'gwiki_layout_timeout', LAYOUT_TIMEOUT),
+                getattr(cfg, 'gwiki_layout_memory', LAYOUT_MEMORY))
+
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(settings)
+        if pool is None:
+            pool = _pools[settings] = LayoutPool(*settings)
+        return pool
+    finally:
+        _pools_lock.release()
+
+def _layout_in_process(source, engine, format):
+    from graphingwiki.graphrepr import Graphviz
+
+    try:
+        graphviz = Graphviz(engine=engine, string=source)
+    except ValueError, error:
+        raise LayoutError(str(error))
+
+    tmp_fileno, tmp_name = mkstemp()
+    try:
+        graphviz.layout(fname=tmp_name, format=format)
+        f = file(tmp_name)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    finally:
+        os.close(tmp_fileno)
+        os.remove(tmp_name)
+
+def layout(request, source, engine, format):
+    """
+    Lay out the dot source with engine and render it in format.
+    Raises LayoutError if the graph could not be laid out.
+    """
+    try:
+        return layout_pool(request).layout(source, engine, format)
+    except LayoutUnavailable:
+        return _layout_in_process(source, engine, format)
+
+def render(request, graphviz, format):
+    """
+    Lay out and render a graphingwiki.graphrepr.Graphviz graph
+    """
+    return layout(request, graphviz.source(), graphviz.engine, format)
@@ -47,6 +47,7 @@ from graphingwiki import gv_found, igraph_found, actionname, \
 
 from graphingwiki.graph import Graph
 from graphingwiki.graphrepr import GraphRepr, Graphviz, IGraphRepr
+from graphingwiki.layout import render, LayoutError
 
 from graphingwiki.util import (attachment_file, attachment_url, url_parameters,
                                get_url_ns, load_parents, load_children,
@@ -54,7 +55,8 @@ from graphingwiki.util import (attachment_file, attachment_url, url_parameters,
                                form_writer, load_node, decode_page,
                                template_regex, category_regex, encode_page,
                                make_tooltip, cache_exists, SPECIAL_ATTRS,
-                               cache_key, xml_document, xml_node_id_and_text,
+                               cache_key, latest_edit,
+                               xml_document, xml_node_id_and_text,
                                geoip_init, geoip_get_coords,
                                render_error, render_warning)
 from graphingwiki.editing import ordervalue, verify_coordinates
@@ -95,6 +97,22 @@ graphvizshapes = ["box", "polygon", "egg", "triangle",
                   "invhouse", "Mdiamond", "Msquare", "Mcircle",
                   "rectangle", "note", "tab", "box3d", "component"]
 
+class OutputBuffer(object):
+    """
+    Collects redirected request output, encoded in the wiki charset
+    """
+
+    def __init__(self):
+        self.data = list()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode(config.charset)
+        self.data.append(data)
+
+    def getvalue(self):
+        return ''.join(self.data)
+
 def url_reconstruct(request):
     url = request.script_root + '/' + request.page.page_name
 
@@ -273,6 +291,9 @@ class GraphShower(object):
         # Hashes of shapefiles stored for caching
         self.shapefiles = dict()
         self.cache_key = ''
+        # Cache keys of the images shown in the output
+        self.image_keys = list()
+        self.layout_failed = False
 
         # SVG shapefiles need some extra work
         self.shapefiles_svg = dict()
@@ -1490,6 +1511,9 @@ class GraphShower(object):
         return gr
 
     def get_layout(self, grapheng, format, addon=''):
+        if isinstance(grapheng, Graphviz):
+            return render(self.request, grapheng, format)
+
         tmp_fileno, tmp_name = mkstemp(addon)
         grapheng.layout(fname=tmp_name, format=format, 
                         height=self.height, width=self.width)
@@ -1513,6 +1537,18 @@ class GraphShower(object):
         
         if not key:
             key = "%s-%s" % (self.cache_key, self.format)
+        self.image_keys.append(key)
+
+        try:
+            self.send_image(grapheng, key, text)
+        except LayoutError, e:
+            # Do not cache the output, the layout may work next time
+            self.layout_failed = True
+            self.request.write(form_escape(_("ERROR: %s.") % (unicode(e))) +
+                               u'</div>')
+
+    def send_image(self, grapheng, key, text):
+        _ = self.request.getText
 
         gvformat = self.get_gv_format()
 
@@ -1909,10 +1945,7 @@ class GraphShower(object):
         return outgraph
 
     def execute(self):
-        _ = self.request.getText
-
         error = self.form_args()
-        warnings = list()
 
         if self.format == 'kml':
             self.GEO_IP, geo_error = geoip_init(self.request)
@@ -1926,7 +1959,70 @@ class GraphShower(object):
             self.send_form()
             self.fail_page(error)
             return
-            
+
+        key = self.output_key()
+        output = self.cached_output(key)
+        if output is None:
+            output = self.render_output(formatter, key)
+        self.request.write(output)
+
+        if not self.inline:
+            self.send_footer(formatter)
+
+    def output_key(self):
+        """
+        Key of the output for this request. The output does not change
+        between edits, so it can be looked up without going through
+        the graph data.
+        """
+        request = self.request
+        return cache_key(request, ['output', self.pagename, self.app_page,
+                                   self.inline, self.urladd,
+                                   self.graphengine,
+                                   sorted(request.values.lists()),
+                                   request.user.name, request.lang,
+                                   latest_edit(request)])
+
+    def cached_output(self, key):
+        if not cache_exists(self.request, key) or \
+                not cache_exists(self.request, key + '-images'):
+            return None
+
+        # The images may have been removed from the cache separately
+        datafile = cache._get_datafile(self.request, key + '-images')
+        image_keys = datafile.read().split()
+        datafile.close()
+        for image_key in image_keys:
+            if not cache_exists(self.request, image_key):
+                return None
+
+        datafile = cache._get_datafile(self.request, key)
+        output = datafile.read()
+        datafile.close()
+        return output
+
+    def render_output(self, formatter, key):
+        buf = OutputBuffer()
+        self.request.redirect(buf)
+        try:
+            self.send_output(formatter)
+        finally:
+            self.request.redirect()
+        output = buf.getvalue()
+
+        if self.layout_failed:
+            pass
+        elif not getattr(self.request.cfg, 'gwiki_cache_invalidate', False):
+            cache.put(self.request, key, output, content_type='text/plain')
+            cache.put(self.request, key + '-images',
+                      ' '.join(self.image_keys), content_type='text/plain')
+
+        return output
+
+    def send_output(self, formatter):
+        _ = self.request.getText
+        warnings = list()
+
         self.build_graph_data()
         outgraph = self.build_outgraph()
 
@@ -2027,9 +2123,6 @@ class GraphShower(object):
         else:
             self.test_graph(gr, outgraph)
 
-        if not self.inline:
-            self.send_footer(formatter)
-
     def test_graph(self, gr, outgraph):
         formatter = self.request.formatter
         self.request.write('<div class="graph-info">')
@@ -26,15 +26,12 @@
     OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
     DEALINGS IN THE SOFTWARE.
 """
-import os
-from tempfile import mkstemp
-
 from MoinMoin import wikiutil
 from MoinMoin.action import AttachFile
 from MoinMoin.action import cache
 
 from graphingwiki import gv_found, actionname, values_to_form
-from graphingwiki.graphrepr import Graphviz
+from graphingwiki.layout import layout, LayoutError
 from graphingwiki.util import enter_page, exit_page, url_parameters, \
     encode_page, cache_exists, cache_key, form_escape
 
@@ -218,12 +215,22 @@ class ViewDot(object):
 
         if self.format in ['zgr', 'svg']:
             formatcontent = 'svg+xml'
+            gvformat = 'svg'
         else:
             formatcontent = self.format
+            gvformat = self.format
 
         if not cache_exists(request, key):
-            graphviz = Graphviz(engine=self.graphengine, string=data)
-            data = self.getLayoutInFormat(graphviz, self.format)
+            try:
+                data = layout(request, data, self.graphengine, gvformat)
+            except LayoutError, e:
+                fault = _(u"ERROR: %s.") % (unicode(e))
+                if self.inline:
+                    request.write(request.formatter.text(fault))
+                    return
+                request.content_type = 'text/plain'
+                request.write(fault)
+                return
 
             cache.put(self.request, key, data, content_type=formatcontent)
 
@@ -68,9 +68,10 @@ def parse_text(request, page, text):
     pi, _ = get_processing_instructions(text)
     for verb, args in pi:
         if verb == u'acl':
-            # Add all ACL:s on multiple lines to an one-lines
+            # Keep the ACL lines apart, each ending with a newline,
+            # so that they can be parsed as the page does
             acls = new_data.get(pagename, dict()).get('acl', '')
-            acls = acls.strip() + args
+            acls = acls + args + u'\n'
             new_data.setdefault(pagename, dict())['acl'] = acls
 
     for metakey, value in p.definitions.iteritems():
@@ -45,7 +45,7 @@ def macro_LonePages(macro, omit_hierarchical=False, limit=0):
         if (pageobj.get("saved") and
            not pageobj.get("out") and
            not pageobj.get("include") and
-           not pageobj.get("in")):
+           not request.graphdata.has_in(page)):
             count += 1
             out += (f.listitem(1, **{"class": "loneitem"}) +
                     f.pagelink(1, page) + f.text(page) + f.pagelink(0) +
@@ -14,8 +14,11 @@ class SlideshowException(Exception):
         return self.args
 
 def get_slides(request, pagename, slidekey, direction):
-    pagedata = request.graphdata.getpage(pagename)
-    slides = pagedata.get(direction, dict()).get(slidekey, list())
+    if direction == 'in':
+        links = request.graphdata.get_in(pagename)
+    else:
+        links = request.graphdata.get_out(pagename)
+    slides = links.get(slidekey, list())
     
     accessible = list()
     for slide in slides:
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    Graphingwiki - MetaSlideshow macro tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import os
+import shutil
+import tempfile
+
+from MoinMoin._tests import become_trusted, create_page, nuke_page
+from MoinMoin.metadata.backend import shelvedb
+
+from graphingwiki.plugin.macro import MetaSlideshow
+
+FIRST = u'MetaSlideshowFirst'
+SECOND = u'MetaSlideshowSecond'
+
+
+class TestMetaSlideshow(object):
+    """ MetaSlideshow: following the slide links both ways """
+
+    def setup_class(self):
+        become_trusted(self.request)
+        create_page(self.request, FIRST, u'First slide\n')
+        create_page(self.request, SECOND, u'Second slide\n')
+
+    def teardown_class(self):
+        become_trusted(self.request)
+        nuke_page(self.request, FIRST)
+        nuke_page(self.request, SECOND)
+
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_graphdata = self.request.__dict__.pop('_graphdata', None)
+
+        graphshelve = os.path.join(self.tempdir, 'graphdata.shelve')
+        graphdata = shelvedb.GraphData(self.request, graphshelve=graphshelve)
+        graphdata.set_page(self.request, FIRST,
+                           {FIRST: {u'meta': {u'next': [u'[[%s]]' % SECOND]},
+                                    u'out': {u'next': [SECOND]}}})
+        graphdata.set_page(self.request, SECOND, {SECOND: {}})
+        graphdata.commit()
+        self.request.__dict__['_graphdata'] = graphdata
+
+    def teardown_method(self, method):
+        graphdata = self.request.__dict__.pop('_graphdata', None)
+        if graphdata is not None:
+            graphdata.close()
+        if self.old_graphdata is not None:
+            self.request.__dict__['_graphdata'] = self.old_graphdata
+        shutil.rmtree(self.tempdir)
+
+    def test_get_slides(self):
+        request = self.request
+        assert MetaSlideshow.get_slides(request, FIRST, u'next', 'out') == \
+            [SECOND]
+        assert MetaSlideshow.get_slides(request, SECOND, u'next', 'in') == \
+            [FIRST]
+        assert MetaSlideshow.get_slides(request, FIRST, u'next', 'in') == []
+
+    def test_get_slideshow(self):
+        request = self.request
+        slideshow = [FIRST, SECOND]
+        assert MetaSlideshow.get_slideshow(request, FIRST, u'next') == \
+            slideshow
+        # The previous slides are found through the links in
+        assert MetaSlideshow.get_slideshow(request, SECOND, u'next') == \
+            slideshow
+
+coverage_modules = ['graphingwiki.plugin.macro.MetaSlideshow']
@@ -27,14 +27,12 @@
     DEALINGS IN THE SOFTWARE.
 """
 
-import os
-from tempfile import mkstemp
 from base64 import b64encode
 
 from MoinMoin import wikiutil
 
 from graphingwiki import gv_found
-from graphingwiki.graphrepr import Graphviz
+from graphingwiki.layout import layout, LayoutError
 
 Dependencies = ['attachments']
 
@@ -54,16 +52,6 @@ class Parser(object):
         if 'engine' in attrs:
             self.graphengine = attrs['engine'].encode('utf-8')[1:-1]
 
-    def getLayoutInFormat(self, graphviz, format):
-        tmp_fileno, tmp_name = mkstemp()
-        graphviz.layout(fname=tmp_name, format=format)
-        f = file(tmp_name)
-        data = f.read()
-        os.close(tmp_fileno)
-        os.remove(tmp_name)
-
-        return data
-
     def format(self, formatter, **kw):
         _ = self.request.getText
 
@@ -74,13 +62,12 @@ class Parser(object):
             return
 
         try:
-            graphviz = Graphviz(engine=self.graphengine, string=self.raw)
-        except ValueError, e:
+            img = layout(self.request, self.raw, self.graphengine,
+                         self.layoutformat)
+        except LayoutError, e:
             self.request.write(formatter.text(_(\
                         "ERROR: Malformed graph (%s).") % (e)))
             return
-            
-        img = self.getLayoutInFormat(graphviz, self.layoutformat)
 
         imgbase = "data:image/" + self.layoutformat + ";base64," + \
                   b64encode(img)
@@ -1,25 +1,39 @@
+import os
+import re
+import tempfile
 import xmlrpclib
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
-from cStringIO import StringIO
-
-from graphingwiki.editing import save_attachfile
 from graphingwiki.editing import check_attachfile
+from graphingwiki.editing import check_pagecachefile
 from graphingwiki.editing import list_pagecachefiles
 from graphingwiki.editing import list_attachments
 
-from graphingwiki.editing import load_pagecachefile
 from graphingwiki.editing import delete_pagecachefile
-from graphingwiki.editing import load_attachfile
 from graphingwiki.editing import delete_attachfile
 
+from MoinMoin import caching
+from MoinMoin import config
+from MoinMoin.Page import Page
+from MoinMoin.support.python_compatibility import hash_new
+from MoinMoin.util import filesys
 from MoinMoin.wikiutil import normalize_pagename
+from MoinMoin.action.AttachFile import RangeFile, _addLogEntry
 
 CHUNK_SIZE = 1024 * 1024
 
+# Chunks are named after the md5 digest of their data
+DIGEST_RE = re.compile('^[0-9a-f]{32}$')
+# Clients may also give the sha256 digests of the chunks, which chunks
+# of the attachments of other pages are checked against
+STRONG_RE = re.compile('^[0-9a-f]{64}$')
+
+class MissingChunk(Exception):
+    pass
+
 def runChecked(func, request, pagename, filename, *args, **keys):
     # Checks ACLs and the return value of the called function.
     # If the return value is None, return Fault
@@ -35,27 +49,267 @@ def runChecked(func, request, pagename, filename, *args, **keys):
 
     return result
 
+def digests_entry(request, pagename, filename):
+    # The digests of an attachment are kept in the page cache, where
+    # they are not listed as attachments. The key is hashed as the
+    # attachment name can have characters not fit for a cache key.
+    key = 'chunkdigests-' + md5(filename.encode('utf-8')).hexdigest()
+    return caching.CacheEntry(request, Page(request, pagename), key,
+                              scope='item', do_locking=False,
+                              use_pickle=True)
+
+def chunk_entry(request, digest):
+    # Index of the chunks of all attachments by digest, so that a
+    # chunk already in the wiki does not have to be uploaded again
+    # for another page.
+    return caching.CacheEntry(request, 'chunks', digest, scope='wiki',
+                              do_locking=False, use_pickle=True)
+
+def file_identity(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def load_digests(request, pagename, filename, st):
+    # Return the stored digests of the attachment, if they were
+    # stored for the file of the given stat and not an older one.
+    entry = digests_entry(request, pagename, filename)
+    if not entry.exists():
+        return None
+
+    try:
+        digests = entry.content()
+    except caching.CacheError:
+        return None
+
+    if digests.get('identity') != file_identity(st):
+        return None
+
+    return digests
+
+def save_digests(request, pagename, filename, st, digest, chunkSize, chunks,
+                 strong):
+    # The chunks are only indexed when they are all chunkSize long,
+    # apart from the last one, as their offsets follow from that.
+    digests = {'identity': file_identity(st),
+               'digest': digest,
+               'size': st.st_size,
+               'chunkSize': chunkSize,
+               'chunks': chunks,
+               'strong': strong}
+
+    try:
+        digests_entry(request, pagename, filename).update(digests)
+
+        if chunkSize:
+            seen = set()
+            for index, chunk in enumerate(chunks):
+                if chunk in seen:
+                    continue
+                seen.add(chunk)
+                chunk_entry(request, chunk).update((pagename, filename, index))
+    except caching.CacheError:
+        pass
+
+    return digests
+
+def hash_file(stream, chunkSize):
+    # Return the digest of the whole file and the md5 and sha256
+    # digests of each of its chunks
+    digest = md5()
+    chunks = list()
+    strong = list()
+
+    data = stream.read(chunkSize)
+    while data:
+        digest.update(data)
+        chunks.append(md5(data).hexdigest())
+        strong.append(hash_new('sha256', data).hexdigest())
+        data = stream.read(chunkSize)
+
+    return digest.hexdigest(), chunks, strong
+
+def file_digests(request, pagename, filename, fpath, chunkSize=None):
+    # Return the digests of an attachment, for chunks of chunkSize if
+    # given. They are only computed when the file has changed since
+    # they were last stored.
+    stream = open(fpath, "rb")
+    try:
+        st = os.fstat(stream.fileno())
+        digests = load_digests(request, pagename, filename, st)
+        if digests is not None and chunkSize in (None, digests['chunkSize']):
+            return digests
+
+        digest, chunks, strong = hash_file(stream, chunkSize or CHUNK_SIZE)
+    finally:
+        stream.close()
+
+    return save_digests(request, pagename, filename, st, digest,
+                        chunkSize or CHUNK_SIZE, chunks, strong)
+
+def find_chunks(request, pagename, digests, strong=None):
+    # Return a dict of the digests that have a chunk of the same data
+    # in an attachment that the user may read, to (path, digests of
+    # the attachment, index of the chunk). As md5 collisions can be
+    # made, chunks of other pages are only used when their sha256
+    # digest is the one given for the digest in strong.
+    found = dict()
+    attachments = dict()
+    strong = strong or dict()
+
+    for digest in digests:
+        if digest in found or not DIGEST_RE.match(digest):
+            continue
+
+        entry = chunk_entry(request, digest)
+        if not entry.exists():
+            continue
+
+        try:
+            source, filename, index = entry.content()
+        except (caching.CacheError, TypeError, ValueError):
+            continue
+
+        if source != pagename and not strong.get(digest):
+            continue
+        if not request.user.may.read(source):
+            continue
+
+        key = source, filename
+        if key not in attachments:
+            attachments[key] = None
+            fpath, exists = check_attachfile(request, source, filename)
+            if exists:
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    continue
+                stored = load_digests(request, source, filename, st)
+                # Digests stored before the sha256 ones were are not
+                # used, the data can not be checked
+                if stored is not None and stored['chunkSize'] and \
+                        stored.get('strong'):
+                    attachments[key] = fpath, stored
+
+        if attachments[key] is None:
+            continue
+
+        fpath, stored = attachments[key]
+        if stored['chunks'][index:index + 1] != [digest]:
+            continue
+        if source != pagename and stored['strong'][index] != strong[digest]:
+            continue
+        found[digest] = fpath, stored, index
+
+    return found
+
+def open_chunk(request, pagename, digest, found):
+    # Return a file-like object for the data of a chunk, None if it
+    # is not there (anymore).
+    if digest in found:
+        fpath, stored, index = found[digest]
+        try:
+            stream = open(fpath, "rb")
+        except IOError:
+            return None
+
+        # The file may have been replaced since the chunk was found
+        if file_identity(os.fstat(stream.fileno())) != stored['identity']:
+            stream.close()
+            return None
+
+        start = index * stored['chunkSize']
+        stop = min(start + stored['chunkSize'], stored['size'])
+        return RangeFile(stream, [('', start, stop)])
+
+    # Try both cache files and attachments (for legacy, see reassembly)
+    entry, exists = check_pagecachefile(request, pagename, digest)
+    if exists:
+        try:
+            entry.open(mode='rb')
+        except caching.CacheError:
+            return None
+        return entry
+
+    fpath, exists = check_attachfile(request, pagename, digest)
+    if exists:
+        try:
+            return open(fpath, "rb")
+        except IOError:
+            return None
+
+    return None
+
+def write_chunks(request, pagename, fpath, digests, found):
+    # Stream the chunks into a temp file next to the attachment and
+    # rename it over the attachment when all of it is written, so
+    # that no one sees a partial file. Returns the stat of the file,
+    # its digest and the digests, sha256 digests and sizes of the
+    # chunks. Chunks of other attachments must still have the data
+    # their sha256 digest was stored for.
+    fd, tmpname = tempfile.mkstemp('.tmp', '.chunked-',
+                                   os.path.dirname(fpath))
+    try:
+        stream = os.fdopen(fd, 'wb')
+        try:
+            digest = md5()
+            chunks = list()
+            strong = list()
+            sizes = list()
+
+            for bite in digests:
+                source = open_chunk(request, pagename, bite, found)
+                if source is None:
+                    raise MissingChunk(bite)
+
+                chunk = md5()
+                chunk_strong = hash_new('sha256')
+                size = 0
+                try:
+                    data = source.read(CHUNK_SIZE)
+                    while data:
+                        digest.update(data)
+                        chunk.update(data)
+                        chunk_strong.update(data)
+                        size += len(data)
+                        stream.write(data)
+                        data = source.read(CHUNK_SIZE)
+                finally:
+                    source.close()
+
+                if bite in found:
+                    stored, index = found[bite][1:]
+                    if chunk_strong.hexdigest() != stored['strong'][index]:
+                        raise MissingChunk(bite)
+
+                chunks.append(chunk.hexdigest())
+                strong.append(chunk_strong.hexdigest())
+                sizes.append(size)
+        finally:
+            stream.close()
+
+        filesys.chmod(tmpname, 0666 & config.umask)
+        # The rename keeps the inode and mtime of the temp file
+        st = os.stat(tmpname)
+        filesys.rename(tmpname, fpath)
+    except:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
+    return st, digest.hexdigest(), chunks, strong, sizes
+
 def info(request, pagename, filename):
     try:
         fpath, exists = check_attachfile(request, pagename, filename)
         if not exists:
             return None
 
-        stream = open(fpath, "rb")
-        digest = md5()
-
-        data = stream.read(CHUNK_SIZE)
-        while data:
-            digest.update(data)
-            data = stream.read(CHUNK_SIZE)
-
-        digest = digest.hexdigest()
-        size = stream.tell()
-        stream.close()
+        digests = file_digests(request, pagename, filename, fpath)
     except:
         return None
 
-    return [digest, size]
+    return [digests['digest'], digests['size']]
 
 def load(request, pagename, filename, start, end):
     try:
@@ -63,16 +317,17 @@ def load(request, pagename, filename, start, end):
         if not exists:
             return None
 
-        stream = open(fpath, "rb")
-        stream.seek(start)
-        data = stream.read(max(end-start, 0))
+        # Same reader as the byte ranges of AttachFile downloads
+        stream = RangeFile(open(fpath, "rb"), [('', start, end)])
+        data = stream.read()
         stream.close()
     except:
         return None
 
     return xmlrpclib.Binary(data)
 
-def reassembly(request, pagename, filename, chunkSize, digests, overwrite=True):
+def reassembly(request, pagename, filename, chunkSize, digests, overwrite=True,
+               strong=None):
     _ = request.getText
 
     # Also check ACLs
@@ -80,26 +335,18 @@ def reassembly(request, pagename, filename, chunkSize, digests, overwrite=True):
         return xmlrpclib.Fault(1, _("You are not allowed to attach a "+
                                     "file to this page"))
 
-    # Check whether the file already exists. If it does, check the hashes.
+    # Check whether the file already exists. If it does, check the
+    # hashes, which are stored with the file when it is reassembled.
     fpath, exists = check_attachfile(request, pagename, filename)
     if chunkSize is not None and exists:
         try:
-            stream = open(fpath, "rb")
-        except:
+            stored = file_digests(request, pagename, filename, fpath,
+                                  chunkSize)
+        except (IOError, OSError):
             pass
         else:
-            for digest in digests:
-                data = stream.read(chunkSize)
-                other = md5(data).hexdigest()
-                if other != digest:
-                    break
-            else:
-                data = stream.read(chunkSize)
-                if not data:
-                    stream.close()
-                    return list()
-            
-            stream.close()
+            if stored['chunks'] == list(digests):
+                return list()
 
         # Fail if the file doesn't match and we don't want to overwrite.
         if not overwrite:
@@ -107,48 +354,58 @@ def reassembly(request, pagename, filename, chunkSize, digests, overwrite=True):
 
     # If there are missing chunks, just return them. Chunks might also
     # be in attachments for the people that use older versions of
-    # opencollab.
-    result = list_pagecachefiles(request, pagename)
-    result.extend(list_attachments(request, pagename))
+    # opencollab, or in attachments of any page that have chunks with
+    # the same data.
+    result = set(list_pagecachefiles(request, pagename))
+    result.update(list_attachments(request, pagename))
     missing = [digest for digest in digests if digest not in result]
+    strong = dict((digest, value.lower())
+                  for digest, value in zip(digests, strong or list())
+                  if isinstance(value, basestring) and
+                  STRONG_RE.match(value.lower()))
+    found = find_chunks(request, pagename, missing, strong)
+    missing = [digest for digest in missing if digest not in found]
     if missing:
         return missing
 
+    if exists and not overwrite:
+        return xmlrpclib.Fault(2, _("Attachment not saved, file exists"))
+
     # Reassembly the file from the chunks into a temp file.
-    buffer = StringIO()
-    
-    for bite in digests:
-        # Try both cache files and attachments (for legacy, see above)
-        data = load_pagecachefile(request, pagename, bite)
-        if not data:
-            data = load_attachfile(request, pagename, bite)
-        if not data:
-            return xmlrpclib.Fault(2, "%s: %s" % (_("Nonexisting "+
-                                                    "attachment or cachefile"),
-                                                  filename))
-        buffer.write(data)
-
-    # Attach the decoded file.
-    success = save_attachfile(request, pagename, buffer.getvalue(), filename, 
-                              overwrite, True)
+    try:
+        st, digest, chunks, strong, sizes = write_chunks(request, pagename,
+                                                         fpath, digests,
+                                                         found)
+    except MissingChunk:
+        return xmlrpclib.Fault(2, "%s: %s" % (_("Nonexisting "+
+                                                "attachment or cachefile"),
+                                              filename))
+    except (IOError, OSError, caching.CacheError):
+        return xmlrpclib.Fault(2, _("Attachment not saved"))
+
+    _addLogEntry(request, 'ATTNEW', pagename, filename)
+
+    # The chunks can only be found by offset if they are of chunkSize.
+    if not chunkSize or [size for size in sizes[:-1] if size != chunkSize] or \
+            sizes and sizes[-1] > chunkSize:
+        chunkSize = None
+    save_digests(request, pagename, filename, st, digest, chunkSize, chunks,
+                 strong)
 
     # FIXME: What should we do when the cleanup fails?
-    for bite in digests:
+    for bite in set(digests):
+        if bite in found:
+            continue
         # Try both cache files and attachments (for legacy, see above)
         in_cache = delete_pagecachefile(request, pagename, bite)
         if not in_cache:
             delete_attachfile(request, pagename, bite, True)
 
-    # On success signal that there were no missing chunks.
-    if success:
-        return list()
-    
-    if overwrite == False:
-        return xmlrpclib.Fault(2, _("Attachment not saved, file exists"))
-
-    return xmlrpclib.Fault(2, _("Attachment not saved"))
+    # Signal that there were no missing chunks.
+    return list()
 
-def execute(xmlrpcobj, page, fname, action='info', start=None, end=None):
+def execute(xmlrpcobj, page, fname, action='info', start=None, end=None,
+            strong=None):
     request = xmlrpcobj.request
     _ = request.getText
 
@@ -165,7 +422,8 @@ def execute(xmlrpcobj, page, fname, action='info', start=None, end=None):
         success = runChecked(load, request, page, fname, start, end)
     elif action == 'reassembly' and start is not None:
         chunk, digests = start, end
-        success = runChecked(reassembly, request, page, fname, chunk, digests)
+        success = runChecked(reassembly, request, page, fname, chunk, digests,
+                             strong=strong)
     else:
         success = xmlrpclib.Fault(3, _("No method specified or invalid span"))
 
@@ -1,17 +1,17 @@
 """
     Incremental GetMeta (prototype).
 
+    Handles are versions of the change feed of the graph data, so
+    polling with a handle only gets the metas of the pages changed
+    after it. The earlier values of the changed pages are not known,
+    so they are reported as removed and then added with all their
+    current values.
+
     @copyright: 2008 by Joachim Viide
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 """
-import os
-import struct
-import base64
-import shelve
-
-from graphingwiki.editing import get_metas, metatable_parseargs
+from MoinMoin.metadata.query import get_metas, metatable_parseargs
 
-from MoinMoin.util.lock import WriteLock
 from MoinMoin.Page import Page
 
 def diff(previous, current):
@@ -41,17 +41,20 @@ def diff(previous, current):
 
             if discarded or added:
                 updates.setdefault(page, dict())[key] = discarded, added
-            
-    return removedPages, updates
 
-def create_new_handle(db):
-    number = db.get("", 0)
-    db[""] = number + 1
-    return base64.b64encode(struct.pack("!Q", number))
-
-def inc_get_metas(request, args, handle=None):
-    pages, keys, _ = metatable_parseargs(request, args, get_all_keys=True)
+    return removedPages, updates
 
+def parse_handle(handle):
+    "Return the version of a handle, or None for unknown handles"
+    try:
+        version = int(handle)
+    except (TypeError, ValueError):
+        return None
+    if version < 0:
+        return None
+    return version
+
+def current_metas(request, pages, keys):
     current = dict()
     for page in pages:
         request.page = Page(request, page)
@@ -62,31 +65,49 @@ def inc_get_metas(request, args, handle=None):
         for key in keys:
             values = set(metas[key])
             current[page][key] = values
+    return current
 
-    cachedir = os.path.join(request.cfg.cache_dir, "getmetas")
-    if not os.path.exists(cachedir):
-        os.makedirs(cachedir)
+def inc_get_metas(request, args, handle=None):
+    graphdata = request.graphdata
 
-    lock = WriteLock(cachedir, timeout=60.0)
-    success = lock.acquire()
+    # Changes made while this poll is running are seen again by the
+    # next one
+    version = graphdata.get_version()
+    previous = parse_handle(handle)
+    # Handles from before the graph data was rebuilt from scratch
+    if previous is not None and previous > version:
+        previous = None
 
-    path = os.path.join(cachedir, request.cfg.siteid + ".shelve")
-    db = shelve.open(path)
+    pages, keys, _ = metatable_parseargs(request, args, get_all_keys=True)
 
-    incremental = True
-    try:
-        if not handle or handle not in db:
-            incremental = False
-            handle = create_new_handle(db)
-        previous = db.get(handle, dict())
-        db[handle] = current
-    finally:
-        db.close()
-
-    if lock.isLocked():
-        lock.release()
-
-    return [incremental, handle, diff(previous, current)]
+    if previous is None:
+        current = current_metas(request, pages, keys)
+        return [False, str(version), diff(dict(), current)]
+
+    changed = graphdata.changes_since(previous)[0]
+
+    # Groups and dicts affect who may read what, so any page may have
+    # entered or left the result without changing itself
+    cache = request.cfg.cache
+    for name in changed:
+        if (cache.page_group_regexact.search(name) or
+            cache.page_dict_regexact.search(name)):
+            current = current_metas(request, pages, keys)
+            return [False, str(version), diff(dict(), current)]
+
+    pages = set(pages)
+
+    # Values of indirect keys come from other pages
+    if [key for key in keys if '->' in key]:
+        changed.update(pages)
+
+    removed = list()
+    for page in changed:
+        if page in pages or request.user.may.read(page):
+            removed.append(page)
+
+    current = current_metas(request, pages & changed, keys)
+    return [True, str(version), (removed, diff(dict(), current)[1])]
 
 def execute(xmlrpcobj, query, handle=None):
     request = xmlrpcobj.request
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+    Graphingwiki - ChunkedAttachFile xmlrpc plugin tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import os
+import xmlrpclib
+
+import py
+
+from MoinMoin.action import AttachFile
+from MoinMoin.support.python_compatibility import hash_new
+from MoinMoin._tests import become_trusted, create_page, nuke_page, wikiconfig
+
+from graphingwiki.editing import check_attachfile, list_pagecachefiles
+from graphingwiki.editing import save_pagecachefile
+from graphingwiki.plugin.xmlrpc import ChunkedAttachFile
+
+PAGE = u'ChunkedAttachFilePage'
+OTHER = u'ChunkedAttachFileOther'
+SECRET = u'ChunkedAttachFileSecret'
+
+
+def md5sum(data):
+    return hash_new('md5', data).hexdigest()
+
+def sha256sum(data):
+    return hash_new('sha256', data).hexdigest()
+
+
+class TestChunkedAttachFile(object):
+    """ ChunkedAttachFile: digests and reassembly of attachments """
+
+    class Config(wikiconfig.Config):
+        acl_rights_before = u'AdminUser:read,write,delete,revert,admin'
+
+    def setup_class(self):
+        become_trusted(self.request, u'AdminUser')
+        create_page(self.request, PAGE, u'Chunks\n')
+        create_page(self.request, OTHER, u'Chunks\n')
+        create_page(self.request, SECRET, u'#acl All:\nChunks\n')
+
+    def teardown_class(self):
+        become_trusted(self.request, u'AdminUser')
+        for pagename in [PAGE, OTHER, SECRET]:
+            nuke_page(self.request, pagename)
+
+    def setup_method(self, method):
+        become_trusted(self.request)
+
+    def attach(self, pagename, filename, content, chunkSize=None):
+        AttachFile.add_attachment(self.request, pagename, filename,
+                                  content, overwrite=1)
+        fpath, exists = check_attachfile(self.request, pagename, filename)
+        if chunkSize:
+            ChunkedAttachFile.file_digests(self.request, pagename, filename,
+                                           fpath, chunkSize)
+        return fpath
+
+    def read(self, fpath):
+        return file(fpath, 'rb').read()
+
+    def test_info(self):
+        request = self.request
+        self.attach(PAGE, u'info.bin', 'info data')
+        entry = ChunkedAttachFile.digests_entry(request, PAGE, u'info.bin')
+        assert not entry.exists()
+
+        result = ChunkedAttachFile.info(request, PAGE, u'info.bin')
+        assert result == [md5sum('info data'), 9]
+        assert entry.exists()
+
+        # The stored digests are used while the file is not changed
+        digests = entry.content()
+        digests['digest'] = 'stored'
+        entry.update(digests)
+        result = ChunkedAttachFile.info(request, PAGE, u'info.bin')
+        assert result == ['stored', 9]
+
+        self.attach(PAGE, u'info.bin', 'other data!')
+        result = ChunkedAttachFile.info(request, PAGE, u'info.bin')
+        assert result == [md5sum('other data!'), 11]
+
+        assert ChunkedAttachFile.info(request, PAGE, u'missing.bin') is None
+
+    def test_already_matches(self):
+        request = self.request
+        fpath = self.attach(PAGE, u'match.bin', 'abcdefgh', 4)
+
+        digests = [md5sum('abcd'), md5sum('efgh')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'match.bin',
+                                              4, digests, False)
+        assert result == list()
+        assert self.read(fpath) == 'abcdefgh'
+
+        # A file that does not match is not overwritten
+        digests = [md5sum('abcd'), md5sum('ijkl')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'match.bin',
+                                              4, digests, False)
+        assert isinstance(result, xmlrpclib.Fault)
+        assert self.read(fpath) == 'abcdefgh'
+
+    def test_reassembly(self):
+        request = self.request
+        fpath = self.attach(PAGE, u'new.bin', 'old data')
+
+        digests = [md5sum('mnop'), md5sum('qrst')]
+        save_pagecachefile(request, PAGE, 'mnop', digests[0])
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'new.bin',
+                                              4, digests)
+        assert result == [digests[1]]
+        assert self.read(fpath) == 'old data'
+
+        save_pagecachefile(request, PAGE, 'qrst', digests[1])
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'new.bin',
+                                              4, digests)
+        assert result == list()
+        assert self.read(fpath) == 'mnopqrst'
+        # The uploaded chunks are removed
+        assert digests[0] not in list_pagecachefiles(request, PAGE)
+        assert ChunkedAttachFile.info(request, PAGE, u'new.bin') == \
+            [md5sum('mnopqrst'), 8]
+
+    def test_missing_chunk(self):
+        request = self.request
+        fpath = self.attach(PAGE, u'keep.bin', 'old data')
+        attach_dir = os.path.dirname(fpath)
+        files = sorted(os.listdir(attach_dir))
+
+        digests = [md5sum('abcd'), md5sum('gone')]
+        save_pagecachefile(request, PAGE, 'abcd', digests[0])
+        py.test.raises(ChunkedAttachFile.MissingChunk,
+                       ChunkedAttachFile.write_chunks,
+                       request, PAGE, fpath, digests, dict())
+
+        assert self.read(fpath) == 'old data'
+        assert sorted(os.listdir(attach_dir)) == files
+
+    def test_reuse_own_page(self):
+        request = self.request
+        self.attach(PAGE, u'source.bin', 'ownchunk', 4)
+        fpath = self.attach(PAGE, u'copy.bin', 'old data')
+
+        digests = [md5sum('hunk'), md5sum('ownc')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'copy.bin',
+                                              4, digests)
+        assert result == list()
+        assert self.read(fpath) == 'hunkownc'
+
+    def test_reuse_other_page(self):
+        request = self.request
+        self.attach(OTHER, u'source.bin', 'readable', 4)
+        fpath = self.attach(PAGE, u'reuse.bin', 'old data')
+        digests = [md5sum('able'), md5sum('read')]
+
+        # Without the sha256 digests md5 collisions could be used to
+        # get the data of another attachment into this one
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'reuse.bin',
+                                              4, digests)
+        assert result == digests
+
+        strong = [sha256sum('able'), sha256sum('other')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'reuse.bin',
+                                              4, digests, strong=strong)
+        assert result == [digests[1]]
+
+        strong = [sha256sum('able'), sha256sum('read')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'reuse.bin',
+                                              4, digests, strong=strong)
+        assert result == list()
+        assert self.read(fpath) == 'ableread'
+
+    def test_reuse_unreadable_page(self):
+        request = self.request
+        become_trusted(request, u'AdminUser')
+        self.attach(SECRET, u'source.bin', 'secretly', 4)
+        become_trusted(request)
+        assert not request.user.may.read(SECRET)
+        fpath = self.attach(PAGE, u'secret.bin', 'old data')
+
+        digests = [md5sum('secr'), md5sum('etly')]
+        strong = [sha256sum('secr'), sha256sum('etly')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'secret.bin',
+                                              4, digests, strong=strong)
+        assert result == digests
+        assert self.read(fpath) == 'old data'
+
+    def test_reuse_changed_chunk(self):
+        request = self.request
+        source = self.attach(OTHER, u'changed.bin', 'chanchan', 4)
+        fpath = self.attach(PAGE, u'changed.bin', 'old data')
+
+        # The data of the chunk no longer has the stored sha256 digest
+        entry = ChunkedAttachFile.digests_entry(request, OTHER, u'changed.bin')
+        stored = entry.content()
+        stored['strong'] = [sha256sum('else')] * 2
+        entry.update(stored)
+
+        digests = [md5sum('chan')]
+        strong = [sha256sum('else')]
+        result = ChunkedAttachFile.reassembly(request, PAGE, u'changed.bin',
+                                              4, digests, strong=strong)
+        assert isinstance(result, xmlrpclib.Fault)
+        assert self.read(fpath) == 'old data'
+
+coverage_modules = ['graphingwiki.plugin.xmlrpc.ChunkedAttachFile']
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    Graphingwiki - IncGetMeta xmlrpc plugin tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+import os
+import shutil
+import tempfile
+
+from MoinMoin._tests import become_trusted
+from MoinMoin.metadata.backend import shelvedb
+
+from graphingwiki.plugin.xmlrpc import IncGetMeta
+
+PAGE = u'IncGetMetaPage'
+OTHER = u'IncGetMetaOther'
+GROUP = u'IncGetMetaTestGroup'
+QUERY = u'%s, %s' % (PAGE, OTHER)
+
+
+def page_data(pagename, meta):
+    return {pagename: {u'meta': meta, u'out': dict()}}
+
+
+class TestIncGetMeta(object):
+    """ IncGetMeta: incremental results from the change feed """
+
+    def setup_method(self, method):
+        become_trusted(self.request)
+        self.tempdir = tempfile.mkdtemp()
+        self.old_graphdata = self.request.__dict__.pop('_graphdata', None)
+
+        self.graphdata = self.open_graphdata()
+        self.set_page(PAGE, {u'key': [u'1']})
+        self.set_page(OTHER, {u'key': [u'2']})
+
+    def teardown_method(self, method):
+        self.graphdata.close()
+        self.request.__dict__.pop('_graphdata', None)
+        if self.old_graphdata is not None:
+            self.request.__dict__['_graphdata'] = self.old_graphdata
+        shutil.rmtree(self.tempdir)
+
+    def open_graphdata(self):
+        graphshelve = os.path.join(self.tempdir, 'graphdata.shelve')
+        graphdata = shelvedb.GraphData(self.request, graphshelve=graphshelve)
+        self.request.__dict__['_graphdata'] = graphdata
+        return graphdata
+
+    def set_page(self, pagename, meta):
+        # The changed pages get their versions when closing
+        self.graphdata.set_page(self.request, pagename,
+                                page_data(pagename, meta))
+        self.graphdata.commit()
+        self.graphdata.close()
+        self.graphdata = self.open_graphdata()
+
+    def test_full(self):
+        incremental, handle, result = \
+            IncGetMeta.inc_get_metas(self.request, QUERY)
+        assert not incremental
+        assert handle == str(self.graphdata.get_version())
+        assert result == ([], {PAGE: {u'key': ([], [u'1'])},
+                               OTHER: {u'key': ([], [u'2'])}})
+
+        # Unknown handles and handles from the future get everything
+        for old in ['junk', str(int(handle) + 1)]:
+            assert IncGetMeta.inc_get_metas(self.request, QUERY, old) == \
+                [False, handle, result]
+
+    def test_incremental(self):
+        handle = IncGetMeta.inc_get_metas(self.request, QUERY)[1]
+        assert IncGetMeta.inc_get_metas(self.request, QUERY, handle) == \
+            [True, handle, ([], {})]
+
+        self.set_page(PAGE, {u'key': [u'3']})
+        incremental, newer, result = \
+            IncGetMeta.inc_get_metas(self.request, QUERY, handle)
+        assert incremental
+        assert int(newer) > int(handle)
+        assert result == ([PAGE], {PAGE: {u'key': ([], [u'3'])}})
+
+    def test_group_changed(self):
+        handle = IncGetMeta.inc_get_metas(self.request, QUERY)[1]
+
+        # Groups may change who may read any of the pages
+        self.set_page(GROUP, dict())
+        incremental, newer, result = \
+            IncGetMeta.inc_get_metas(self.request, QUERY, handle)
+        assert not incremental
+        assert int(newer) > int(handle)
+        assert result == ([], {PAGE: {u'key': ([], [u'1'])},
+                               OTHER: {u'key': ([], [u'2'])}})
+
+coverage_modules = ['graphingwiki.plugin.xmlrpc.IncGetMeta']
@@ -51,9 +51,17 @@ from MoinMoin.Page import Page
 from MoinMoin.PageEditor import PageEditor
 from MoinMoin.logfile import editlog
 
-from graphingwiki import geoip_found, GeoIP, id_escape, SEPARATOR
+from MoinMoin.metadata.constants import SEPARATOR, SPECIAL_ATTRS, NO_TYPE
+from MoinMoin.metadata.util import (filter_categories, category_regex,
+                                    template_regex, editable_p,
+                                    encode_page, decode_page)
+
+from graphingwiki import geoip_found, GeoIP, id_escape
 from graphingwiki.graph import Graph
 
+import logging
+log = logging.getLogger("graphingwiki")
+
 MOIN_VERSION = float('.'.join(MoinVersion.release.split('.')[:2]))
 
 
@@ -132,13 +140,12 @@ def geoip_get_coords(GEO_IP, text):
 # Methods related to Moin cache feature
 def latest_edit(request):
     log = editlog.EditLog(request)
-    entry = ''
 
-    for x in log.reverse():
-        entry = x
-        break
-    
-    return entry.ed_time_usecs
+    for entry in log.reverse():
+        return entry.ed_time_usecs
+
+    # Nothing edited yet
+    return 0
 
 def cache_exists(request, key):
     if getattr(request.cfg, 'gwiki_cache_invalidate', False):